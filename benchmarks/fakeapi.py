@@ -0,0 +1,107 @@
+""" In-process control API stand-in for benchmarks.
+
+    Answers every Api endpoint with a minimal valid response, hands out
+    backup ids and remembers completed backups so that the next one is
+    incremental. changes are answered once to the next changes request.
+    Requests are counted per endpoint.
+"""
+import re
+import json
+import threading
+import urlparse
+from collections import defaultdict
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+
+ID_RE = re.compile(r'/\d+(?=/|$)')
+JSON_ENDPOINTS = ('changes', 'get/schedules', 'get/access', 'get/db',
+                  'get/restore', 'version/current')
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in one segment, otherwise delayed ACK
+    # adds tens of milliseconds to every request
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else ''
+        path = urlparse.urlparse(self.path).path.strip('/')
+        if path.startswith('api/'):
+            path = path[4:]
+        data = {}
+        if self.headers.get('Content-Type', '').startswith(
+                'application/x-www-form-urlencoded'):
+            data = dict((k, v[0]) for k, v in urlparse.parse_qs(body).items())
+        code, content = self.server.api.respond(path, data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = _handle
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeApi(object):
+    def __init__(self, host='127.0.0.1', port=0):
+        self.requests = defaultdict(int)
+        self.backups = []
+        self.completed = []
+        # answer of the next changes request
+        self.changes = {}
+        self._lock = threading.Lock()
+        self.server = ThreadingServer((host, port), Handler)
+        self.server.api = self
+        self.host, self.port = self.server.server_address
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+
+    def respond(self, path, data):
+        with self._lock:
+            self.requests[ID_RE.sub('/<id>', path)] += 1
+            if path == 'backup/prepare':
+                self.backups.append(len(self.backups) + 1)
+                return 200, str(self.backups[-1])
+            if path == 'backup/filesystem':
+                if self.completed:
+                    return 200, json.dumps({'is_full': False,
+                                            'prev': self.completed[-1]})
+                return 200, json.dumps({'is_full': True})
+            if path == 'backup/complete':
+                self.completed.append(int(data['id']))
+                return 200, 'ok'
+            if path == 'changes':
+                changes, self.changes = self.changes, {}
+                return 200, json.dumps(changes)
+            if path.startswith('backup/') and path.endswith('/files'):
+                return 200, '{}'
+            if path in JSON_ENDPOINTS:
+                return 200, '{}'
+        return 200, 'ok'
+
+    def stats(self):
+        with self._lock:
+            return {'requests': dict(self.requests)}
+
+    def reset(self):
+        with self._lock:
+            self.requests.clear()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,466 @@
+""" In-process S3 stand-in for benchmarks.
+
+    Serves the part of the S3 REST API used by the client with path-style
+    addressing: buckets listing, objects with user metadata and ranged
+    reads, multipart uploads. Objects are kept in files under root so the
+    memory of the benchmarked process is not inflated. Authentication is
+    not checked.
+"""
+import os
+import time
+import json
+import shutil
+import socket
+import urllib
+import threading
+import urlparse
+from hashlib import md5
+from collections import defaultdict
+from email.utils import formatdate
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from xml.sax.saxutils import escape
+
+
+BLOCK_SIZE = 64 * 1024
+LIST_LIMIT = 1000
+XMLNS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+META_PREFIX = 'x-amz-meta-'
+
+
+class Storage(object):
+    """ Objects of one bucket stored as files named by md5 of the key
+    """
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+        self.keys = {}
+        self.uploads = {}
+        self.counter = 0
+        for d in ('objects', 'parts'):
+            os.makedirs(os.path.join(root, d))
+
+    def path(self, key):
+        return os.path.join(self.root, 'objects', md5(key).hexdigest())
+
+    def part_path(self, upload_id, part):
+        return os.path.join(self.root, 'parts', '%s.%05i' % (upload_id, part))
+
+    def put(self, key, path, etag, metadata):
+        os.rename(path, self.path(key))
+        with self.lock:
+            self.keys[key] = {'size': os.path.getsize(self.path(key)),
+                              'etag': etag,
+                              'mtime': time.time(),
+                              'metadata': metadata}
+
+    def get(self, key):
+        with self.lock:
+            return self.keys.get(key)
+
+    def delete(self, key):
+        with self.lock:
+            info = self.keys.pop(key, None)
+        if info:
+            os.remove(self.path(key))
+        return info
+
+    def list(self, prefix='', delimiter='', marker='', limit=LIST_LIMIT):
+        """ Returns keys, common prefixes and truncation flag
+        """
+        with self.lock:
+            names = sorted(k for k in self.keys
+                           if k.startswith(prefix) and k > marker)
+        keys = []
+        prefixes = []
+        for name in names:
+            if len(keys) + len(prefixes) >= limit:
+                return keys, prefixes, True
+            if delimiter:
+                pos = name.find(delimiter, len(prefix))
+                if pos != -1:
+                    common = name[:pos + len(delimiter)]
+                    if common not in prefixes and common > marker:
+                        prefixes.append(common)
+                    continue
+            keys.append((name, self.keys[name]))
+        return keys, prefixes, False
+
+    def initiate(self, key, metadata):
+        with self.lock:
+            self.counter += 1
+            upload_id = 'upload%08i' % self.counter
+            self.uploads[upload_id] = {'key': key, 'metadata': metadata,
+                                       'parts': {},
+                                       'initiated': time.time()}
+        return upload_id
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body go out in one segment, otherwise delayed ACK
+    # adds tens of milliseconds to every request
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.s3.opened(self.connection)
+
+    def finish(self):
+        self.s3.closed(self.connection)
+        BaseHTTPRequestHandler.finish(self)
+
+    @property
+    def s3(self):
+        return self.server.s3
+
+    def _parse(self):
+        url = urlparse.urlparse(self.path)
+        path = urllib.unquote(url.path).lstrip('/')
+        bucket, _, key = path.partition('/')
+        query = dict((k, v[0] if v else '') for k, v in
+                     urlparse.parse_qs(url.query,
+                                       keep_blank_values=True).iteritems())
+        return bucket, key, query
+
+    def _metadata(self):
+        return dict((k[len(META_PREFIX):], v)
+                    for k, v in self.headers.items()
+                    if k.lower().startswith(META_PREFIX))
+
+    def _respond(self, code, body='', headers=None, length=None):
+        self.send_response(code)
+        for name, value in (headers or {}).iteritems():
+            self.send_header(name, value)
+        self.send_header('Content-Length',
+                         str(len(body) if length is None else length))
+        self.end_headers()
+        if body and self.command != 'HEAD':
+            self.s3.transfer(len(body))
+            self.wfile.write(body)
+
+    def _xml(self, root, content, code=200):
+        body = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<%s xmlns="%s">%s</%s>' % (root, XMLNS, content, root))
+        self._respond(code, body, {'Content-Type': 'application/xml'})
+
+    def _error(self, code, error):
+        self._xml('Error', '<Code>%s</Code><Message>%s</Message>'
+                           % (error, error), code)
+
+    def _receive(self, path):
+        """ Reads request body to path, returns its md5
+        """
+        # clients send headers and body separately, acknowledge
+        # the headers at once as S3 does not hold the connection
+        if hasattr(socket, 'TCP_QUICKACK'):
+            self.connection.setsockopt(socket.IPPROTO_TCP,
+                                       socket.TCP_QUICKACK, 1)
+        left = int(self.headers.get('Content-Length', 0))
+        digest = md5()
+        with open(path, 'wb') as f:
+            while left:
+                data = self.rfile.read(min(left, BLOCK_SIZE))
+                if not data:
+                    break
+                self.s3.transfer(len(data))
+                digest.update(data)
+                f.write(data)
+                left -= len(data)
+        return digest.hexdigest()
+
+    def _count(self, kind):
+        self.s3.count(self.command, kind)
+        if self.s3.latency:
+            time.sleep(self.s3.latency)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        bucket, key, query = self._parse()
+        storage = self.s3.bucket(bucket)
+        if storage is None:
+            self._count('bucket')
+            return self._error(404, 'NoSuchBucket')
+        if not key:
+            if 'uploads' in query:
+                self._count('list_uploads')
+                return self._list_uploads(storage, query)
+            self._count('list')
+            return self._list(storage, query)
+        if 'uploadId' in query:
+            self._count('list_parts')
+            return self._list_parts(storage, query)
+        self._count('object')
+        info = storage.get(key)
+        if not info:
+            return self._error(404, 'NoSuchKey')
+        headers = {'ETag': info['etag'],
+                   'Last-Modified': formatdate(info['mtime'], usegmt=True),
+                   'Content-Type': 'application/octet-stream',
+                   'Accept-Ranges': 'bytes'}
+        for name, value in info['metadata'].iteritems():
+            headers[META_PREFIX + name] = value
+        start, end = 0, info['size'] - 1
+        code = 200
+        rng = self.headers.get('Range')
+        if rng and rng.startswith('bytes='):
+            first, _, last = rng[6:].partition('-')
+            start = int(first) if first else info['size'] - int(last)
+            end = min(int(last), end) if first and last else end
+            code = 206
+            headers['Content-Range'] = 'bytes %i-%i/%i' % (start, end,
+                                                           info['size'])
+        length = max(0, end - start + 1)
+        self.send_response(code)
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        with open(storage.path(key), 'rb') as f:
+            f.seek(start)
+            while length:
+                data = f.read(min(length, BLOCK_SIZE))
+                if not data:
+                    break
+                self.s3.transfer(len(data))
+                self.wfile.write(data)
+                length -= len(data)
+
+    def _list(self, storage, query):
+        keys, prefixes, truncated = storage.list(
+                                        prefix=query.get('prefix', ''),
+                                        delimiter=query.get('delimiter', ''),
+                                        marker=query.get('marker', ''),
+                                        limit=int(query.get('max-keys',
+                                                            LIST_LIMIT)))
+        content = ['<Name>%s</Name><Prefix>%s</Prefix><Marker>%s</Marker>'
+                   '<MaxKeys>%i</MaxKeys><IsTruncated>%s</IsTruncated>'
+                   % (self.s3.bucket_name, escape(query.get('prefix', '')),
+                      escape(query.get('marker', '')), LIST_LIMIT,
+                      'true' if truncated else 'false')]
+        for name, info in keys:
+            content.append('<Contents><Key>%s</Key>'
+                           '<LastModified>%s</LastModified>'
+                           '<ETag>%s</ETag><Size>%i</Size>'
+                           '<StorageClass>STANDARD</StorageClass></Contents>'
+                           % (escape(name),
+                              time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                                            time.gmtime(info['mtime'])),
+                              escape(info['etag']), info['size']))
+        for prefix in prefixes:
+            content.append('<CommonPrefixes><Prefix>%s</Prefix>'
+                           '</CommonPrefixes>' % escape(prefix))
+        self._xml('ListBucketResult', ''.join(content))
+
+    def _list_uploads(self, storage, query):
+        prefix = query.get('prefix', '')
+        with storage.lock:
+            uploads = sorted((u['key'], upload_id) for upload_id, u
+                             in storage.uploads.iteritems()
+                             if u['key'].startswith(prefix))
+        content = ['<Bucket>%s</Bucket><IsTruncated>false</IsTruncated>'
+                   % self.s3.bucket_name]
+        for key, upload_id in uploads:
+            content.append('<Upload><Key>%s</Key><UploadId>%s</UploadId>'
+                           '</Upload>' % (escape(key), upload_id))
+        self._xml('ListMultipartUploadsResult', ''.join(content))
+
+    def _list_parts(self, storage, query):
+        upload = storage.uploads.get(query['uploadId'])
+        if not upload:
+            return self._error(404, 'NoSuchUpload')
+        content = ['<Bucket>%s</Bucket><Key>%s</Key><UploadId>%s</UploadId>'
+                   '<IsTruncated>false</IsTruncated>'
+                   % (self.s3.bucket_name, escape(upload['key']),
+                      query['uploadId'])]
+        for number, (etag, size) in sorted(upload['parts'].items()):
+            content.append('<Part><PartNumber>%i</PartNumber>'
+                           '<ETag>%s</ETag><Size>%i</Size></Part>'
+                           % (number, etag, size))
+        self._xml('ListPartsResult', ''.join(content))
+
+    def do_PUT(self):
+        bucket, key, query = self._parse()
+        storage = self.s3.bucket(bucket)
+        if storage is None or not key:
+            self._count('bucket')
+            return self._error(404, 'NoSuchBucket')
+        if 'uploadId' in query:
+            self._count('part')
+            upload = storage.uploads.get(query['uploadId'])
+            if not upload:
+                return self._error(404, 'NoSuchUpload')
+            number = int(query['partNumber'])
+            path = storage.part_path(query['uploadId'], number)
+            etag = '"%s"' % self._receive(path)
+            upload['parts'][number] = (etag, os.path.getsize(path))
+            return self._respond(200, headers={'ETag': etag})
+        self._count('put')
+        tmp = storage.part_path('put%i' % threading.current_thread().ident, 0)
+        etag = '"%s"' % self._receive(tmp)
+        storage.put(key, tmp, etag, self._metadata())
+        self._respond(200, headers={'ETag': etag})
+
+    def do_POST(self):
+        bucket, key, query = self._parse()
+        storage = self.s3.bucket(bucket)
+        if storage is None or not key:
+            self._count('bucket')
+            return self._error(404, 'NoSuchBucket')
+        if 'uploads' in query:
+            self._count('initiate')
+            upload_id = storage.initiate(key, self._metadata())
+            return self._xml('InitiateMultipartUploadResult',
+                             '<Bucket>%s</Bucket><Key>%s</Key>'
+                             '<UploadId>%s</UploadId>'
+                             % (self.s3.bucket_name, escape(key), upload_id))
+        self._count('complete')
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with storage.lock:
+            upload = storage.uploads.pop(query.get('uploadId'), None)
+        if not upload:
+            return self._error(404, 'NoSuchUpload')
+        tmp = storage.part_path(query['uploadId'], 0)
+        digest = md5()
+        with open(tmp, 'wb') as out:
+            for number, (etag, size) in sorted(upload['parts'].items()):
+                digest.update(etag.strip('"').decode('hex'))
+                path = storage.part_path(query['uploadId'], number)
+                with open(path, 'rb') as f:
+                    shutil.copyfileobj(f, out, BLOCK_SIZE)
+                os.remove(path)
+        etag = '"%s-%i"' % (digest.hexdigest(), len(upload['parts']))
+        storage.put(key, tmp, etag, upload['metadata'])
+        self._xml('CompleteMultipartUploadResult',
+                  '<Location>http://%s/%s/%s</Location><Bucket>%s</Bucket>'
+                  '<Key>%s</Key><ETag>%s</ETag>'
+                  % (self.headers.get('Host'), self.s3.bucket_name,
+                     escape(key), self.s3.bucket_name, escape(key), etag))
+
+    def do_DELETE(self):
+        bucket, key, query = self._parse()
+        storage = self.s3.bucket(bucket)
+        if storage is None or not key:
+            self._count('bucket')
+            return self._error(404, 'NoSuchBucket')
+        if 'uploadId' in query:
+            self._count('abort')
+            with storage.lock:
+                upload = storage.uploads.pop(query['uploadId'], None)
+            for number in (upload or {}).get('parts', {}):
+                os.remove(storage.part_path(query['uploadId'], number))
+        else:
+            self._count('delete')
+            storage.delete(key)
+        self._respond(204)
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeS3(object):
+    """ Runs the server in a background thread.
+        latency is added to every request in seconds, bandwidth limits
+        bytes per second of request and response bodies (0 - no limit).
+    """
+    def __init__(self, root, bucket='bench', latency=0, bandwidth=0,
+                 host='127.0.0.1', port=0):
+        self.bucket_name = bucket
+        self.storage = Storage(root)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.requests = defaultdict(int)
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._allowed = time.time()
+        # kept alive connections, their threads wait for next requests
+        self._connections = set()
+        self._finished = threading.Condition(self._lock)
+        self.server = ThreadingServer((host, port), Handler)
+        self.server.s3 = self
+        self.host, self.port = self.server.server_address
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+
+    def bucket(self, name):
+        return self.storage if name == self.bucket_name else None
+
+    def count(self, method, kind):
+        with self._lock:
+            self.requests['%s %s' % (method, kind)] += 1
+
+    def transfer(self, size):
+        """ Accounts size bytes, sleeps to keep the bandwidth
+        """
+        with self._lock:
+            self.bytes += size
+            if not self.bandwidth:
+                return
+            now = time.time()
+            self._allowed = max(self._allowed, now) + size / float(self.bandwidth)
+            delay = self._allowed - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def access(self):
+        """ Returns amazon access settings for the client status
+        """
+        return {'key_id': 'bench', 'secret_key': 'bench',
+                'bucket': self.bucket_name, 'username': u'bench',
+                'host': self.host, 'port': self.port, 'is_secure': False}
+
+    def stats(self):
+        with self._lock:
+            return {'requests': dict(self.requests), 'bytes': self.bytes}
+
+    def reset(self):
+        with self._lock:
+            self.requests.clear()
+            self.bytes = 0
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def opened(self, connection):
+        with self._lock:
+            self._connections.add(connection)
+
+    def closed(self, connection):
+        with self._lock:
+            self._connections.discard(connection)
+            self._finished.notify_all()
+
+    def stop(self, timeout=5):
+        """ Stops the server and closes kept alive connections, so their
+            threads do not outlive the interpreter
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        deadline = time.time() + timeout
+        with self._lock:
+            for connection in self._connections:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+            while self._connections and time.time() < deadline:
+                self._finished.wait(deadline - time.time())
+
+
+if __name__ == '__main__':
+    import sys
+    import tempfile
+    s3 = FakeS3(tempfile.mkdtemp(), port=int(sys.argv[1]) if sys.argv[1:] else 0)
+    print json.dumps(s3.access())
+    s3.thread.setDaemon(False)
+    s3.start()
@@ -0,0 +1,215 @@
+#! /usr/bin/env python2.7
+""" Micro-benchmarks of the filesystem scan and the manifest.
+
+    Measures entries per second of levelwalk, iterfiles, modified (all
+    files unchanged, the incremental backup case) and BackupData add, get
+    and files on generated trees and manifests:
+
+        python2.7 benchmarks/micro.py --sizes 10k,100k --save
+        python2.7 benchmarks/micro.py --sizes 10k,100k
+
+    The first run saves the baseline, the next ones fail with exit code 1
+    if any rate is lower than the baseline by more than the threshold.
+    Generated trees and manifests are kept in --workdir and reused.
+"""
+import os
+import sys
+import json
+import time
+import pickle
+import random
+import argparse
+import tempfile
+from uuid import uuid4
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'micro_baseline.json')
+DIR_FILES = 1000
+SAMPLE = 1000
+ROWS_BATCH = 100000
+UNITS = {'k': 10**3, 'm': 10**6}
+
+
+def count_arg(value):
+    values = []
+    for v in value.lower().split(','):
+        unit = v[-1] if v[-1] in UNITS else ''
+        values.append(int(v[:len(v) - len(unit)]) * UNITS.get(unit, 1))
+    return values
+
+
+def setup_client(workdir):
+    """ Makes bitcalm importable without an installed client
+    """
+    data_dir = os.path.join(workdir, 'client')
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    conf = os.path.join(workdir, 'bitcalm.conf')
+    with open(conf, 'w') as f:
+        f.write('uuid = %s\nhost = localhost\n' % uuid4())
+    with open(os.path.join(data_dir, 'data'), 'w') as f:
+        pickle.dump({}, f)
+    os.environ.update(BITCALM_CONF=conf,
+                      BITCALM_DATA_DIR=data_dir,
+                      BITCALM_LOG=os.path.join(workdir, 'bitcalm.log'))
+    sys.path.insert(0, ROOT)
+
+
+def file_path(top, i):
+    d = i // DIR_FILES
+    return os.path.join(top, 'd%03i' % (d // 100), 'd%03i' % (d % 100),
+                        'f%07i' % i)
+
+
+def make_tree(workdir, count):
+    """ Creates count empty files in directories of DIR_FILES files
+    """
+    top = os.path.join(workdir, 'tree_%i' % count)
+    done = top + '.done'
+    if not os.path.exists(done):
+        for i in xrange(count):
+            path = file_path(top, i)
+            if not i % DIR_FILES:
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+        open(done, 'w').close()
+    return top
+
+
+def make_manifest(workdir, count, top):
+    """ Returns BackupData with rows of all files of the tree
+    """
+    from bitcalm.config.base import BackupData
+    path = os.path.join(workdir, 'manifest_%i.db' % count)
+    done = path + '.done'
+    if not os.path.exists(done):
+        if os.path.exists(path):
+            os.remove(path)
+        data = BackupData(path)
+        mtime = time.time() + 3600
+        for start in xrange(0, count, ROWS_BATCH):
+            data.add([(file_path(top, i), 1, mtime, 0, 0100644, 0, 0, 1, 1,
+                       None, None, None, None, None, None)
+                      for i in xrange(start, min(count, start + ROWS_BATCH))])
+        open(done, 'w').close()
+    return BackupData(path)
+
+
+def run(func, repeat):
+    """ Returns the best rate of func which returns number of entries
+    """
+    best = 0
+    for i in xrange(repeat):
+        started = time.time()
+        entries = func()
+        rate = entries / max(time.time() - started, 1e-6)
+        best = max(best, rate)
+    return best
+
+
+def cases(workdir, count):
+    from bitcalm.filesystem.utils import levelwalk, iterfiles, modified
+    top = make_tree(workdir, count)
+    data = make_manifest(workdir, count, top)
+    rnd = random.Random(count)
+
+    def walk():
+        return sum(1 + len(dirs) + len(files)
+                   for level, has_next, cursor in levelwalk(top=top)
+                   for path, dirs, files in level)
+
+    def listfiles():
+        return sum(1 for f in iterfiles(dirs=[top]))
+
+    def unchanged():
+        for f in modified(iterfiles(dirs=[top]), data):
+            raise AssertionError('%s is reported as modified' % f)
+        return count
+
+    def add():
+        # the same paths every time, so the manifest does not grow
+        for p in [file_path(top, count + i) for i in xrange(SAMPLE)]:
+            data.add(((p, 1, 0, 0, 0, 0, 0, 1, 2,
+                       None, None, None, None, None, None),))
+        return SAMPLE
+
+    def get():
+        for i in xrange(SAMPLE):
+            data.get_mtime(file_path(top, rnd.randrange(count)))
+        return SAMPLE
+
+    def files():
+        return sum(1 for row in data.files(backup_id=1, iterator=True))
+
+    return (('levelwalk', walk),
+            ('iterfiles', listfiles),
+            ('modified', unchanged),
+            ('backupdata.add', add),
+            ('backupdata.get', get),
+            ('backupdata.files', files))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Filesystem scan and '
+                                                 'manifest micro-benchmarks')
+    parser.add_argument('--sizes', type=count_arg, default=[10**4, 10**5],
+                        help='comma separated numbers of entries, '
+                             'k and m suffixes (default 10k,100k)')
+    parser.add_argument('--only', help='comma separated names of cases')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workdir', default=os.path.join(
+                                            tempfile.gettempdir(),
+                                            'bitcalm_micro'))
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save', action='store_true',
+                        help='save results as the baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed slowdown, share of baseline rate')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.workdir):
+        os.makedirs(args.workdir)
+    setup_client(args.workdir)
+    only = set(args.only.split(',')) if args.only else None
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    print '%-18s %10s %14s %14s %8s' % ('case', 'entries', 'rate/s',
+                                        'baseline/s', 'change')
+    for count in args.sizes:
+        for name, func in cases(args.workdir, count):
+            if only and name not in only:
+                continue
+            key = '%s/%i' % (name, count)
+            rate = run(func, args.repeat)
+            results[key] = rate
+            base = baseline.get(key)
+            change = ''
+            if base:
+                change = '%+.1f%%' % ((rate / base - 1) * 100)
+                if rate < base * (1 - args.threshold):
+                    regressions.append(key)
+                    change += ' !'
+            print '%-18s %10i %14.0f %14s %8s' % (name, count, rate,
+                                                  '%.0f' % base if base else
+                                                  '-', change)
+            sys.stdout.flush()
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print 'Baseline saved to %s' % args.baseline
+    if regressions:
+        print 'Regressions beyond %i%%: %s' % (args.threshold * 100,
+                                               ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
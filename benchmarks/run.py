@@ -0,0 +1,245 @@
+#! /usr/bin/env python2.7
+""" End-to-end benchmark of make_backup and backup.restore.
+
+    Runs offline against in-process S3 and control API stand-ins:
+
+        python2.7 benchmarks/run.py --tree small --files 10000
+        python2.7 benchmarks/run.py --tree huge --files 2 --size 512M \\
+                                    --latency 20 --bandwidth 50M
+
+    The client is pointed to a temporary directory by BITCALM_CONF,
+    BITCALM_DATA_DIR and BITCALM_LOG, so an installed client is not
+    touched. bitcalm.backupd refuses to run without root.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import pickle
+import random
+import argparse
+import resource
+import tempfile
+from uuid import uuid4
+
+from fakes3 import FakeS3
+from fakeapi import FakeApi
+from trees import TREES, KB, MB
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UNITS = {'': 1, 'K': KB, 'M': MB, 'G': 1024 * MB}
+
+
+def size_arg(value):
+    value = value.upper()
+    unit = value[-1] if value[-1] in UNITS else ''
+    return int(float(value[:len(value) - len(unit)]) * UNITS[unit])
+
+
+def peak_rss():
+    """ Returns peak resident set size in bytes
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * KB
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * KB
+
+
+def reset_peak_rss():
+    """ Linux resets VmHWM on writing 5 to clear_refs
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        pass
+
+
+def tree_stats(top):
+    files = size = 0
+    for path, dirs, names in os.walk(top):
+        for name in names:
+            files += 1
+            size += os.path.getsize(os.path.join(path, name))
+    return files, size
+
+
+def compare(top, orig):
+    """ Returns number of files which differ between trees
+    """
+    mismatched = 0
+    for path, dirs, names in os.walk(orig):
+        for name in names:
+            a = os.path.join(path, name)
+            b = os.path.join(top, os.path.relpath(a, orig))
+            if not os.path.isfile(b):
+                mismatched += 1
+                continue
+            with open(a, 'rb') as fa, open(b, 'rb') as fb:
+                while True:
+                    x, y = fa.read(MB), fb.read(MB)
+                    if x != y:
+                        mismatched += 1
+                        break
+                    if not x:
+                        break
+    return mismatched
+
+
+def touch(top, share, seed=0):
+    """ Appends to share of files, returns their number and size
+    """
+    rnd = random.Random(seed)
+    files = size = 0
+    for path, dirs, names in os.walk(top):
+        for name in names:
+            if rnd.random() < share:
+                p = os.path.join(path, name)
+                with open(p, 'ab') as f:
+                    f.write('changed\n')
+                files += 1
+                size += os.path.getsize(p)
+    return files, size
+
+
+def prepare(workdir, s3, api):
+    """ Writes config and status for the client, imports it
+    """
+    data_dir = os.path.join(workdir, 'data')
+    os.makedirs(data_dir)
+    conf = os.path.join(workdir, 'bitcalm.conf')
+    with open(conf, 'w') as f:
+        f.write('uuid = %s\nhost = %s\nport = %i\nhttps = 0\n'
+                % (uuid4(), api.host, api.port))
+    with open(os.path.join(data_dir, 'data'), 'w') as f:
+        pickle.dump({'is_registered': True,
+                     'key': 'bench',
+                     'amazon': s3.access()}, f)
+    os.environ.update(BITCALM_CONF=conf,
+                      BITCALM_DATA_DIR=data_dir,
+                      BITCALM_LOG=os.path.join(workdir, 'bitcalm.log'))
+    sys.path.insert(0, ROOT)
+    from bitcalm import backupd, backup
+    return backupd, backup
+
+
+def measure(name, func, files, size, s3, api):
+    from bitcalm import metrics
+    s3.reset()
+    api.reset()
+    reset_peak_rss()
+    before = metrics.registry.snapshot()
+    started = time.time()
+    result = func()
+    elapsed = max(time.time() - started, 1e-6)
+    return {'name': name,
+            'result': result,
+            'seconds': round(elapsed, 3),
+            'files': files,
+            'bytes': size,
+            'files_per_s': round(files / elapsed, 1),
+            'mb_per_s': round(size / float(MB) / elapsed, 2),
+            'peak_rss': peak_rss(),
+            's3': s3.stats(),
+            'api': api.stats(),
+            'metrics': metrics.registry.summary(since=before)}
+
+
+def report(results):
+    print '%-12s %9s %9s %11s %9s %10s %8s %8s' % ('stage', 'files',
+        'seconds', 'files/s', 'MB/s', 'peak RSS', 'S3 req', 'API req')
+    for r in results:
+        print '%-12s %9i %9.2f %11.1f %9.2f %9.1fM %8i %8i' % (
+                r['name'], r['files'], r['seconds'], r['files_per_s'],
+                r['mb_per_s'], r['peak_rss'] / float(MB),
+                sum(r['s3']['requests'].values()),
+                sum(r['api']['requests'].values()))
+    for r in results:
+        print '\n%s S3 requests:' % r['name']
+        for kind, count in sorted(r['s3']['requests'].items()):
+            print '    %-20s %i' % (kind, count)
+        print '%s client metrics:' % r['name']
+        for metric, value in sorted(r['metrics'].items()):
+            if isinstance(value, dict):
+                value = '%(count)i, %(sum).3f s' % value
+            print '    %-50s %s' % (metric, value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backup and restore '
+                                                 'benchmark')
+    parser.add_argument('--tree', choices=sorted(TREES), default='small')
+    parser.add_argument('--files', type=int, help='number of files')
+    parser.add_argument('--size', type=size_arg,
+                        help='(average) file size, K, M, G suffixes')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='S3 latency per request, ms')
+    parser.add_argument('--bandwidth', type=size_arg, default=0,
+                        help='S3 bandwidth, bytes per second')
+    parser.add_argument('--incremental', type=float, default=0.1,
+                        help='share of files changed before the second '
+                             'backup, 0 to skip it')
+    parser.add_argument('--no-restore', action='store_true')
+    parser.add_argument('--workdir', help='directory for the tree, '
+                                          'S3 objects and client data')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the working directory')
+    parser.add_argument('--json', help='save results to the file')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bitcalm_bench_', dir=args.workdir)
+    s3 = FakeS3(os.path.join(workdir, 's3'), latency=args.latency / 1000.0,
+                bandwidth=args.bandwidth).start()
+    api = FakeApi().start()
+    try:
+        backupd, backup = prepare(workdir, s3, api)
+        from bitcalm.config import status
+        from bitcalm.schedule import DailySchedule
+
+        top = os.path.join(workdir, 'tree')
+        kwargs = dict((k, v) for k, v in (('count', args.files),
+                                          ('size', args.size)) if v)
+        started = time.time()
+        TREES[args.tree](top, **kwargs)
+        files, size = tree_stats(top)
+        print 'Generated %i files, %.1f MB in %.1f s' % (
+                files, size / float(MB), time.time() - started)
+
+        status.schedules = [DailySchedule(id=1, time=(0, 0), files=[top],
+                                          db={}, day=1)]
+        results = [measure('full backup', backupd.make_backup,
+                           files, size, s3, api)]
+        if args.incremental:
+            changed, changed_size = touch(top, args.incremental)
+            results.append(measure('incremental', backupd.make_backup,
+                                   changed, changed_size, s3, api))
+        if not args.no_restore:
+            orig = top + '.orig'
+            os.rename(top, orig)
+            backup_id = api.completed[-1]
+            results.append(measure('restore',
+                                   lambda: backup.restore(backup_id),
+                                   files, size, s3, api))
+            results[-1]['mismatched'] = compare(top, orig)
+        report(results)
+        if not args.no_restore:
+            print '\nRestored files differing from the original: %i' \
+                    % results[-1]['mismatched']
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2)
+    finally:
+        s3.stop()
+        api.stop()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+""" Synthetic file trees for benchmarks.
+
+    Every generator takes the top directory and a random seed and returns
+    (number of files, total size). Text files compress well, files with
+    compressed extensions are random and are uploaded as is.
+"""
+import os
+import random
+
+
+KB = 1024
+MB = 1024 * KB
+DIR_FILES = 100
+WORDS = ('backup', 'restore', 'server', 'files', 'database', 'bucket',
+         'schedule', 'status', 'level', 'manifest', 'upload', 'part')
+_pool = []
+
+
+def text(rnd, size):
+    """ slices of a megabyte of random words """
+    if not _pool:
+        words = random.Random(0)
+        _pool.append(' '.join(words.choice(WORDS)
+                              for i in xrange(MB // 6))[:MB])
+    pool = _pool[0]
+    data = []
+    while size:
+        start = rnd.randrange(len(pool))
+        n = min(size, len(pool) - start)
+        data.append(pool[start:start + n])
+        size -= n
+    return ''.join(data)
+
+
+def noise(rnd, size):
+    return os.urandom(size) if size else ''
+
+
+def write(path, data):
+    d = os.path.dirname(path)
+    if not os.path.isdir(d):
+        os.makedirs(d)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def write_large(path, size, chunk, rnd, make):
+    """ writes size bytes by chunks of generated data
+    """
+    d = os.path.dirname(path)
+    if not os.path.isdir(d):
+        os.makedirs(d)
+    with open(path, 'wb') as f:
+        left = size
+        while left:
+            n = min(left, chunk)
+            f.write(make(rnd, n))
+            left -= n
+
+
+def file_path(top, i, ext):
+    return os.path.join(top, 'd%04i' % (i // DIR_FILES), 'f%06i.%s' % (i, ext))
+
+
+def small_files(top, count=10000, size=4 * KB, seed=0):
+    """ many small text files """
+    rnd = random.Random(seed)
+    total = 0
+    for i in xrange(count):
+        n = rnd.randint(0, 2 * size)
+        write(file_path(top, i, 'txt'), text(rnd, n))
+        total += n
+    return count, total
+
+
+def huge_files(top, count=4, size=256 * MB, seed=0):
+    """ few huge files, half of them text and half random """
+    rnd = random.Random(seed)
+    for i in xrange(count):
+        if i % 2:
+            write_large(file_path(top, i, 'gz'), size, MB, rnd, noise)
+        else:
+            write_large(file_path(top, i, 'log'), size, MB, rnd, text)
+    return count, count * size
+
+
+def mixed(top, count=2000, size=64 * KB, seed=0):
+    """ files of sizes from empty to 100 times size, a third of them
+        incompressible
+    """
+    rnd = random.Random(seed)
+    total = 0
+    for i in xrange(count):
+        n = int(rnd.expovariate(1.0 / size))
+        n = min(n, 100 * size)
+        if i % 3:
+            write(file_path(top, i, 'txt'), text(rnd, n))
+        else:
+            write_large(file_path(top, i, 'zip'), n, MB, rnd, noise)
+        total += n
+    return count, total
+
+
+TREES = {'small': small_files,
+         'huge': huge_files,
+         'mixed': mixed}
@@ -1,11 +1,29 @@
 import os
-import subprocess
 from datetime import datetime
 
 VERSION = (0, 1, 0, 'dev', 32)
 
 
-def get_version(version=VERSION):
+def git_timestamp():
+    """ Returns time of the last commit, None outside of a git checkout
+    """
+    import subprocess
+    git_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        git = subprocess.Popen('git log --pretty=format:%ct --quiet -1 HEAD',
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               cwd=git_path, shell=True)
+    except OSError:
+        return None
+    ts = git.communicate()[0]
+    try:
+        return int(ts)
+    except ValueError:
+        return None
+
+
+def get_version(version=VERSION, timestamp=None):
     parts = 3 if version[2] else 2
     main = '.'.join(str(x) for x in version[:parts])
     
@@ -16,21 +34,16 @@ def get_version(version=VERSION):
 
     if version[3] == 'dev':
         sub = '.dev'
-        git_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        git = subprocess.Popen('git log --pretty=format:%ct --quiet -1 HEAD',
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE,
-                                   cwd=git_path, shell=True)
-        ts = git.communicate()[0]
-        try:
-            ts = int(ts)
-        except ValueError:
-            pass
-        else:
-            sub += datetime.utcfromtimestamp(ts).strftime('%Y%m%d%H%M%S')
+        if timestamp:
+            sub += datetime.utcfromtimestamp(timestamp).strftime('%Y%m%d%H%M%S')
     else:
         mapping = {'alpha': 'a', 'beta': 'b', 'rc': 'c'}
         sub = '%s%i' % (mapping.get(version[3]), version[4])
     return main + sub
 
-__version__ = get_version()
+# setup.py saves the version with the commit time to _build.py,
+# a source checkout has the dev version without it
+try:
+    from bitcalm._build import __version__
+except ImportError:
+    __version__ = get_version()
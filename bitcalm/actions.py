@@ -1,65 +1,217 @@
+import os
+import fcntl
+import errno
+import heapq
+import select
+import itertools
+import traceback
 from datetime import datetime, timedelta
+from threading import RLock, Thread
 
 from bitcalm import log
+from bitcalm.profiler import profiler
 from bitcalm.utils import total_seconds
 
 
+class CONCURRENCY:
+    CONTROL = None
+    BACKUP = 'backup'
+    RESTORE = 'restore'
+    FS = 'fs'
+    UPDATE = 'update'
+
+
 class ActionPool(object):
+    """ Keeps actions in a heap ordered by time.
+        Rescheduling pushes a new heap entry; outdated entries are skipped
+        when they reach the top. wait() sleeps in select() on a pipe
+        which every change writes to, so it is woken up by changes and
+        interrupted by signals without polling.
+        Control actions run in the caller's thread, other concurrency
+        classes run in worker threads, one action per class at a time.
+    """
+    CONFLICTS = {CONCURRENCY.BACKUP: (CONCURRENCY.UPDATE,),
+                 CONCURRENCY.RESTORE: (CONCURRENCY.UPDATE,),
+                 CONCURRENCY.FS: (CONCURRENCY.UPDATE,),
+                 CONCURRENCY.UPDATE: (CONCURRENCY.BACKUP,
+                                      CONCURRENCY.RESTORE,
+                                      CONCURRENCY.FS)}
+
     def __init__(self):
-        self._actions = []
+        self._actions = {}
+        self._tags = {}
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = RLock()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._running = []
+        self._blocked = []
 
     def _funcs(self):
-        return [a._func for a in self._actions]
+        return self._actions.keys()
 
     def __iter__(self):
-        return iter(sorted(self._actions))
+        return iter(sorted(self._actions.values()))
+
+    def _push(self, action):
+        if action.time is None:
+            action._entry = None
+            return
+        action._entry = (action.time, next(self._counter), action)
+        heapq.heappush(self._heap, action._entry)
+
+    def _wake(self):
+        try:
+            os.write(self._wakeup_w, '.')
+        except OSError, e:
+            # the pipe is full, wait() is woken up anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _drain(self):
+        try:
+            while os.read(self._wakeup_r, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _is_actual(self, entry):
+        action = entry[2]
+        return action.pool is self and action._entry is entry
 
     def add(self, action):
-        if action._func in self._funcs():
-            return False
-        self._actions.append(action)
-        action.pool = self
+        with self._lock:
+            if action._func in self._actions:
+                return False
+            self._actions[action._func] = action
+            if action.tag is not None:
+                self._tags[action.tag] = action
+            action.pool = self
+            self._push(action)
+            self._wake()
         return True
 
     def extend(self, actions):
-        actions = [a for a in actions if a._func not in self._funcs()]
-        self._actions.extend(actions)
-        for action in actions:
-            action.pool = self
-        return len(actions)
+        return len(filter(self.add, actions))
+
+    def reschedule(self, action):
+        with self._lock:
+            if self._actions.get(action._func) is action:
+                self._push(action)
+                self._wake()
 
     def remove(self, action):
-        self._actions.remove(action)
-        action.pool = None
+        with self._lock:
+            del self._actions[action._func]
+            if action.tag is not None:
+                self._tags.pop(action.tag, None)
+            action.pool = None
+            action._entry = None
+            self._wake()
 
     def clear(self):
-        if self._actions:
-            for a in self._actions:
+        with self._lock:
+            for a in self._actions.values():
                 a.pool = None
-            self._actions = []
+                a._entry = None
+            self._actions = {}
+            self._tags = {}
+            self._heap = []
+            self._blocked = []
+            self._wake()
 
     def get(self, func_or_tag):
         """ Returns action identified by it's function or tag
         """
-        attr = '_func' if callable(func_or_tag) else 'tag'
-        for action in self._actions:
-            if getattr(action, attr) == func_or_tag:
-                return action
-        return None
+        if callable(func_or_tag):
+            return self._actions.get(func_or_tag)
+        return self._tags.get(func_or_tag)
 
     def has(self, func_or_tag):
         return bool(self.get(func_or_tag))
 
     def next(self):
-        if self._actions:
-            return min(filter(lambda a: a.time is not None, self._actions))
-        return None
+        with self._lock:
+            while self._heap and not self._is_actual(self._heap[0]):
+                heapq.heappop(self._heap)
+            return self._heap[0][2] if self._heap else None
+
+    def is_running(self, func_or_tag):
+        action = self.get(func_or_tag)
+        return any(a is action for a in self._running)
+
+    def _can_run(self, action):
+        if action.concurrency is CONCURRENCY.CONTROL:
+            return True
+        running = [a.concurrency for a in self._running]
+        if action.concurrency in running:
+            return False
+        conflicts = self.CONFLICTS.get(action.concurrency, ())
+        return not any(c in conflicts for c in running)
+
+    def wait(self):
+        """ Blocks until the earliest action is due and can be run
+        """
+        while True:
+            with self._lock:
+                # changes made after this are written to the pipe again
+                self._drain()
+                action = self.next()
+                timeout = action.time_left() if action else None
+                if action and not timeout:
+                    if self._can_run(action):
+                        return action
+                    heapq.heappop(self._heap)
+                    self._blocked.append(action)
+                    continue
+            try:
+                select.select([self._wakeup_r], [], [], timeout)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+    def run(self, action):
+        """ Performs action in the current thread if it is a control one
+            or starts a worker thread for it.
+        """
+        if action.concurrency is CONCURRENCY.CONTROL:
+            return action()
+        with self._lock:
+            self._running.append(action)
+        t = Thread(target=self._work, args=(action,),
+                   name='action-%s' % getattr(action._func, '__name__',
+                                               action._func))
+        t.setDaemon(True)
+        t.start()
+
+    def _work(self, action):
+        try:
+            action()
+        except Exception, e:
+            traceback.print_exc()
+            log.error('Action %s crashed: %s' % (action._func, e))
+            action.delay()
+        finally:
+            with self._lock:
+                self._running = [a for a in self._running if a is not action]
+                blocked, self._blocked = self._blocked, []
+                for a in blocked:
+                    if a.pool is self:
+                        self._push(a)
+                self._wake()
 
 
 class Action(object):
     def __init__(self, nexttime, func, *args, **kwargs):
         self.tag = kwargs.pop('tag', None)
+        self.concurrency = kwargs.pop('concurrency', CONCURRENCY.CONTROL)
         self.pool = None
+        self._entry = None
+        self._time = None
         self.lastexectime = None
         self._func = func
         if callable(nexttime):
@@ -82,7 +234,7 @@ class Action(object):
     def __call__(self):
         log.info('Perform action: %s' % self._func)
         self.lastexectime = datetime.utcnow()
-        if self._func(*self._args, **self._kwargs):
+        if self._call():
             self.next()
             log.info('Action %s is complete' % self._func)
         else:
@@ -91,6 +243,20 @@ class Action(object):
     
     def __cmp__(self, other):
         return cmp(self.time, other.time)
+
+    def _call(self):
+        name = getattr(self._func, '__name__', str(self._func))
+        return profiler.call(name, self._func, *self._args, **self._kwargs)
+
+    @property
+    def time(self):
+        return self._time
+
+    @time.setter
+    def time(self, value):
+        self._time = value
+        if self.pool:
+            self.pool.reschedule(self)
     
     def _default_next(self):
         return (self.lastexectime or datetime.utcnow()) \
@@ -119,7 +285,7 @@ class OneTimeAction(Action):
     def __call__(self):
         log.info('Perform action: %s' % self._func)
         self.lastexectime = datetime.utcnow()
-        if self._func(*self._args, **self._kwargs):
+        if self._call():
             if self.pool:
                 pool = self.pool
                 self.pool.remove(self)
@@ -152,7 +318,7 @@ class StepAction(Action):
 
     def __call__(self):
         log.info('Perform action: %s' % self._func)
-        result = self._func(*self._args, **self._kwargs)
+        result = self._call()
         self.lastexectime = datetime.utcnow()
         if result == -1:
             self.time = datetime.utcnow() + timedelta(seconds=self.step)
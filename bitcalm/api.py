@@ -1,4 +1,6 @@
+import re
 import json
+import time
 import zlib
 import pickle
 import platform
@@ -8,10 +10,13 @@ from hashlib import sha512 as sha
 from urllib import urlencode
 
 from config import config, status as client_status
-from bitcalm import __version__
+from bitcalm import __version__, metrics
 from bitcalm.const import MIN
 
 
+ID_RE = re.compile(r'/\d+(?=/|$)')
+
+
 def returns_json(func):
     def inner(self, *args, **kwargs):
         status, content = func(self, *args, **kwargs)
@@ -25,12 +30,17 @@ class Api(object):
     BOUNDARY = '-' * 20 + sha(str(random())).hexdigest()[:20]
 
     def __init__(self, host, port, uuid, key):
-        conn_cls = HTTPSConnection if config.https else HTTPConnection
-        self.conn = conn_cls(host, port, timeout=5*MIN)
+        self.conn_cls = HTTPSConnection if config.https else HTTPConnection
+        self.host = host
+        self.port = port
         self.base_params = {'uuid': uuid, 'key': key}
     
     def _send(self, path, data={}, files={}, method='POST'):
-        data.update(self.base_params)
+        """ Every request uses its own connection so that actions
+            running in different threads can use the api simultaneously.
+        """
+        conn = self.conn_cls(self.host, self.port, timeout=5*MIN)
+        data = dict(data, **self.base_params)
         headers = {'Accept': 'text/plain'}
         url = '/api/%s/' % path
         if files:
@@ -43,15 +53,24 @@ class Api(object):
         if method == 'GET':
             url = '%s?%s' % (url, body)
             body = None
+        endpoint = ID_RE.sub('/<id>', path)
+        started = time.time()
         try:
-            self.conn.request(method, url, body, headers)
-        except Exception, e:
-            raise e
-        else:
-            response = self.conn.getresponse()
-            return (response.status, response.read())
+            conn.request(method, url, body, headers)
+            response = conn.getresponse()
+            result = (response.status, response.read())
+        except Exception:
+            metrics.counter('api_errors_total', 'Failed API requests',
+                            endpoint=endpoint).inc()
+            raise
         finally:
-            self.conn.close()
+            conn.close()
+            metrics.histogram('api_request_seconds', 'API request',
+                              endpoint=endpoint).observe(time.time() - started)
+        if result[0] >= 400:
+            metrics.counter('api_errors_total', 'Failed API requests',
+                            endpoint=endpoint).inc()
+        return result
     
     def encode_multipart_data(self, data={}, files={}):
         """ Returns multipart/form-data encoded data
@@ -139,14 +158,18 @@ class Api(object):
     def get_files_info(self, backup_id):
         return self._send('backup/%i/files' % backup_id, method='GET')
 
-    def update_backup_stats(self, backup_id, size=0, files=0, db_names=[]):
-        """ increases backup statistics
+    def update_backup_stats(self, backup_id, size=0, files=0, db_names=[],
+                            metrics=None):
+        """ increases backup statistics, metrics is summary of
+            performance metrics of the backup
         """
         data = {'id': backup_id,
                 'size': size,
                 'files': files}
         if db_names:
             data['db_names'] = json.dumps(db_names)
+        if metrics:
+            data['metrics'] = json.dumps(metrics)
         return self._send('backup/stat', data=data)[0]
 
     def update_system_info(self, info):
@@ -195,6 +218,11 @@ class Api(object):
         return self._send('exception',
                           files={'exception': pickle.dumps(exception)})[0]
 
+    def report_profile(self, name, summary):
+        return self._send('profile',
+                          data={'name': name},
+                          files={'summary': zlib.compress(summary, 9)})[0]
+
     @returns_json
     def get_version(self):
         return self._send('version/current', method='GET')
@@ -207,4 +235,17 @@ class Api(object):
         return self._send('emergency', data=data)
 
 
-api = Api(config.host, config.port, config.uuid, client_status.key)
+class LazyApi(object):
+    """ Creates Api on the first use of the module level api
+    """
+    def __init__(self):
+        self._api = None
+
+    def __getattr__(self, name):
+        if self._api is None:
+            self._api = Api(config.host, config.port, config.uuid,
+                            client_status.key)
+        return getattr(self._api, name)
+
+
+api = LazyApi()
@@ -1,25 +1,59 @@
 import os
 import math
+import shutil
 import gzip
+import json
+import zlib
+import tempfile
+import threading
+from uuid import uuid4
 from hashlib import sha384 as sha
 from cStringIO import StringIO
 
-from boto.s3.connection import S3Connection
+from boto.s3.connection import S3Connection, OrdinaryCallingFormat
 from boto.exception import S3ResponseError
 from boto.s3.key import Key
+from boto.s3.multipart import MultiPartUpload
+from boto.utils import compute_md5
 from filechunkio import FileChunkIO
 
-from bitcalm import log
+from bitcalm import log, metrics
 from bitcalm.api import api
 from bitcalm.config import status
 from bitcalm.config.base import BackupData
-from bitcalm.utils import is_file_compressed, try_exec
-from bitcalm.database import get_credentials, import_db
+from bitcalm.throttle import bandwidth
+from bitcalm.utils import is_file_compressed, try_exec, run_parallel
+from bitcalm.database import (get_credentials, import_stream,
+                              parse_dump_name, BINLOG_EXT)
+from bitcalm.tabledump import blocks
+from bitcalm.filesystem.utils import is_sparse, extents as get_extents
 
 
 CHUNK_SIZE = 32 * 1024 * 1024
 MB = 1024 * 1024
 RESTORE_DB_PATH = '/tmp/bitcalm_restore.db'
+MANIFEST_EXT = '.manifest'
+DELTA_EXT = '.delta'
+# deltas of the files manifest between its uploads as a whole
+MANIFEST_DELTAS = 10
+DELTA_ENCODING = 'latin-1'
+TABLES_RESTORE_WORKERS = 4
+COMPRESS = metrics.histogram('compress_seconds', 'Compression of a block')
+UPLOAD_PART = metrics.histogram('upload_part_seconds',
+                                'Upload of a part of multipart upload')
+UPLOAD_OBJECT = metrics.histogram('upload_object_seconds',
+                                  'Upload of a single object')
+UPLOADED = metrics.counter('uploaded_bytes_total', 'Bytes uploaded to S3')
+DEDUPLICATED = metrics.counter('deduplicated_bytes_total',
+                               'Bytes of files not uploaded as duplicates')
+SPARSE = metrics.counter('sparse_bytes_total',
+                         'Bytes of holes of sparse files not read')
+DB_RESTORE_WORKERS = 4
+DB_HOST_RESTORE_WORKERS = 2
+UPLOAD_ATTEMPTS = 3
+PACK_FILE_SIZE = 256 * 1024
+PACK_SIZE = 16 * MB
+PACK_GAP = 256 * 1024
 
 
 class PREFIX_TYPE:
@@ -33,17 +67,48 @@ def next_date():
 
 
 def next_schedule():
-    if status.schedules:
-        return min([s for s in status.schedules if not s.exclude])
+    with status.lock:
+        if status.schedules:
+            return min([s for s in status.schedules if not s.exclude])
     return None
 
 
 def get_bucket():
+    kwargs = {}
+    if status.amazon.get('host'):
+        # S3 compatible endpoint, buckets are addressed by path
+        kwargs = {'host': status.amazon['host'],
+                  'port': status.amazon.get('port'),
+                  'is_secure': status.amazon.get('is_secure', True),
+                  'calling_format': OrdinaryCallingFormat()}
     conn = S3Connection(status.amazon['key_id'],
-                        status.amazon['secret_key'])
+                        status.amazon['secret_key'],
+                        **kwargs)
     return conn.get_bucket(status.amazon['bucket'])
 
 
+def file_row(filename, info, compressed, backup_id,
+             pack=None, offset=None, length=None, ref=None, link=None,
+             extents=None):
+    """ Returns manifest row of the uploaded file
+    """
+    return (filename,
+            1,
+            info.st_mtime,
+            info.st_size,
+            info.st_mode,
+            info.st_uid,
+            info.st_gid,
+            int(compressed),
+            backup_id,
+            pack,
+            offset,
+            length,
+            ref,
+            link,
+            json.dumps(extents) if extents is not None else None)
+
+
 def get_prefix(backup_id, ptype=''):
     return '/'.join((status.amazon['username'].encode('ascii'),
                      'backup_%i' % backup_id,
@@ -80,12 +145,66 @@ def chunks(path, chunk_size=CHUNK_SIZE):
         chunk.close()
 
 
+def sparse_chunks(path, extents, chunk_size=CHUNK_SIZE):
+    """ Yields data of extents of the file in chunks of chunk_size
+    """
+    chunk = StringIO()
+    with open(path, 'rb') as f:
+        for offset, length in extents:
+            f.seek(offset)
+            while length:
+                data = f.read(min(length, chunk_size - chunk.tell(), MB))
+                if not data:
+                    break
+                chunk.write(data)
+                length -= len(data)
+                if chunk.tell() >= chunk_size:
+                    chunk.seek(0)
+                    yield chunk
+                    chunk = StringIO()
+    if chunk.tell():
+        chunk.seek(0)
+        yield chunk
+
+
+def hashed_chunks(chunks, digest):
+    """ Updates digest with data of chunks as they are read
+    """
+    for chunk in chunks:
+        data = chunk.read()
+        digest.update(data)
+        yield StringIO(data)
+
+
+def file_digest(path, extents=None, block_size=MB):
+    digest = sha()
+    if extents is not None:
+        for chunk in sparse_chunks(path, extents, chunk_size=block_size):
+            digest.update(chunk.read())
+        return digest
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), ''):
+            digest.update(block)
+    return digest
+
+
+def stream_chunks(fileobj, block_size=MB):
+    while True:
+        block = fileobj.read(block_size)
+        if not block:
+            break
+        yield StringIO(block)
+
+
 def compress_chunks(chunks, chunk_size=CHUNK_SIZE):
     chunk = StringIO()
-    gz = gzip.GzipFile(fileobj=chunk, mode='wb')
+    # zero mtime makes the output and so parts of resumed uploads the same
+    gz = gzip.GzipFile(fileobj=chunk, mode='wb', mtime=0)
     for c in chunks:
-        gz.write(c.read())
-        gz.flush()
+        data = c.read()
+        with COMPRESS.time():
+            gz.write(data)
+            gz.flush()
         if chunk.tell() > chunk_size:
             chunk.seek(0)
             yield chunk
@@ -96,16 +215,84 @@ def compress_chunks(chunks, chunk_size=CHUNK_SIZE):
     yield chunk
 
 
+def decompress_key(key, chunk_size=MB):
+    """ Yields decompressed data of gzipped key as it is downloaded
+    """
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        while True:
+            data = key.read(chunk_size)
+            if not data:
+                break
+            if bandwidth.profiles:
+                bandwidth.consume(len(data))
+            while data:
+                chunk = d.decompress(data)
+                if chunk:
+                    yield chunk
+                data = d.unused_data
+                if data:
+                    # next gzip member
+                    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunk = d.flush()
+        if chunk:
+            yield chunk
+    finally:
+        key.close()
+
+
 def compress(fileobj):
     c = StringIO()
-    gz = gzip.GzipFile(fileobj=c, mode='wb')
+    gz = gzip.GzipFile(fileobj=c, mode='wb', mtime=0)
     fileobj.seek(0)
-    gz.write(fileobj.read())
-    gz.close()
+    data = fileobj.read()
+    with COMPRESS.time():
+        gz.write(data)
+        gz.close()
     c.seek(0)
     return c
 
 
+def write_gzipped(fileobj, source):
+    """ Compresses source to fileobj by blocks and rewinds fileobj
+    """
+    gz = gzip.GzipFile(fileobj=fileobj, mode='wb', mtime=0)
+    while True:
+        data = source.read(MB)
+        if not data:
+            break
+        with COMPRESS.time():
+            gz.write(data)
+    gz.close()
+    fileobj.seek(0)
+
+
+def write_delta(fileobj, changes):
+    """ Writes batches of BackupData.changes to fileobj as gzipped JSON
+        lines and rewinds it. Strings of the manifest are bytes, they are
+        written as DELTA_ENCODING which has a character for every byte.
+    """
+    gz = gzip.GzipFile(fileobj=fileobj, mode='wb', mtime=0)
+    for batch in changes:
+        gz.write(json.dumps(batch, encoding=DELTA_ENCODING) + '\n')
+    gz.close()
+    fileobj.seek(0)
+
+
+def read_delta(fileobj):
+    """ Yields batches written by write_delta
+    """
+    def value(v):
+        return v.encode(DELTA_ENCODING) if isinstance(v, unicode) else v
+
+    gz = gzip.GzipFile(fileobj=fileobj, mode='rb')
+    for line in gz:
+        table, rows = json.loads(line)
+        if table not in ('file', 'content'):
+            raise ValueError('Unknown table of manifest delta: %s' % table)
+        yield str(table), [tuple(value(v) for v in row) for row in rows]
+
+
 def decompress(zipped, unzipped=None, delete=True):
     if not unzipped:
         unzipped = zipped[:-3]
@@ -114,22 +301,35 @@ def decompress(zipped, unzipped=None, delete=True):
         os.makedirs(dirname)
     gz = gzip.open(zipped, 'rb')
     with open(unzipped, 'wb') as f:
-        for chunk in chunks(gz):
-            f.write(chunk)
+        shutil.copyfileobj(gz, f, MB)
     gz.close()
     if delete:
         os.remove(zipped)
     return unzipped
 
 
-def upload_multipart(key_name, parts, bucket=None):
-    mp = bucket.initiate_multipart_upload(key_name, encrypt_key=True)
+def limited(**kwargs):
+    """ Adds bandwidth limiting callback to boto transfer arguments
+    """
+    cb = bandwidth.callback()
+    if cb:
+        kwargs.update(cb=cb, num_cb=-1)
+    return kwargs
+
+
+def upload_multipart(key_name, parts, bucket=None, metadata=None):
+    mp = bucket.initiate_multipart_upload(key_name, encrypt_key=True,
+                                          metadata=metadata or {})
     size = 0
     for i, part in enumerate(parts):
         try:
-            size += try_exec(mp.upload_part_from_file,
-                             args=(part,), kwargs={'part_num': i+1},
-                             exc=S3ResponseError).size
+            with UPLOAD_PART.time():
+                part_size = try_exec(mp.upload_part_from_file,
+                                     args=(part,),
+                                     kwargs=limited(part_num=i+1),
+                                     exc=S3ResponseError).size
+            size += part_size
+            UPLOADED.inc(part_size)
         except Exception, e:
             mp.cancel_upload()
             log.error('Upload of part %i failed: %s' % (i, str(e)))
@@ -138,14 +338,120 @@ def upload_multipart(key_name, parts, bucket=None):
     return size
 
 
-def upload(key_name, fileobj, bucket=None):
+def upload_resumable(key_name, path, compressed=False, bucket=None,
+                     digest=None, extents=None):
+    """ Multipart upload of a file which is kept on failure.
+        The upload id, part size and ETags of uploaded parts are saved
+        in status.uploads; the next call for the same key and unchanged
+        file lists parts of the upload and sends only those which are
+        missing or differ by md5. digest is updated with data of the
+        file. Only extents of a sparse file are uploaded if they are
+        given. Returns size or None on failure.
+    """
+    info = os.stat(path)
+    source = [info.st_size, info.st_mtime]
+    state = status.uploads.get(key_name)
+    uploaded = {}
+    mp = None
+    if state:
+        mp = MultiPartUpload(bucket)
+        mp.key_name, mp.id = key_name, state['id']
+        try:
+            if state['source'] == source:
+                uploaded = dict((p.part_number, p.etag) for p in mp)
+            else:
+                mp.cancel_upload()
+                mp = None
+        except S3ResponseError, e:
+            if e.status != 404:
+                log.error('Failed to resume upload of %s: %s' % (path, e))
+                return None
+            mp = None
+    if not mp:
+        mp = bucket.initiate_multipart_upload(key_name, encrypt_key=True)
+        state = {'id': mp.id,
+                 'part_size': CHUNK_SIZE,
+                 'source': source,
+                 'parts': {}}
+        with status.lock:
+            status.uploads[key_name] = state
+        status.save(force=True)
+    if extents is None:
+        parts = chunks(path, chunk_size=state['part_size'])
+    else:
+        parts = sparse_chunks(path, extents, chunk_size=state['part_size'])
+    if digest:
+        parts = hashed_chunks(parts, digest)
+    if compressed:
+        parts = compress_chunks(parts, chunk_size=state['part_size'])
+    size = 0
+    part_num = 0
+    for part_num, part in enumerate(parts, 1):
+        md5 = compute_md5(part)
+        etag = '"%s"' % md5[0]
+        if uploaded.get(part_num) != etag:
+            try:
+                with UPLOAD_PART.time():
+                    try_exec(mp.upload_part_from_file,
+                             args=(part,),
+                             kwargs=limited(part_num=part_num, md5=md5[:2]),
+                             exc=S3ResponseError)
+            except Exception, e:
+                log.error('Upload of part %i of %s failed: %s'
+                          % (part_num, path, e))
+                return None
+            UPLOADED.inc(md5[2])
+            with status.lock:
+                state['parts'][part_num] = etag
+            status.save(force=True)
+        size += md5[2]
+    if any(n > part_num for n in uploaded):
+        # parts of a longer stream, e.g. compressed by another zlib
+        mp.cancel_upload()
+        with status.lock:
+            del status.uploads[key_name]
+        status.save(force=True)
+        return None
+    mp.complete_upload()
+    with status.lock:
+        del status.uploads[key_name]
+    status.save(force=True)
+    return size
+
+
+def abort_uploads(bucket=None):
+    """ Cancels multipart uploads left by failures
+    """
+    if not status.uploads:
+        return
+    bucket = bucket or get_bucket()
+    for key_name, state in status.uploads.items():
+        mp = MultiPartUpload(bucket)
+        mp.key_name, mp.id = key_name, state['id']
+        try:
+            mp.cancel_upload()
+        except S3ResponseError, e:
+            if e.status != 404:
+                log.error('Failed to cancel upload of %s: %s'
+                          % (key_name, e))
+                continue
+        with status.lock:
+            del status.uploads[key_name]
+    status.save(force=True)
+
+
+def upload(key_name, fileobj, bucket=None, metadata=None):
     if not bucket:
         bucket = get_bucket()
     k = Key(bucket)
     k.key = key_name
-    size = try_exec(k.set_contents_from_file,
-                    args=(fileobj,), kwargs={'encrypt_key': True},
-                    exc=S3ResponseError)
+    if metadata:
+        k.update_metadata(metadata)
+    with UPLOAD_OBJECT.time():
+        size = try_exec(k.set_contents_from_file,
+                        args=(fileobj,), kwargs=limited(encrypt_key=True),
+                        exc=S3ResponseError)
+    UPLOADED.inc(size or 0)
     return size
 
 
@@ -164,26 +470,45 @@ def download(key, path, check_space=True):
             return -1
     if check_space and available_space(path=os.path.dirname(path)) < key.size:
         return key.size
-    key.get_contents_to_filename(path)
+    key.get_contents_to_filename(path, **limited())
     return 0
 
 
 class BackupHandler(object):
+    """ Uploads files and dumps of a backup and collects its statistics.
+        May be used from several threads; every thread gets its own
+        S3 connection.
+    """
     def __init__(self, backup_id):
         self.id = backup_id
-        self.bucket = get_bucket()
         self.prefix, self.prefix_fs, self.prefix_db = get_prefixes(self.id)
         self.size = 0
         self.files_count = 0
+        # files_count of stats uploaded already
+        self.files_reported = 0
         self.db_names = []
+        self._local = threading.local()
+        self._lock = threading.RLock()
+        self._pack = StringIO()
+        self._pack_name = None
+        self._members = []
+        self._contents = {}
+        self._sizes = {}
 
     def __enter__(self):
-        if not self.bucket:
-            self.bucket = get_bucket()
         return self
 
+    @property
+    def bucket(self):
+        bucket = getattr(self._local, 'bucket', None)
+        if not bucket:
+            bucket = self._local.bucket = get_bucket()
+        return bucket
+
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.files_count:
+        if not exc_type:
+            self.flush_pack()
+        if self.files_count or self.files_reported:
             self.upload_fs_info()
         self.upload_stats()
 
@@ -193,75 +518,327 @@ class BackupHandler(object):
     def get_db_keyname(self, filename):
         return make_db_key(self.prefix_db, filename)
 
-    def upload_file(self, filename):
-        """ compress if necessary and upload file
+    def reference(self, filename, info, content, extents=None):
+        """ Returns manifest row of a file with the same content as
+            the uploaded object
+        """
+        key, compressed, offset, length = content
+        DEDUPLICATED.inc(info.st_size)
+        with self._lock:
+            self.files_count += 1
+        return file_row(filename, info, compressed, self.id,
+                        offset=offset, length=length, ref=key,
+                        extents=extents)
+
+    def link_file(self, filename, info, target):
+        """ Adds manifest row of a hardlink to the backed up target. While
+            there is a pack not uploaded yet, which may hold the target,
+            the row is added with its files.
+        """
+        DEDUPLICATED.inc(info.st_size)
+        with self._lock:
+            self.files_count += 1
+        row = file_row(filename, info, False, self.id, link=target)
+        if self._members:
+            self._members.append(row)
+        else:
+            status.backupdb.add((row,))
+            status.save()
+
+    def upload_file(self, filename, info):
+        """ compress if necessary and upload file; returns manifest row
+            or None if upload failed. A file with the content of an
+            uploaded one is not uploaded again. A file uploaded by parts
+            is read to be hashed before the upload only if there is
+            content of the same size, otherwise it is hashed as it is
+            uploaded. Only data of a sparse file is read and uploaded.
         """
         key_name = self.get_fs_keyname(filename)
         need_to_compress = not is_file_compressed(filename)
-        multipart = os.stat(filename).st_size > CHUNK_SIZE
-        if multipart:
-            data = chunks(filename)
-            if need_to_compress:
-                data = compress_chunks(data)
-            size = upload_multipart(key_name, data, bucket=self.bucket)
+        extents = get_extents(filename) if is_sparse(info) else None
+        if extents is None:
+            size = info.st_size
         else:
-            with open(filename, 'r') as f:
-                if need_to_compress:
-                    f = compress(f)
-                size = upload(key_name, f, bucket=self.bucket)
+            size = sum(length for offset, length in extents)
+            SPARSE.inc(info.st_size - size)
+        data = digest = None
+        if size > CHUNK_SIZE:
+            if status.backupdb.has_content_size(size):
+                digest = file_digest(filename, extents=extents)
+        else:
+            if extents is None:
+                with open(filename, 'rb') as f:
+                    data = f.read()
+            else:
+                data = ''.join(c.getvalue()
+                               for c in sparse_chunks(filename, extents))
+            digest = sha(data)
+        if digest:
+            content = status.backupdb.get_content(digest.hexdigest())
+            if content:
+                return self.reference(filename, info, content,
+                                      extents=extents)
+        ref = None
+        row = status.backupdb.get(filename)
+        if row and row[2] == self.id and \
+                status.backupdb.has_content_key(key_name):
+            # uploaded before the backup was interrupted and may be
+            # referenced already, so changed content goes to another key
+            key_name = ref = '%s.%s' % (key_name, uuid4().hex[:8])
+        if data is None:
+            for attempt in xrange(UPLOAD_ATTEMPTS):
+                hashing = None if digest else sha()
+                uploaded = upload_resumable(key_name, filename,
+                                            compressed=need_to_compress,
+                                            bucket=self.bucket,
+                                            digest=hashing,
+                                            extents=extents)
+                if uploaded is not None:
+                    digest = digest or hashing
+                    break
+            else:
+                return None
+        else:
+            f = StringIO(data)
+            if need_to_compress:
+                f = compress(f)
+            uploaded = upload(key_name, f, bucket=self.bucket)
+
+        status.backupdb.add_content(((digest.hexdigest(), size,
+                                      key_name, int(need_to_compress),
+                                      None, None, self.id),))
+        with self._lock:
+            self.files_count += 1
+            self.size += uploaded
+        return file_row(filename, info, need_to_compress, self.id, ref=ref,
+                        extents=extents)
+
+    @property
+    def packed(self):
+        """ Number of files in the pack which is not uploaded yet
+        """
+        return len(self._members)
+
+    def pack_file(self, filename, info):
+        """ Adds a file not larger than PACK_FILE_SIZE to the pack, every
+            file is compressed separately. The pack is uploaded and its
+            files are added to the manifest when it reaches PACK_SIZE.
+            Returns True if the pack was uploaded, None if the file
+            could not be read.
+        """
+        compressed = not is_file_compressed(filename)
+        try:
+            with open(filename, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        digest = sha(data).hexdigest()
+        content = self._contents.get(digest) or \
+                  status.backupdb.get_content(digest)
+        if content:
+            self._members.append(self.reference(filename, info, content))
+            return False
+        if compressed:
+            data = compress(StringIO(data)).getvalue()
+        if not self._pack_name:
+            self._pack_name = 'pack-%s' % uuid4().hex
+        offset = self._pack.tell()
+        self._contents[digest] = (self.prefix_fs + self._pack_name,
+                                  int(compressed), offset, len(data))
+        self._sizes[digest] = info.st_size
+        self._members.append(file_row(filename, info, compressed, self.id,
+                                      pack=self._pack_name,
+                                      offset=offset,
+                                      length=len(data)))
+        self._pack.write(data)
+        if self._pack.tell() >= PACK_SIZE:
+            return self.flush_pack()
+        return False
 
-        self.files_count += 1
-        self.size += size
-        return size, need_to_compress
+    def flush_pack(self):
+        if not self._members:
+            return False
+        size = 0
+        if self._pack.tell():
+            self._pack.seek(0)
+            size = upload(self.prefix_fs + self._pack_name, self._pack,
+                          bucket=self.bucket)
+        status.backupdb.add_content([(digest, self._sizes[digest]) + content
+                                     + (self.id,)
+                                     for digest, content
+                                     in self._contents.iteritems()])
+        status.backupdb.add(self._members)
+        status.save()
+        with self._lock:
+            # references and links are counted as they are added
+            self.files_count += sum(1 for m in self._members
+                                    if not (m[12] or m[13]))
+            self.size += size
+        self._pack = StringIO()
+        self._pack_name = None
+        self._members = []
+        self._contents = {}
+        self._sizes = {}
+        return True
 
-    def upload_db(self, path):
-        """ upload dump file
+    def upload_db(self, filename, dump, stream=None, metadata=None):
+        """ compress output of dump process (or stream reading it) and
+            upload it by parts as it comes; returns 0 if dump or upload failed
         """
-        with open(path, 'r') as f:
-            size = upload(self.get_db_keyname(path), f, bucket=self.bucket)
-        self.db_names.append(os.path.basename(path))
-        self.size += size
+        key_name = self.get_db_keyname(filename)
+        parts = compress_chunks(stream_chunks(stream or dump.stdout))
+        size = upload_multipart(key_name, parts, bucket=self.bucket,
+                                metadata=metadata)
+        dump.stdout.close()
+        if dump.wait():
+            if size:
+                self.bucket.delete_key(key_name)
+            return 0
+        if size:
+            with self._lock:
+                self.db_names.append(filename)
+                self.size += size
+        return size
+
+    def upload_tables(self, base, dump):
+        """ upload objects of TableDump in parallel and then the manifest
+            listing them; returns 0 if any object failed
+        """
+        objects = dump.objects()
+        for i, obj in enumerate(objects):
+            obj['key'] = '%s.d/%05i.sql.gz' % (base, i)
+        failed = []
+        uploaded = []
+
+        def upload_object(obj):
+            key_name = self.prefix_db + obj['key']
+            try:
+                parts = compress_chunks(blocks(dump.dump(obj)))
+                obj['size'] = upload_multipart(key_name, parts,
+                                               bucket=self.bucket)
+            except Exception, e:
+                log.error('Dump of %s failed: %s' % (obj['key'], e))
+                obj['size'] = 0
+            (uploaded if obj['size'] else failed).append(key_name)
+
+        for obj in run_parallel(upload_object, objects,
+                                workers=dump.workers):
+            failed.append(self.prefix_db + obj['key'])
+        if failed:
+            for key_name in uploaded:
+                self.bucket.delete_key(key_name)
+            return 0
+        manifest = StringIO(json.dumps({'version': 1,
+                                        'database': dump.name,
+                                        'objects': objects}))
+        filename = base + MANIFEST_EXT
+        upload(self.get_db_keyname(filename), manifest, bucket=self.bucket)
+        size = sum(obj['size'] for obj in objects)
+        with self._lock:
+            self.db_names.append(filename)
+            self.size += size
         return size
 
     def upload_fs_info(self):
-        with open(status.backupdb.db, 'r') as f:
-            return upload(self.prefix + os.path.basename(status.backupdb.db),
-                          compress(f),
-                          bucket=self.bucket)
+        """ Uploads rows added since the last uploaded manifest with 'prev'
+            metadata referring to its backup, or the whole manifest if it
+            follows MANIFEST_DELTAS deltas or nothing.
+        """
+        prev = status.manifest
+        if prev.get('backup_id') == self.id:
+            # uploaded by the interrupted run of this backup
+            prev = prev.get('prev') or {}
+        key_name = self.prefix + os.path.basename(status.backupdb.db)
+        f = tempfile.TemporaryFile()
+        try:
+            if prev and prev['deltas'] < MANIFEST_DELTAS:
+                since = prev['backup_id']
+                write_delta(f, status.backupdb.changes(since=since))
+                size = upload(key_name + DELTA_EXT, f, bucket=self.bucket,
+                              metadata={'prev': str(prev['backup_id'])})
+                deltas = prev['deltas'] + 1
+            else:
+                with open(status.backupdb.db, 'rb') as db:
+                    write_gzipped(f, db)
+                size = upload(key_name, f, bucket=self.bucket)
+                deltas = 0
+        finally:
+            f.close()
+        if size:
+            if prev:
+                prev = {'backup_id': prev['backup_id'],
+                        'deltas': prev['deltas']}
+            status.manifest = {'backup_id': self.id,
+                               'deltas': deltas,
+                               'prev': prev}
+            status.save()
+        return size
 
     def upload_stats(self):
-        if not self.has_stats():
-            return True
-        if api.update_backup_stats(self.id,
-                                   size=self.size,
-                                   files=self.files_count,
-                                   db_names=self.db_names) == 200:
-            self.reset_stats()
-            return True
-        return False
+        with self._lock:
+            if not self.has_stats():
+                return True
+            if api.update_backup_stats(self.id,
+                                       size=self.size,
+                                       files=self.files_count,
+                                       db_names=self.db_names) == 200:
+                self.reset_stats()
+                return True
+            return False
 
     def has_stats(self):
         return any((self.size, self.files_count, self.db_names))
 
     def reset_stats(self):
+        self.files_reported += self.files_count
         self.size = self.files_count = 0
         del self.db_names[:]
 
 
 def get_database(backup_id, path=None):
     """ path is path where to decompress database; default is main db.
+        Deltas are followed by 'prev' metadata back to the manifest
+        uploaded whole and applied to it.
         Returns:
             -1 if database wasn't found;
             0 on success;
             number of bytes of compressed database if there is not enough free space for it.
     """
+    bucket = get_bucket()
     basename = os.path.basename(status.backupdb.db)
-    key = get_prefix(backup_id) + basename
+    deltas = []
+    current = backup_id
+    while True:
+        key_name = get_prefix(current) + basename
+        key = bucket.get_key(key_name)
+        if key:
+            break
+        delta = bucket.get_key(key_name + DELTA_EXT)
+        prev = delta and delta.get_metadata('prev')
+        if not prev or int(prev) >= current:
+            return -1
+        deltas.append(delta)
+        current = int(prev)
     gzipped = os.path.join('/tmp', basename)
     result = download(key, gzipped)
     if result:
         return result
     decompress(gzipped, unzipped=path or status.backupdb.db)
+    if path:
+        data = BackupData(path)
+    else:
+        data = status.backupdb
+        data.migrate()
+    for delta in reversed(deltas):
+        with tempfile.TemporaryFile() as f:
+            delta.get_contents_to_file(f, **limited())
+            f.seek(0)
+            data.apply(read_delta(f))
+    if not path:
+        status.manifest = {'backup_id': backup_id,
+                           'deltas': len(deltas),
+                           'prev': {}}
+        status.save()
     return 0
 
 
@@ -281,28 +858,50 @@ def restore(backup_id):
     if not files:
         s, files = api.get_files_info(backup_id)
         if s == 200:
-            files = ((path, b_id, True) for path, b_id in files.items())
+            files = ((path, b_id, 0, True) + (None,) * 7
+                     for path, b_id in files.items())
         else:
             return 'Failed to request the list of files'
     backup_prefixes = {}
     low_space_msg = 'Need at least %i bytes free'
-    for path, b_id, hash_key, compressed in files:
+    # files of a pack follow each other in the manifest
+    members = []
+    # hardlinks are made when their targets are restored
+    links = []
+    for (path, b_id, hash_key, compressed,
+         pack, offset, length, ref, link, size, extents) in files:
+        if link:
+            links.append((path, link))
+            continue
         prefix = backup_prefixes.get(b_id)
         if not prefix:
             prefix = get_prefix(b_id, ptype=PREFIX_TYPE.FS)
             backup_prefixes[b_id] = prefix
-        if hash_key:
+        if ref:
+            keyname = ref
+        elif pack:
+            keyname = prefix + pack
+        elif hash_key:
             keyname = make_hash_fs_key(prefix, path)
         else:
             keyname = make_path_fs_key(prefix, path, compressed=compressed)
+        if offset is not None:
+            # a file in a pack
+            if members and members[0][0] != keyname:
+                restore_pack(bucket, members)
+                members = []
+            members.append((keyname, path, compressed, offset, length))
+            continue
         key = bucket.get_key(keyname)
         if not key:
             continue
+        # data of a sparse file is put to its extents afterwards
+        target = path if extents is None else path + '.extents'
         if compressed:
             gzipped = '/tmp' + os.path.basename(path)
             if download(key, gzipped):
                 return low_space_msg % key.size
-            decompress(gzipped, path)
+            decompress(gzipped, target)
         else:
             dirname = os.path.dirname(path)
             if not os.path.exists(dirname):
@@ -312,36 +911,212 @@ def restore(backup_id):
                 av_space += os.stat(path).st_size
             if av_space < key.size:
                 return low_space_msg
-            download(key, path, check_space=False)
+            download(key, target, check_space=False)
+        if extents is not None:
+            restore_sparse(target, path, json.loads(extents), size)
+    if members:
+        restore_pack(bucket, members)
+    for path, target in links:
+        restore_link(path, target)
 
     if os.path.exists(RESTORE_DB_PATH):
         os.remove(RESTORE_DB_PATH)
 
     prefix = get_prefix(backup_id, ptype=PREFIX_TYPE.DB)
-    db_keys = bucket.get_all_keys(prefix=prefix)
+    # objects of table dumps are listed as common prefixes
+    db_keys = bucket.list(prefix=prefix, delimiter='/')
     db_creds = {}
+    jobs = []
     for k in db_keys:
-        basename = os.path.basename(k.key)
-        host, port, name = basename.split('_', 3)[:3]
-        port = int(port)
+        if not isinstance(k, Key):
+            continue
+        basename = k.key[len(prefix):]
+        try:
+            host, port, name, ext = parse_dump_name(basename)
+        except ValueError:
+            log.error('Unknown database dump: %s' % basename)
+            continue
         db_key = '%s:%i' % (host, port)
         if db_key not in db_creds:
+            creds = get_credentials(host, port)
+            if not creds:
+                log.error('There are no credentials for %s:%i' % (host, port))
+                continue
+            db_creds[db_key] = creds
+        user, passwd = db_creds[db_key]
+
+        chain = [(k, prefix, ext)]
+        if ext == BINLOG_EXT:
+            chain = get_binlog_chain(bucket, k, ext, host, port, name)
+            if not chain:
+                return 'There is no full dump of %s from %s:%i' % (name,
+                                                                  host, port)
+        jobs.append((chain, user, host, passwd, port, name))
+
+    errors = []
+
+    def restore_database(job):
+        error = restore_chain(*job)
+        if error:
+            errors.append(error)
+
+    for chain, user, host, passwd, port, name in run_parallel(
+            restore_database, jobs, workers=DB_RESTORE_WORKERS,
+            group=lambda job: (job[2], job[4]),
+            group_workers=DB_HOST_RESTORE_WORKERS):
+        errors.append('Restore of %s to %s:%i crashed' % (name, host, port))
+    if errors:
+        log.error('\n'.join(errors))
+        return errors[0]
+    return None
+
+
+def get_binlog_chain(bucket, key, ext, host, port, name):
+    """ Follows 'prev' metadata of binary log dumps back to the full dump.
+        Returns list of (key, prefix, ext) to import, the full dump first,
+        or None if the chain is broken.
+    """
+    chain = []
+    while ext == BINLOG_EXT:
+        prev = bucket.get_key(key.key).get_metadata('prev')
+        if not prev:
+            return None
+        prefix = get_prefix(int(prev), ptype=PREFIX_TYPE.DB)
+        found = None
+        for k in bucket.list(prefix='%s%s_%i_%s_' % (prefix, host, port, name),
+                             delimiter='/'):
+            if not isinstance(k, Key):
+                continue
             try:
-                db_creds[db_key] = get_credentials(host, port)
+                dump = parse_dump_name(k.key[len(prefix):])
             except ValueError:
-                log.error('There are no credentials for %s:%i' % (host, port))
                 continue
+            if dump[:3] == (host, port, name):
+                found = k
+                break
+        if not found:
+            return None
+        chain.append((key, key.key[:key.key.rindex('/') + 1], ext))
+        key, ext = found, dump[3]
+    chain.append((key, key.key[:key.key.rindex('/') + 1], ext))
+    chain.reverse()
+    return chain
 
-        gzipped = '/tmp/' + basename
-        if download(k, gzipped):
-            return 'Need at least %i bytes free' % k.size
-        filename = decompress(gzipped)
 
-        user, passwd = db_creds[db_key]
-        if import_db(filename, user, host, passwd, port, name):
-            os.remove(filename)
-        else:
-            log.error('Failed to import %s to %s:%i' % (name, host, port))
+def restore_sparse(data_path, path, extents, size):
+    """ Writes data of a sparse file to its extents, the rest are holes
+    """
+    with open(data_path, 'rb') as data, open(path, 'wb') as f:
+        for offset, length in extents:
+            f.seek(offset)
+            while length:
+                block = data.read(min(length, MB))
+                if not block:
+                    break
+                f.write(block)
+                length -= len(block)
+        f.truncate(size)
+    os.remove(data_path)
+
+
+def restore_link(path, target):
+    dirname = os.path.dirname(path)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    try:
+        if os.path.lexists(path):
+            os.remove(path)
+        os.link(target, path)
+    except OSError, e:
+        log.error('Failed to link %s to %s: %s' % (path, target, e))
+
+
+def restore_pack(bucket, members):
+    """ Restores files of a pack, members are (pack key name, path,
+        compressed, offset, length). Members apart by no more than
+        PACK_GAP bytes are fetched by one ranged GET.
+    """
+    key = bucket.new_key(members[0][0])
+    members = sorted(members, key=lambda m: m[3])
+    while members:
+        run = [members.pop(0)]
+        while members and \
+                members[0][3] - (run[-1][3] + run[-1][4]) <= PACK_GAP:
+            run.append(members.pop(0))
+        start = run[0][3]
+        end = run[-1][3] + run[-1][4]
+        headers = {'Range': 'bytes=%i-%i' % (start, end - 1)}
+        try:
+            data = key.get_contents_as_string(**limited(headers=headers))
+        except S3ResponseError, e:
+            log.error('Failed to download %s: %s' % (key.name, e))
+            continue
+        for pack, path, compressed, offset, length in run:
+            content = data[offset - start:offset - start + length]
+            if compressed:
+                content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+            dirname = os.path.dirname(path)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            with open(path, 'wb') as f:
+                f.write(content)
+
+
+def restore_chain(chain, user, host, passwd, port, name):
+    """ Imports full dump and binary logs after it one by one;
+        stops at the first failure and returns its error message or None.
+    """
+    # boto connections are not shared between threads
+    db_bucket = get_bucket()
+    for key, prefix, ext in chain:
+        error = restore_dump(Key(db_bucket, key.key), prefix, ext,
+                             user, host, passwd, port, name)
+        if error:
+            return error
+    return None
+
+
+def restore_dump(key, prefix, ext, user, host, passwd, port, name):
+    """ Imports full dump, table dump or binary log dump of a database;
+        returns error message or None.
+    """
+    if ext == MANIFEST_EXT:
+        return restore_tables(key, prefix, user, host, passwd, port, name)
+
+    if import_stream(decompress_key(key), user, host, passwd, port, name):
+        return None
+    if ext == BINLOG_EXT:
+        return 'Failed to apply binary log %s to %s:%i' % (key.key, host,
+                                                          port)
+    return 'Failed to import %s to %s:%i' % (name, host, port)
+
+
+def restore_tables(manifest_key, prefix, user, host, passwd, port, name,
+                   workers=TABLES_RESTORE_WORKERS):
+    """ Imports objects of a table dump: schema, then data objects in
+        parallel, then views and triggers.
+    """
+    objects = json.loads(manifest_key.get_contents_as_string())['objects']
+    errors = []
+
+    def import_object(obj):
+        key = get_bucket().get_key(prefix + obj['key'])
+        if not key:
+            errors.append('There is no %s' % obj['key'])
+        elif not import_stream(decompress_key(key),
+                               user, host, passwd, port, name):
+            errors.append('Failed to import %s to %s:%i'
+                          % (obj['key'], host, port))
+
+    for otype in ('schema', 'data', 'post'):
+        for obj in run_parallel(import_object,
+                                [o for o in objects if o['type'] == otype],
+                                workers=workers):
+            errors.append('Import of %s to %s:%i crashed'
+                          % (obj['key'], host, port))
+        if errors:
+            log.error('\n'.join(errors))
+            return errors[0]
     return None
 
 
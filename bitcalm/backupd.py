@@ -5,8 +5,6 @@ if os.getuid() != 0:
     exit('Sorry, you have not enough rights to run BitCalm. Only root can run BitCalm.')
 
 import re
-import sys
-import errno
 import signal
 import pickle
 import time
@@ -25,49 +23,84 @@ from mysql.connector import errors as mysql_errors
 import log
 import backup
 import bitcalm
-from bitcalm.utils import total_seconds, get_system_info
-from bitcalm.const import KB, MIN, HOUR, DAY
-from config import config, status as client_status
+from bitcalm.cli import PIDFILE_PATH, stop, main
+from bitcalm.utils import total_seconds, get_system_info, run_parallel
+from bitcalm.const import KB, GB, MIN, HOUR, DAY
+from bitcalm import metrics
+from bitcalm.governor import governor
+from bitcalm.profiler import profiler, MODE as PROFILE_MODE
+from bitcalm.tabledump import TableDump
+from config import config, status as client_status, DATA_DIR
 from api import api
-from filesystem.utils import levelwalk, iterfiles, modified
-from actions import ActionPool, OneTimeAction, Action, StepAction, ActionSeed
+from filesystem.utils import levelwalk, iterfiles, modified, STAT
+from actions import (ActionPool, OneTimeAction, Action, StepAction, ActionSeed,
+                     CONCURRENCY)
 from schedule import DailySchedule, WeeklySchedule, MonthlySchedule
 from database import (EXCLUDE_DB,
                       DEFAULT_DB_PORT,
                       get_databases,
+                      get_sizes,
+                      get_binlog_position,
                       dump_db,
-                      connection_error)
+                      dump_binlog,
+                      BinlogPositionReader,
+                      DUMP_EXT,
+                      BINLOG_EXT,
+                      connection_error,
+                      pool as db_pool)
 
 MAX_CRASH_SIZE = KB
 FS_SET_PERIOD = DAY
 LOG_UPLOAD_PERIOD = 5 * MIN
 CHANGES_CHECK_PERIOD = 10 * MIN
 DB_CHECK_PERIOD = DAY
-PIDFILE_PATH = '/var/run/bitcalmd.pid'
+DB_DUMP_WORKERS = 4
+DB_HOST_DUMP_WORKERS = 2
+TABLE_DUMP_SIZE = 20 * GB
+TABLE_DUMP_WORKERS = 4
+DB_FULL_PERIOD = 7 * DAY
+METRICS_PERIOD = MIN
+METRICS_PATH = os.path.join(DATA_DIR, 'metrics.prom')
+# directories of filesystem levels being uploaded
+FS_SPOOL_PATH = os.path.join(DATA_DIR, 'fs_levels')
 CRASH_PATH = '/var/log/bitcalm.crash'
 
 
 actions = ActionPool()
 
 
+def toggle_profile():
+    if config.profile != PROFILE_MODE.OFF:
+        profiler.toggle(mode=config.profile)
+    else:
+        profiler.toggle()
+    return True
+
+
+def on_profile(signum, frame):
+    # the sampler is joined and dumps are written by the main loop
+    actions.add(OneTimeAction(0, toggle_profile, start=0))
+
+
 def on_stop(signum, frame):
     log.info('Terminated process with pid %i' % os.getpid())
+    client_status.flush()
+    db_pool.clear()
     raise SystemExit()
 
 
-def set_fs(depth=-1, step_time=2*MIN, top='/', action='start', start=None):
+def set_fs(depth=-1, step_time=2*MIN, top='/', action='start', cursor=None):
     till = datetime.utcnow() + timedelta(seconds=step_time)
-    for level, has_next in levelwalk(depth=depth, top=top, start=start):
+    walk = levelwalk(depth=depth, top=top, spool=FS_SPOOL_PATH, cursor=cursor)
+    for level, has_next, cursor in walk:
         status = api.update_fs([level], action, has_next=has_next)
-        depth -= 1
         if status == 200:
             if has_next:
-                client_status.upload_dirs = [[p[:2] for p in level if p[1]],
-                                             depth]
+                client_status.upload_dirs = list(cursor)
             else:
                 client_status.upload_dirs = []
                 client_status.last_fs_upload = datetime.utcnow()
-            client_status.save()
+            client_status.save(force=True)
         else:
             return 0
         if datetime.utcnow() > till and has_next:
@@ -76,12 +109,12 @@ def set_fs(depth=-1, step_time=2*MIN, top='/', action='start', start=None):
     return 1
 
 def update_fs(depth=-1, step_time=2*MIN):
-    if client_status.upload_dirs:
-        kwargs = {'action': 'append'}
-        kwargs['start'], depth = client_status.upload_dirs
-    else:
-        kwargs = {}
-    return set_fs(depth=depth, step_time=step_time, **kwargs)
+    cursor = client_status.upload_dirs
+    # upload_dirs of older versions held directories of the level,
+    # their upload starts over
+    if cursor and isinstance(cursor[0], int):
+        return set_fs(step_time=step_time, action='append', cursor=cursor)
+    return set_fs(depth=depth, step_time=step_time)
 
 
 def upload_log(entries=log.upload):
@@ -207,7 +240,8 @@ def check_changes():
         if version:
             ver, url = version
             if ver != bitcalm.__version__:
-                actions.add(OneTimeAction(0, update, url))
+                actions.add(OneTimeAction(0, update, url,
+                                          concurrency=CONCURRENCY.UPDATE))
                 log.info('Planned update to %s' % ver)
                 return True
 
@@ -245,28 +279,32 @@ def check_changes():
                     for dbases in db.itervalues():
                         dbases[:] = filter(user_db, dbases)
                     s['db'] = db
-                cs = curr.get(s['id'])
-                if cs:
-                    if isinstance(cs, types[s['type']]):
-                        cs.update(**s)
+            with client_status.lock:
+                for s in schedules:
+                    cs = curr.get(s['id'])
+                    if cs:
+                        if isinstance(cs, types[s['type']]):
+                            cs.update(**s)
+                        else:
+                            ns = types[s.pop('type')](**s)
+                            ns.prev_backup = cs.prev_backup
+                            ns.exclude = cs.exclude
+                            client_status.schedules.remove(cs)
+                            client_status.schedules.append(ns)
                     else:
                         ns = types[s.pop('type')](**s)
-                        ns.prev_backup = cs.prev_backup
-                        ns.exclude = cs.exclude
-                        client_status.schedules.remove(cs)
                         client_status.schedules.append(ns)
-                else:
-                    ns = types[s.pop('type')](**s)
-                    client_status.schedules.append(ns)
             b = actions.get(make_backup)
             if b:
                 b.next()
             else:
-                actions.add(Action(backup.next_date, make_backup))
+                actions.add(Action(backup.next_date, make_backup,
+                                   concurrency=CONCURRENCY.BACKUP))
         client_status.save()
         tasks = content.get('restore')
         if tasks:
-            actions.add(OneTimeAction(30, restore, tasks))
+            actions.add(OneTimeAction(30, restore, tasks,
+                                      concurrency=CONCURRENCY.RESTORE))
         if content.get('log_tail', False):
             actions.add(OneTimeAction(0, upload_log, entries=tail_log()))
         if content.get('send_fs', False):
@@ -274,7 +312,8 @@ def check_changes():
             if fs_action:
                 fs_action.delay(period=0)
             else:
-                actions.add(StepAction(FS_SET_PERIOD, update_fs, start=0))
+                actions.add(StepAction(FS_SET_PERIOD, update_fs, start=0,
+                                       concurrency=CONCURRENCY.FS))
         return True
     elif status == 304:
         return True
@@ -299,8 +338,14 @@ def restore(tasks):
     return not tasks
 
 
+def write_metrics():
+    metrics.registry.write(METRICS_PATH)
+    return True
+
+
 def make_backup():
     schedule = backup.next_schedule()
+    started = metrics.registry.snapshot()
     if not client_status.backup:
         status, backup_id = api.set_backup_info('prepare',
                                                 time=time.time(),
@@ -308,69 +353,106 @@ def make_backup():
         if status != 200:
             return False
         client_status.backup = {'backup_id': backup_id, 'status': 0}
-        client_status.save()
+        client_status.sync()
     else:
         backup_id = client_status.backup['backup_id']
     bstatus = client_status.backup
     if schedule.files and bstatus['status'] < 2:
-        schedule.clean_files()
+        with client_status.lock:
+            schedule.clean_files()
         if bstatus['status'] == 0:
             status, content = api.set_backup_info(
                                 'filesystem',
                                 backup_id=backup_id,
                                 has_info=bool(client_status.backupdb.count()))
             if status == 200:
-                bstatus['is_full'] = content['is_full']
+                with client_status.lock:
+                    bstatus['is_full'] = content['is_full']
                 if bstatus['is_full']:
                     client_status.backupdb.clean()
-                elif 'prev' in content:
+                    # the next manifest is uploaded whole
+                    client_status.manifest = {}
+                elif 'prev' in content and (
+                        client_status.manifest.get('backup_id')
+                        != int(content['prev'])
+                        or not client_status.backupdb.count()):
+                    # the local manifest is not the uploaded one
                     backup.get_database(int(content['prev']))
             else:
                 return False
-            bstatus['status'] = 1
-            client_status.save()
+            with client_status.lock:
+                bstatus['status'] = 1
+            client_status.sync()
         if bstatus.get('items') is None:
-            bstatus['items'] = {'dirs': filter(os.path.isdir,
-                                               schedule.files),
-                                'files': filter(os.path.isfile,
-                                                schedule.files)}
+            items = {'dirs': filter(os.path.isdir, schedule.files),
+                     'files': filter(os.path.isfile, schedule.files)}
+            with client_status.lock:
+                bstatus['items'] = items
             client_status.save()
 
+        def save_cursor(cursor):
+            with client_status.lock:
+                bstatus['cursor'] = cursor
+            client_status.save(force=True)
+
+        pending = []
+        # the first backed up path of every file with several hardlinks
+        links = {}
+
+        def checkpoint(cursor):
+            # files of the pack being filled are not in the manifest yet
+            if handler.packed:
+                pending[:] = [cursor]
+            else:
+                save_cursor(cursor)
+
         files = iterfiles(files=bstatus['items']['files'],
-                          dirs=bstatus['items']['dirs'])
+                          dirs=bstatus['items']['dirs'],
+                          cursor=bstatus.get('cursor'),
+                          checkpoint=checkpoint)
         if not bstatus['is_full']:
             files = modified(files, client_status.backupdb)
 
-        with backup.BackupHandler(backup_id) as handler:
+        with backup.BackupHandler(backup_id) as handler, \
+                profiler.stage('files'):
             for filename in files:
+                governor.check()
                 try:
-                    info = os.stat(filename)
+                    with STAT.time():
+                        info = os.stat(filename)
                 except OSError:
                     continue
-                size, is_compressed = handler.upload_file(filename)
-                if size is None:
+                inode = (info.st_dev, info.st_ino)
+                if info.st_nlink > 1 and inode in links:
+                    handler.link_file(filename, info, links[inode])
                     continue
-                row = (filename,
-                       1,
-                       info.st_mtime,
-                       info.st_size,
-                       info.st_mode,
-                       info.st_uid,
-                       info.st_gid,
-                       int(is_compressed),
-                       backup_id)
-                client_status.backupdb.add((row,))
-                client_status.save()
+                if info.st_size <= backup.PACK_FILE_SIZE:
+                    flushed = handler.pack_file(filename, info)
+                    if flushed is None:
+                        continue
+                    if flushed and pending:
+                        save_cursor(pending.pop())
+                else:
+                    row = handler.upload_file(filename, info)
+                    if row is None:
+                        continue
+                    client_status.backupdb.add((row,))
+                    client_status.save()
+                if info.st_nlink > 1:
+                    links[inode] = filename
                 if handler.files_count >= 100:
                     handler.upload_stats()
+            if handler.flush_pack() and pending:
+                save_cursor(pending.pop())
 
     if schedule.databases and bstatus['status'] < 3:
         if bstatus['status'] != 2:
             api.set_backup_info('database', backup_id=backup_id)
-            bstatus['status'] = 2
-            client_status.save()
+            with client_status.lock:
+                bstatus['status'] = 2
+            client_status.sync()
         if not bstatus.get('databases'):
-            bstatus['databases'] = []
+            databases = []
             for host, dbnames in schedule.databases.iteritems():
                 if ':' in host:
                     host, port = host.split(':')
@@ -378,50 +460,176 @@ def make_backup():
                 else:
                     port = DEFAULT_DB_PORT
                 for name in dbnames:
-                    client_status.backup['databases'].append((host, port, name))
-                client_status.save()
+                    databases.append((host, port, name))
+            with client_status.lock:
+                bstatus['databases'] = databases
+            client_status.save(force=True)
         db_creds = {}
         make_key = lambda h, p: '%s:%i' % (h, p)
         for db in itertools.chain(config.database, client_status.database):
             key = make_key(db['host'], db.get('port', DEFAULT_DB_PORT))
             db_creds[key] = (db['user'], db['passwd'])
-        db_success = 0
         db_total = len(bstatus['databases'])
-        with backup.BackupHandler(backup_id) as handler:
-            while bstatus['databases']:
-                host, port, name = bstatus['databases'].pop()
-                try:
-                    user, passwd = db_creds[make_key(host, port)]
-                except KeyError:
-                    log.error('There are no credentials for %s:%i' % (host, port))
-                    client_status.save()
-                    continue
-                ts = datetime.utcnow().strftime('%Y.%m.%d_%H%M')
-                path = '/tmp/%s_%i_%s_%s.sql.gz' % (host, port, name, ts)
-                if not dump_db(name, host, user,
-                               path=path, passwd=passwd, port=port):
-                    log.error('Dump of %s from %s:%i failed' % (name, host, port))
-                    client_status.save()
-                    continue
-                handler.upload_db(path)
-                handler.upload_stats()
-                client_status.save()
-                db_success += 1
-                os.remove(path)
+        with backup.BackupHandler(backup_id) as handler, \
+                profiler.stage('databases'):
+            db_success = backup_databases(handler, bstatus['databases'],
+                                          db_creds)
         if db_success != db_total:
             log.error('%i of %i databases was backuped' % (db_success, db_total))
 
-    bstatus['status'] = 3
-    client_status.save()
+    with client_status.lock:
+        bstatus['status'] = 3
+    backup.abort_uploads()
+    client_status.sync()
+    api.update_backup_stats(backup_id,
+                            metrics=metrics.registry.summary(since=started))
     api.set_backup_info('complete',
                         backup_id=backup_id,
                         time=time.time())
     client_status.backup = None
-    backup.next_schedule().done()
-    client_status.save()
+    # check_changes may have updated or replaced schedules meanwhile,
+    # so the next one is not necessarily the backed up one
+    with client_status.lock:
+        schedule.done()
+        for s in client_status.schedules:
+            if s.id == schedule.id and s is not schedule:
+                s.done()
+    client_status.sync()
     return True
 
 
+def backup_databases(handler, databases, db_creds):
+    """ Dumps databases in parallel, the largest first.
+        Finished items are removed from databases list.
+        Returns number of successful dumps.
+    """
+    make_key = lambda h, p: '%s:%i' % (h, p)
+    sizes = {}
+    for host, port in set(db[:2] for db in databases):
+        creds = db_creds.get(make_key(host, port))
+        if not creds:
+            continue
+        try:
+            for name, size in get_sizes(creds[0], creds[1],
+                                        host, port).iteritems():
+                sizes[(host, port, name)] = size
+        except mysql_errors.Error as err:
+            log.error('Failed to estimate size of databases at %s:%i: %s'
+                      % (host, port, err))
+    success = []
+
+    def dump(db):
+        host, port, name = db
+        governor.check()
+        try:
+            user, passwd = db_creds[make_key(host, port)]
+        except KeyError:
+            log.error('There are no credentials for %s:%i' % (host, port))
+            result = False
+        else:
+            result = dump_database(handler, host, port, name, user, passwd,
+                                   size=sizes.get(tuple(db), 0))
+            if not result:
+                log.error('Dump of %s from %s:%i failed' % (name, host, port))
+        # databases is bstatus['databases'] pickled by the main thread
+        with client_status.lock:
+            databases.remove(db)
+            if result:
+                success.append(db)
+            client_status.save(force=True)
+        if result:
+            handler.upload_stats()
+
+    queue = sorted(databases, key=lambda db: sizes.get(tuple(db), 0),
+                   reverse=True)
+    failed = run_parallel(dump, queue,
+                          workers=governor.workers(DB_DUMP_WORKERS),
+                          group=lambda db: tuple(db[:2]),
+                          group_workers=DB_HOST_DUMP_WORKERS)
+    if failed:
+        with client_status.lock:
+            for db in failed:
+                if db in databases:
+                    databases.remove(db)
+            client_status.save(force=True)
+    return len([db for db in success if db not in failed])
+
+
+@metrics.timed('db_dump_seconds', 'Dump and upload of a database')
+def dump_database(handler, host, port, name, user, passwd, size=0):
+    """ Uploads binary log since the previous dump if there is a full
+        dump younger than DB_FULL_PERIOD, otherwise a full dump.
+        Remembers the binary log position of the dump.
+        Returns uploaded size.
+    """
+    ts = datetime.utcnow().strftime('%Y.%m.%d_%H%M')
+    base = '%s_%i_%s_%s' % (host, port, name, ts)
+    state_key = '%s:%i/%s' % (host, port, name)
+    state = client_status.binlog.get(state_key)
+    try:
+        position = get_binlog_position(user, passwd, host, port)
+    except mysql_errors.Error:
+        position = None
+
+    if position and state \
+            and time.time() - state['time'] < DB_FULL_PERIOD:
+        proc = dump_binlog(name, host, user, passwd=passwd, port=port,
+                           start=(state['file'], state['pos']),
+                           stop=position)
+        if proc:
+            metadata = {'prev': str(state['backup_id'])}
+            result = handler.upload_db(base + BINLOG_EXT, proc,
+                                       metadata=metadata)
+            if result:
+                with client_status.lock:
+                    state.update(file=position[0], pos=position[1],
+                                 backup_id=handler.id)
+                return result
+        log.info('Incremental dump of %s from %s:%i is not possible, '
+                 'making full dump' % (name, host, port))
+
+    result = 0
+    binlog = position
+    if size >= TABLE_DUMP_SIZE:
+        result, position = dump_tables(handler, base, name, host, user,
+                                       passwd, port)
+    if not result and binlog:
+        proc = dump_db(name, host, user, passwd=passwd, port=port,
+                       master_data=True)
+        reader = BinlogPositionReader(proc.stdout)
+        result = handler.upload_db(base + DUMP_EXT, proc, stream=reader)
+        position = reader.position
+    if not result:
+        proc = dump_db(name, host, user, passwd=passwd, port=port)
+        result = handler.upload_db(base + DUMP_EXT, proc)
+        position = None
+    if result:
+        with client_status.lock:
+            if position:
+                client_status.binlog[state_key] = {'file': position[0],
+                                                   'pos': position[1],
+                                                   'backup_id': handler.id,
+                                                   'time': time.time()}
+            else:
+                client_status.binlog.pop(state_key, None)
+    return result
+
+
+def dump_tables(handler, base, name, host, user, passwd, port):
+    """ Dumps tables of a huge database in parallel.
+        Returns uploaded size and binary log position of the snapshot.
+    """
+    workers = governor.workers(TABLE_DUMP_WORKERS)
+    try:
+        with TableDump(name, host, user, passwd=passwd, port=port,
+                       workers=workers) as dump:
+            return handler.upload_tables(base, dump), dump.position
+    except mysql_errors.Error as err:
+        log.error('Table dump of %s from %s:%i failed: %s' % (name, host,
+                                                            port, err))
+        return 0, None
+
+
 def get_crash():
     if not os.path.exists(CRASH_PATH):
         return '', 0
@@ -527,13 +735,14 @@ class Observer(object):
             t.join(2**31)
             if not t.is_alive():
                 worktime = self.get_work_period()
-                c = self.get_thread(func=report_crash)
+                c = self.get_thread(func=report_crash, name='crash-report')
                 c.join(2**31)
                 if worktime < MIN:
                     self.errors += 1
                     if self.errors >= 10:
                         log.info('Start emergency thread')
-                        t = self.get_thread(EmergencyWorker())
+                        t = self.get_thread(EmergencyWorker(),
+                                            name='emergency')
                         t.join(2**31)
                         log.info('Emergency thread stopped')
                     elif self.errors >= 3:
@@ -542,8 +751,8 @@ class Observer(object):
                     self.errors = 0
                 t = self.start_worker()
 
-    def get_thread(self, func, start=True):
-        t = Thread(target=func)
+    def get_thread(self, func, start=True, name=None):
+        t = Thread(target=func, name=name)
         t.setDaemon(True)
         if start:
             t.start()
@@ -557,7 +766,7 @@ class Observer(object):
     def start_worker(self):
         self.worker_started = datetime.utcnow()
         log.info('Starting worker thread')
-        return self.get_thread(func=self.worker)
+        return self.get_thread(func=self.worker, name='worker')
 
 
 def work():
@@ -572,20 +781,22 @@ def work():
     else:
         till_next = 0
     actions.add(Action(24*HOUR, check_system_info, start=2*MIN))
-    actions.add(StepAction(FS_SET_PERIOD, update_fs, start=till_next))
+    actions.add(StepAction(FS_SET_PERIOD, update_fs, start=till_next,
+                           concurrency=CONCURRENCY.FS))
     actions.extend([Action(LOG_UPLOAD_PERIOD, upload_log),
-                    Action(CHANGES_CHECK_PERIOD, check_changes)])
+                    Action(CHANGES_CHECK_PERIOD, check_changes),
+                    Action(METRICS_PERIOD, write_metrics)])
 
     if config.database or client_status.database:
         actions.add(Action(DB_CHECK_PERIOD, check_db, start=7*MIN))
     
     if client_status.amazon:
-        actions.add(Action(backup.next_date, make_backup))
+        actions.add(Action(backup.next_date, make_backup,
+                           concurrency=CONCURRENCY.BACKUP))
     else:
-        actions.add(OneTimeAction(5*MIN,
-                                  get_s3_access,
-                                  followers=[ActionSeed(backup.next_date,
-                                                        make_backup)]))
+        seed = ActionSeed(backup.next_date, make_backup,
+                          concurrency=CONCURRENCY.BACKUP)
+        actions.add(OneTimeAction(5*MIN, get_s3_access, followers=[seed]))
 
     if os.path.exists(CRASH_PATH) and os.stat(CRASH_PATH).st_size > 0:
         actions.add(OneTimeAction(10*MIN, report_crash, start=0))
@@ -598,12 +809,12 @@ def work():
             msg.append('ActionPool object has %s__iter__ method.')
             msg[-1] %= '' if hasattr(actions, '__iter__') else 'no '
             if hasattr(actions, '_actions'):
-                if isinstance(actions._actions, list):
+                if isinstance(actions._actions, dict):
                     if actions._actions:
                         f = ', '.join((a.__name__ for a in actions._funcs()))
                         msg.append('There are functions: %s.' % f)
                     else:
-                        msg.append('_actions is empty list.')
+                        msg.append('_actions is empty dict.')
                 else:
                     msg.append('_actions is %s.' % type(actions._actions))
             else:
@@ -613,10 +824,10 @@ def work():
         log.error(' '.join(msg))
     log.info('Start main loop')
     while True:
-        action = actions.next()
-        log.info('Next action is %s' % action)
-        time.sleep(action.time_left())
-        action()
+        log.info('Next action is %s' % actions.next())
+        action = actions.wait()
+        actions.run(action)
+        client_status.flush()
 
 
 def run():
@@ -647,85 +858,20 @@ def run():
             exit('Aborted')
 
     context = DaemonContext(pidfile=PIDLockFile(PIDFILE_PATH),
-                            signal_map={signal.SIGTERM: on_stop},
+                            signal_map={signal.SIGTERM: on_stop,
+                                        signal.SIGUSR2: on_profile},
                             stderr=open(CRASH_PATH, 'w'))
     context.files_preserve = map(lambda h: h.stream,
                                  filter(lambda h: isinstance(h, FileHandler),
                                         log.logger.handlers))
     print 'Starting daemon'
     with context:
+        profiler.path = DATA_DIR
+        if config.profile_upload:
+            profiler.report = api.report_profile
+        profiler.set_mode(config.profile)
         Observer(work)()
 
 
-def get_pid():
-    if os.path.exists(PIDFILE_PATH):
-        with open(PIDFILE_PATH, 'r') as f:
-            pid = f.read().strip()
-        try:
-            pid = int(pid)
-        except ValueError:
-            os.remove(PIDFILE_PATH)
-            return None
-        else:
-            return pid
-    else:
-        return None
-
-
-def start():
-    pid = get_pid()
-    if pid:
-        try:
-            os.kill(pid, 0)
-        except OSError, e:
-            running = e.errno == errno.EPERM
-        else:
-            running = True
-        if running:
-            exit('Bitcalm is running, pid %i' % pid)
-        else:
-            os.remove(PIDFILE_PATH)
-    run()
-
-
-def stop(verbose=True):
-    pid = get_pid()
-    if not pid:
-        if verbose:
-            print 'Bitcalm is not running'
-        return True
-    try:
-        os.kill(pid, signal.SIGTERM)
-    except OSError, e:
-        if verbose:
-            print 'Failed to terminate %(pid)i: %(e)s' % vars()
-        return False
-    return True
-
-
-def restart():
-    if stop():
-        run()
-
-
-def usage(actions):
-    return 'Usage: %s %s' % (os.path.basename(sys.argv[0]), '|'.join(actions))
-
-
-def main():
-    if sys.version_info < (2, 6):
-        exit('Please upgrade your python to 2.6 or newer')
-    actions = {'start': start,
-               'stop': stop,
-               'restart': restart,
-               'uninstall': uninstall}
-    if len(sys.argv) != 2:
-        exit(usage(actions.keys()))
-    func = actions.get(sys.argv[1])
-    if not func:
-        exit(usage(actions.keys()))
-    func()
-
-
 if __name__ == '__main__':
     main()
@@ -0,0 +1,114 @@
+""" Command line entry point.
+
+    Only the daemon needs boto, mysql.connector, the config and the status,
+    so stop and status use nothing but the pid file and backupd is
+    imported by the commands which run it.
+"""
+import os
+import sys
+import errno
+import signal
+
+
+PIDFILE_PATH = '/var/run/bitcalmd.pid'
+
+
+def get_pid():
+    if os.path.exists(PIDFILE_PATH):
+        with open(PIDFILE_PATH, 'r') as f:
+            pid = f.read().strip()
+        try:
+            pid = int(pid)
+        except ValueError:
+            os.remove(PIDFILE_PATH)
+            return None
+        else:
+            return pid
+    else:
+        return None
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def start():
+    pid = get_pid()
+    if pid:
+        if is_running(pid):
+            exit('Bitcalm is running, pid %i' % pid)
+        else:
+            os.remove(PIDFILE_PATH)
+    from bitcalm.backupd import run
+    run()
+
+
+def stop(verbose=True):
+    pid = get_pid()
+    if not pid:
+        if verbose:
+            print 'Bitcalm is not running'
+        return True
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except OSError, e:
+        if verbose:
+            print 'Failed to terminate %(pid)i: %(e)s' % vars()
+        return False
+    return True
+
+
+def restart():
+    if stop():
+        from bitcalm.backupd import run
+        run()
+
+
+def status():
+    """ Exit codes follow LSB: 0 running, 1 dead with the pid file left,
+        3 not running
+    """
+    pid = get_pid()
+    if not pid:
+        print 'Bitcalm is not running'
+        exit(3)
+    if not is_running(pid):
+        print 'Bitcalm is not running, stale pid file %s' % PIDFILE_PATH
+        exit(1)
+    print 'Bitcalm is running, pid %i' % pid
+
+
+def uninstall():
+    from bitcalm.backupd import uninstall
+    uninstall()
+
+
+def usage(actions):
+    return 'Usage: %s %s' % (os.path.basename(sys.argv[0]), '|'.join(actions))
+
+
+def main():
+    if sys.version_info < (2, 6):
+        exit('Please upgrade your python to 2.6 or newer')
+    if os.getuid() != 0:
+        exit('Sorry, you have not enough rights to run BitCalm. '
+             'Only root can run BitCalm.')
+    actions = {'start': start,
+               'stop': stop,
+               'restart': restart,
+               'status': status,
+               'uninstall': uninstall}
+    if len(sys.argv) != 2:
+        exit(usage(actions.keys()))
+    func = actions.get(sys.argv[1])
+    if not func:
+        exit(usage(actions.keys()))
+    func()
+
+
+if __name__ == '__main__':
+    main()
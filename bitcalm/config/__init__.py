@@ -1,14 +1,14 @@
 import os
 from shutil import copyfile
 
-from .base import Config, Status
+from .base import Config, Status, DATA_DIR
 
 
-DATA = '/var/lib/bitcalm/data'
+DATA = os.path.join(DATA_DIR, 'data')
 DATA_BACKUP = DATA + '.bak'
 
 
-config = Config('/etc/bitcalm.conf')
+config = Config(os.environ.get('BITCALM_CONF', Config.DEFAULT_CONF))
 
 try:
     status = Status(DATA)
@@ -2,6 +2,8 @@ import os
 import re
 import pickle
 import sqlite3
+import time
+import threading
 from uuid import uuid4
 from datetime import datetime, timedelta
 
@@ -9,20 +11,28 @@ from .exceptions import ConfigEntryError, ConfigSyntaxError
 
 
 DB_RE = re.compile('^((?:[\.\w]+)|(?:(?:\d{1,3}\.){3}\d{1,3}))(?::(\d+))?;(\w+)(?:;(\w+))?$')
-DATA_DIR = '/var/lib/bitcalm'
+BANDWIDTH_RE = re.compile('^(?:([01]?\d|2[0-3]):([0-5]\d)-([01]?\d|2[0-3]):([0-5]\d);)?(\d+)([KMG]?)$')
+UNITS = {'': 1, 'K': 1024, 'M': 1024**2, 'G': 1024**3}
+DATA_DIR = os.environ.get('BITCALM_DATA_DIR', '/var/lib/bitcalm')
 
 
 class Config:
     DEFAULT_CONF = '/etc/bitcalm.conf'
     COMMENT_SYMBOL = '#'
     REQUIRED = ('uuid',)
-    ALLOWED = ('uuid', 'host', 'port', 'database', 'https')
+    ALLOWED = ('uuid', 'host', 'port', 'database', 'https', 'bandwidth',
+               'profile', 'profile_upload')
     VALIDATOR = {'uuid': re.compile('^[0-9A-Fa-f]{8}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{4}-[0-9A-Fa-f]{12}$'),
-                 'database': DB_RE}
+                 'database': DB_RE,
+                 'bandwidth': BANDWIDTH_RE,
+                 'profile': re.compile('^(off|cprofile|sample)$')}
     ENTRY = {'host': {'default': 'bitcalm.com'},
              'port': {'default': 443, 'type': int},
              'https': {'default': 1, 'type': int},
-             'database': {'default': [], 'multiple': True}}
+             'database': {'default': [], 'multiple': True},
+             'bandwidth': {'default': [], 'multiple': True},
+             'profile': {'default': 'off'},
+             'profile_upload': {'default': 0, 'type': int}}
     
     @staticmethod
     def validate(entry, value):
@@ -67,6 +77,7 @@ class Config:
                       'user': db.group(3),
                       'passwd': db.group(4) or ''}
                 self.database[i] = db
+        self.bandwidth = map(parse_bandwidth, self.bandwidth)
     
     def _parse_config(self, filename):
         with open(filename, 'r') as f:
@@ -92,7 +103,29 @@ class Config:
         return config
 
 
+def parse_bandwidth(value):
+    """ Converts "[HH:MM-HH:MM;]rate[K|M|G]" to a dict with start and end
+        minute of the day and rate in bytes per second.
+    """
+    m = BANDWIDTH_RE.match(value)
+    sh, sm, eh, em, rate, unit = m.groups()
+    if sh is None:
+        start = end = 0
+    else:
+        start = int(sh) * 60 + int(sm)
+        end = int(eh) * 60 + int(em)
+    return {'start': start,
+            'end': end or (0 if start else 24 * 60),
+            'rate': int(rate) * UNITS[unit]}
+
+
 class Status(object):
+    """ Client state persisted as a pickled snapshot plus a journal.
+        save() appends changed options to the journal at most once per
+        SAVE_PERIOD; sync() atomically replaces the snapshot.
+        Options are pickled holding lock, threads hold it as well while
+        changing dicts, lists and schedules of the options in place.
+    """
     OPTIONS = ('key',
                'is_registered',
                'schedules',
@@ -102,24 +135,42 @@ class Status(object):
                'last_ver_check',
                'upload_dirs',
                'last_fs_upload',
-               'system_info')
+               'system_info',
+               'binlog',
+               'uploads',
+               'manifest')
     DEFAULT = {'schedules': [],
                'database': [],
-               'upload_dirs': []}
+               'upload_dirs': [],
+               'binlog': {},
+               'uploads': {},
+               'manifest': {}}
+    SAVE_PERIOD = 30
+    JOURNAL_LIMIT = 1000
     
     def __init__(self, path, **kwargs):
         self.path = path
+        self.journal = path + '.journal'
         with open(self.path, 'r') as f:
             data = pickle.load(f)
-            if 'key' not in data:
-                data['key'] = kwargs.get('key', str(uuid4()))
-                with open(self.path, 'w') as f:
-                    pickle.dump(data, f)
+        self._generation = data.get('_generation', 0)
+        records = self._replay(data)
+        need_sync = bool(records)
+        if 'key' not in data:
+            data['key'] = kwargs.get('key', str(uuid4()))
+            need_sync = True
         for option in Status.OPTIONS:
             setattr(self,
                     option,
                     data.get(option, kwargs.get(option) \
                                         or Status.DEFAULT.get(option)))
+        self._saved = self._dump_options()
+        self._records = 0
+        self._flushed = time.time()
+        self._dirty = False
+        self.lock = threading.RLock()
+        if need_sync:
+            self.sync()
         self.backupdb = BackupData(os.path.join(DATA_DIR, 'backup.db'))
 
     def get_files(self):
@@ -140,12 +191,88 @@ class Status(object):
             return False
         return self.last_ver_check + timedelta(minutes=10) > datetime.now()
 
-    def save(self):
-        data = {}
-        for opt in Status.OPTIONS:
-            data[opt] = getattr(self, opt, None)
-        with open(self.path, 'w') as f:
-            pickle.dump(data, f)
+    def _dump_options(self):
+        return dict((opt, pickle.dumps(getattr(self, opt, None),
+                                       pickle.HIGHEST_PROTOCOL))
+                    for opt in Status.OPTIONS)
+
+    def _replay(self, data):
+        """ Applies journal records of the current snapshot to data.
+            A torn last record is ignored.
+        """
+        if not os.path.exists(self.journal):
+            return 0
+        records = 0
+        with open(self.journal, 'rb') as f:
+            try:
+                if pickle.load(f) != self._generation:
+                    return 0
+                while True:
+                    option, value = pickle.load(f)
+                    data[option] = pickle.loads(value)
+                    records += 1
+            except Exception:
+                pass
+        return records
+
+    def save(self, force=False):
+        """ Marks status as changed. The changes are written to the journal
+            when SAVE_PERIOD has passed since the last write or if force.
+        """
+        with self.lock:
+            self._dirty = True
+            if force or time.time() - self._flushed >= self.SAVE_PERIOD:
+                self.flush()
+
+    def flush(self):
+        """ Appends changed options to the journal
+        """
+        with self.lock:
+            if not self._dirty:
+                return
+            if not os.path.exists(self.journal):
+                return self.sync()
+            options = self._dump_options()
+            changed = [opt for opt in Status.OPTIONS
+                       if options[opt] != self._saved.get(opt)]
+            if self._records + len(changed) > Status.JOURNAL_LIMIT:
+                return self.sync()
+            if changed:
+                with open(self.journal, 'ab') as f:
+                    for opt in changed:
+                        pickle.dump((opt, options[opt]), f,
+                                    pickle.HIGHEST_PROTOCOL)
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._records += len(changed)
+            self._saved = options
+            self._flushed = time.time()
+            self._dirty = False
+
+    def sync(self):
+        """ Atomically replaces the snapshot with the current status
+            and starts a new journal.
+        """
+        with self.lock:
+            data = {'_generation': self._generation + 1}
+            for opt in Status.OPTIONS:
+                data[opt] = getattr(self, opt, None)
+            write_atomic(self.path, data)
+            write_atomic(self.journal, data['_generation'])
+            self._generation = data['_generation']
+            self._saved = self._dump_options()
+            self._records = 0
+            self._flushed = time.time()
+            self._dirty = False
+
+
+def write_atomic(path, obj):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
 
 
 def connect(func):
@@ -161,62 +288,196 @@ def connect(func):
 
 
 class BackupData(object):
+    """ Manifest of backed up files. Paths are split into a directory
+        with the trailing separator, kept once in the dir table, and
+        a name. The schema version is
+        kept in user_version, databases of older versions are migrated
+        when opened.
+    """
+    VERSION = 2
 
     class QUERY:
-        _TABLE_NAME = 'backup'
-        _COLUMNS = ('path TEXT PRIMARY KEY',
-                    'hash_key INTEGER default 0',
+        _COLUMNS = ('hash_key INTEGER default 0',
                     'mtime FLOAT',
                     'size INTEGER',
                     'mode INTEGER',
                     'uid INTEGER',
                     'gid INTEGER',
                     'compress INTEGER default 1', # was compressed while performing backup
-                    'backup_id INTEGER')
+                    'backup_id INTEGER',
+                    'pack TEXT', # name of pack object holding the file
+                    'offset INTEGER', # of the file in the pack
+                    'length INTEGER',
+                    'ref TEXT', # key of object with the same content
+                    'link TEXT', # path of a hardlink to the same file
+                    'extents TEXT') # json [[offset, length], ...] of data
+                                    # of a sparse file, the object has
+                                    # only the data
+        _NAMES = [c.split(' ', 1)[0] for c in _COLUMNS]
         _BACKUP_LIMIT = """ WHERE backup_id <= ?"""
-        DROP = """DROP TABLE IF EXISTS %s""" % _TABLE_NAME
-        CREATE = """CREATE TABLE %s (%s)""" % (_TABLE_NAME,
-                                               ', '.join(_COLUMNS))
-        GET_ROW = """SELECT mtime, size FROM %s WHERE path=?""" % _TABLE_NAME
-        INSERT = """INSERT OR REPLACE INTO %s (%s) VALUES(%s)"""
-        INSERT = INSERT % (_TABLE_NAME,
-                           ', '.join([c.split(' ', 1)[0] for c in _COLUMNS]),
-                           ','.join('?'*len(_COLUMNS)))
-        COUNT = """SELECT COUNT(*) FROM %s""" % _TABLE_NAME
+        DROP = ("""DROP TABLE IF EXISTS file""",
+                """DROP TABLE IF EXISTS dir""")
+        CREATE = ("""CREATE TABLE IF NOT EXISTS dir (
+                         id INTEGER PRIMARY KEY, path TEXT UNIQUE)""",
+                  """CREATE TABLE IF NOT EXISTS file (
+                         id INTEGER PRIMARY KEY,
+                         dir INTEGER, name TEXT, %s,
+                         UNIQUE (dir, name))""" % ', '.join(_COLUMNS),
+                  """CREATE INDEX IF NOT EXISTS file_backup
+                         ON file (backup_id)""")
+        DIR_GET = """SELECT id FROM dir WHERE path=?"""
+        DIR_INSERT = """INSERT INTO dir (path) VALUES (?)"""
+        GET_ROW = """SELECT mtime, size, backup_id FROM file
+                     WHERE dir=(SELECT id FROM dir WHERE path=?)
+                     AND name=?"""
+        INSERT = """INSERT OR REPLACE INTO file (dir, name, %s)
+                    VALUES (%s)""" % (', '.join(_NAMES),
+                                      ','.join('?' * (len(_NAMES) + 2)))
+        COUNT = """SELECT COUNT(*) FROM file"""
         COUNT_BACKUP = COUNT + _BACKUP_LIMIT
-        FILES_ALL = """SELECT path, backup_id, hash_key, compress FROM backup"""
+        FILES_ALL = """SELECT d.path || f.name, f.backup_id, f.hash_key,
+                              f.compress, f.pack, f.offset, f.length,
+                              f.ref, f.link, f.size, f.extents
+                       FROM file f JOIN dir d ON f.dir=d.id"""
         FILES = FILES_ALL + _BACKUP_LIMIT
+        # rows of backups made after the given one
+        CHANGES = """SELECT d.path || f.name, %s
+                     FROM file f JOIN dir d ON f.dir=d.id
+                     WHERE f.backup_id > ?""" % ', '.join('f.' + n
+                                                          for n in _NAMES)
+        # uploaded objects by sha of the content of files
+        CONTENT_DROP = """DROP TABLE IF EXISTS content"""
+        CONTENT_CREATE = """CREATE TABLE IF NOT EXISTS content (
+                                hash TEXT PRIMARY KEY, size INTEGER,
+                                key TEXT, compress INTEGER,
+                                offset INTEGER, length INTEGER,
+                                backup_id INTEGER)"""
+        CONTENT_INDEX = ("""CREATE INDEX IF NOT EXISTS content_size
+                                ON content (size)""",
+                         """CREATE INDEX IF NOT EXISTS content_backup
+                                ON content (backup_id)""")
+        CONTENT_GET = """SELECT key, compress, offset, length
+                         FROM content WHERE hash=?"""
+        CONTENT_SIZE = """SELECT 1 FROM content WHERE size=? LIMIT 1"""
+        CONTENT_KEY = """SELECT 1 FROM content WHERE key=? LIMIT 1"""
+        CONTENT_INSERT = """INSERT OR REPLACE INTO content
+                            VALUES (?, ?, ?, ?, ?, ?, ?)"""
+        CONTENT_CHANGES = """SELECT * FROM content WHERE backup_id > ?"""
+        # version 0, a row with the full path for every file
+        LEGACY_TABLE = 'backup'
+        LEGACY_DEFAULTS = {'hash_key': '0', 'compress': '1'}
 
     def __init__(self, dbpath):
         self.db = dbpath
         if not os.path.exists(self.db):
             self.clean()
         else:
-            conn, cur = self._connect()
-            for n in (1, 7):
-                query = """ALTER TABLE %s ADD COLUMN %s""" \
-                            % (self.QUERY._TABLE_NAME, self.QUERY._COLUMNS[n])
-                try:
-                    cur.execute(query)
-                except sqlite3.OperationalError:
-                    pass
-            cur.close()
-            conn.close()
+            self.migrate()
 
     def _connect(self):
         conn = sqlite3.connect(self.db)
         conn.text_factory = str
         return conn, conn.cursor()
 
+    def _create(self, cur):
+        for query in self.QUERY.CREATE:
+            cur.execute(query)
+        cur.execute(self.QUERY.CONTENT_CREATE)
+        for query in self.QUERY.CONTENT_INDEX:
+            cur.execute(query)
+        cur.execute('PRAGMA user_version = %i' % self.VERSION)
+
     @connect
     def clean(self, conn, cur):
-        cur.execute(self.QUERY.DROP)
-        cur.execute(self.QUERY.CREATE)
+        for query in self.QUERY.DROP:
+            cur.execute(query)
+        cur.execute(self.QUERY.CONTENT_DROP)
+        self._create(cur)
         conn.commit()
 
+    def migrate(self):
+        """ Brings the database to VERSION, it may be replaced by a
+            manifest of an older client
+        """
+        conn, cur = self._connect()
+        cur.execute('PRAGMA user_version')
+        version = cur.fetchone()[0]
+        if version < 1:
+            self._split_paths(conn, cur)
+        if version < 2:
+            self._content_backup(cur)
+        if version < self.VERSION:
+            self._create(cur)
+            conn.commit()
+        if version < 1:
+            # space of the dropped table is returned to the filesystem
+            conn.execute('VACUUM')
+        cur.close()
+        conn.close()
+
+    def _split_paths(self, conn, cur, batch=10000):
+        """ Moves rows of the version 0 table to dir and file tables
+        """
+        cur.execute("""SELECT name FROM sqlite_master
+                       WHERE type='table' AND name=?""",
+                    (self.QUERY.LEGACY_TABLE,))
+        if not cur.fetchone():
+            return
+        for query in self.QUERY.CREATE:
+            cur.execute(query)
+        cur.execute('PRAGMA table_info(%s)' % self.QUERY.LEGACY_TABLE)
+        existing = set(row[1] for row in cur.fetchall())
+        # columns added by later versions may be missing
+        columns = [c if c in existing
+                   else self.QUERY.LEGACY_DEFAULTS.get(c, 'NULL')
+                   for c in self.QUERY._NAMES]
+        rows = conn.cursor()
+        rows.execute('SELECT path, %s FROM %s' % (', '.join(columns),
+                                                 self.QUERY.LEGACY_TABLE))
+        while True:
+            chunk = rows.fetchmany(batch)
+            if not chunk:
+                break
+            self._insert(cur, chunk)
+        rows.close()
+        cur.execute('DROP TABLE %s' % self.QUERY.LEGACY_TABLE)
+        conn.commit()
+
+    @staticmethod
+    def _split(path):
+        dirname, name = os.path.split(path)
+        return os.path.join(dirname, ''), name
+
+    def _content_backup(self, cur):
+        """ Adds backup_id to content of version 1, objects uploaded
+            before are in manifests uploaded whole
+        """
+        cur.execute('PRAGMA table_info(content)')
+        columns = [row[1] for row in cur.fetchall()]
+        if columns and 'backup_id' not in columns:
+            cur.execute('ALTER TABLE content ADD COLUMN backup_id INTEGER')
+
+    def _insert(self, cur, rows):
+        dirs = {}
+        values = []
+        for row in rows:
+            dirname, name = self._split(row[0])
+            dir_id = dirs.get(dirname)
+            if dir_id is None:
+                cur.execute(self.QUERY.DIR_GET, (dirname,))
+                found = cur.fetchone()
+                if found:
+                    dir_id = found[0]
+                else:
+                    cur.execute(self.QUERY.DIR_INSERT, (dirname,))
+                    dir_id = cur.lastrowid
+                dirs[dirname] = dir_id
+            values.append((dir_id, name) + tuple(row[1:]))
+        cur.executemany(self.QUERY.INSERT, values)
+
     @connect
     def get(self, path, conn, cur):
-        cur.execute(self.QUERY.GET_ROW, (path,))
+        cur.execute(self.QUERY.GET_ROW, self._split(path))
         row = cur.fetchone()
         return row
 
@@ -230,10 +491,57 @@ class BackupData(object):
 
     @connect
     def add(self, rows, conn, cur):
-        if len(rows) > 1:
-            cur.executemany(self.QUERY.INSERT, rows)
-        else:
-            cur.execute(self.QUERY.INSERT, rows[0])
+        self._insert(cur, rows)
+        conn.commit()
+
+    @connect
+    def get_content(self, digest, conn, cur):
+        """ Returns (key, compress, offset, length) of the object
+            with the content
+        """
+        cur.execute(self.QUERY.CONTENT_GET, (digest,))
+        return cur.fetchone()
+
+    @connect
+    def has_content_size(self, size, conn, cur):
+        cur.execute(self.QUERY.CONTENT_SIZE, (size,))
+        return bool(cur.fetchone())
+
+    @connect
+    def has_content_key(self, key, conn, cur):
+        cur.execute(self.QUERY.CONTENT_KEY, (key,))
+        return bool(cur.fetchone())
+
+    @connect
+    def add_content(self, rows, conn, cur):
+        cur.executemany(self.QUERY.CONTENT_INSERT, rows)
+        conn.commit()
+
+    def changes(self, since=0, batch=1000):
+        """ Yields ('file', rows) and ('content', rows) batches of
+            backups made after since, rows are as add takes them
+        """
+        conn, cur = self._connect()
+        for table, query in (('file', self.QUERY.CHANGES),
+                             ('content', self.QUERY.CONTENT_CHANGES)):
+            cur.execute(query, (since,))
+            while True:
+                rows = cur.fetchmany(batch)
+                if not rows:
+                    break
+                yield table, rows
+        cur.close()
+        conn.close()
+
+    @connect
+    def apply(self, changes, conn, cur):
+        """ Adds batches yielded by changes of another manifest
+        """
+        for table, rows in changes:
+            if table == 'file':
+                self._insert(cur, rows)
+            else:
+                cur.executemany(self.QUERY.CONTENT_INSERT, rows)
         conn.commit()
 
     def files(self, backup_id=None, iterator=False, **kwargs):
@@ -1,6 +1,13 @@
+import os
+import shutil
+import pickle
+import sqlite3
+import tempfile
 import unittest
 
-from bitcalm.config.base import DB_RE
+from bitcalm.config import base
+from bitcalm.config.base import (DB_RE, BANDWIDTH_RE, Status, BackupData,
+                                 parse_bandwidth)
 
 
 class DBConfigTest(unittest.TestCase):
@@ -24,5 +31,159 @@ class DBConfigTest(unittest.TestCase):
             self.assertFalse(DB_RE.match(item))
 
 
+class BandwidthConfigTest(unittest.TestCase):
+    def runTest(self):
+        for item in ('0', '512K', '20M', '09:00-18:00;20M', '22:30-6:00;1G'):
+            self.assertTrue(BANDWIDTH_RE.match(item), '%s did not match' % item)
+        for item in ('20MB', '9-18;20M', '24:00-06:00;1M', '09:00-18:00'):
+            self.assertFalse(BANDWIDTH_RE.match(item))
+        self.assertEqual(parse_bandwidth('20M'),
+                         {'start': 0, 'end': 1440, 'rate': 20 * 1024**2})
+        self.assertEqual(parse_bandwidth('22:30-00:00;1K'),
+                         {'start': 1350, 'end': 0, 'rate': 1024})
+
+
+class StatusJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.data_dir, base.DATA_DIR = base.DATA_DIR, self.dir
+        self.path = os.path.join(self.dir, 'data')
+        with open(self.path, 'w') as f:
+            pickle.dump({'key': 'test'}, f)
+
+    def tearDown(self):
+        base.DATA_DIR = self.data_dir
+        shutil.rmtree(self.dir)
+
+    def runTest(self):
+        status = Status(self.path)
+        status.backup = {'backup_id': 1, 'status': 0}
+        status.save()
+        self.assertEqual(Status(self.path).backup, None)
+        status.flush()
+        status.upload_dirs = [2, 1024, 0, -1, ('/usr/lib', 10)]
+        status.save(force=True)
+        with open(status.journal, 'ab') as f:
+            f.write('torn record')
+        restored = Status(self.path)
+        self.assertEqual(restored.backup, status.backup)
+        self.assertEqual(restored.upload_dirs, status.upload_dirs)
+        self.assertEqual(restored.key, 'test')
+        status.backup = None
+        status.sync()
+        self.assertEqual(Status(self.path).backup, None)
+
+
+
+class MigrationTest(unittest.TestCase):
+    """ Opens a manifest of version 0, a row with the full path for every
+        file and hash_key and compress added by ALTER TABLE, so they may
+        be missing.
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'backup.db')
+        conn = sqlite3.connect(self.path)
+        conn.execute("""CREATE TABLE backup (
+                            path TEXT PRIMARY KEY, mtime FLOAT,
+                            size INTEGER, mode INTEGER, uid INTEGER,
+                            gid INTEGER, backup_id INTEGER, pack TEXT,
+                            offset INTEGER, length INTEGER, ref TEXT,
+                            link TEXT, extents TEXT)""")
+        conn.executemany("""INSERT INTO backup VALUES
+                                (?, ?, ?, 33188, 0, 0, ?, ?, ?, ?, NULL,
+                                 NULL, NULL)""",
+                         [('/etc/hosts', 1.5, 10, 1, None, None, None),
+                          ('/etc/passwd', 2.5, 20, 2, 'pack-1', 0, 20),
+                          ('/etc/ssh/sshd_config', 3.5, 30, 2,
+                           'pack-1', 20, 30),
+                          ('/vmlinuz', 4.5, 40, 1, None, None, None)])
+        conn.execute("""CREATE TABLE content (
+                            hash TEXT PRIMARY KEY, size INTEGER, key TEXT,
+                            compress INTEGER, offset INTEGER,
+                            length INTEGER)""")
+        conn.execute("""INSERT INTO content
+                        VALUES ('h', 20, 'pack-1', 1, 0, 20)""")
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def runTest(self):
+        data = BackupData(self.path)
+        conn = sqlite3.connect(self.path)
+        self.assertEqual(conn.execute('PRAGMA user_version').fetchone()[0],
+                         BackupData.VERSION)
+        self.assertEqual(conn.execute("""SELECT name FROM sqlite_master
+                                         WHERE name='backup'""").fetchall(),
+                         [])
+        self.assertEqual(conn.execute("""SELECT path FROM dir
+                                         ORDER BY path""").fetchall(),
+                         [('/',), ('/etc/',), ('/etc/ssh/',)])
+        self.assertEqual(conn.execute("""SELECT d.path, f.name, f.hash_key,
+                                                f.compress, f.backup_id,
+                                                f.pack, f.offset
+                                         FROM file f JOIN dir d
+                                         ON f.dir=d.id
+                                         ORDER BY f.mtime""").fetchall(),
+                         [('/etc/', 'hosts', 0, 1, 1, None, None),
+                          ('/etc/', 'passwd', 0, 1, 2, 'pack-1', 0),
+                          ('/etc/ssh/', 'sshd_config', 0, 1, 2, 'pack-1', 20),
+                          ('/', 'vmlinuz', 0, 1, 1, None, None)])
+        self.assertEqual(conn.execute('SELECT * FROM content').fetchall(),
+                         [('h', 20, 'pack-1', 1, 0, 20, None)])
+        conn.close()
+        self.assertEqual(data.get('/etc/ssh/sshd_config'), (3.5, 30, 2))
+        self.assertEqual(data.count(), 4)
+        self.assertEqual(data.count(backup_id=1), 2)
+        self.assertEqual(data.get_content('h'), ('pack-1', 1, 0, 20))
+        # opening the migrated database again changes nothing
+        BackupData(self.path)
+        self.assertEqual(data.count(), 4)
+
+
+
+def manifest_row(path, backup_id, size=1, pack=None):
+    return (path, 1, 1.5, size, 33188, 0, 0, 1, backup_id, pack, None, None,
+            None, None, None)
+
+
+class ChangesTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.data = BackupData(os.path.join(self.dir, 'backup.db'))
+        self.data.add([manifest_row('/etc/hosts', 1),
+                       manifest_row('/etc/passwd', 1)])
+        self.data.add_content([('h1', 1, 'pack-1', 1, 0, 10, 1)])
+        self.data.add([manifest_row('/etc/hosts', 2, size=2),
+                       manifest_row('/srv/caf\xe9', 2, pack='pack-2'),
+                       manifest_row('/srv/a/b', 3),
+                       manifest_row('/srv/a/c', 3)])
+        self.data.add_content([('h2', 2, 'pack-2', 1, 0, 20, 2),
+                               ('h3', 3, 'pack-3', 0, 0, 30, 3)])
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def runTest(self):
+        changes = list(self.data.changes(since=1, batch=3))
+        self.assertEqual([(table, len(rows)) for table, rows in changes],
+                         [('file', 3), ('file', 1), ('content', 2)])
+        self.assertEqual(sorted(row[0] for table, rows in changes
+                                for row in rows if table == 'file'),
+                         ['/etc/hosts', '/srv/a/b', '/srv/a/c', '/srv/caf\xe9'])
+        self.assertEqual(list(self.data.changes(since=3)), [])
+        other = BackupData(os.path.join(self.dir, 'other.db'))
+        other.add([manifest_row('/etc/hosts', 1),
+                   manifest_row('/etc/passwd', 1)])
+        other.add_content([('h1', 1, 'pack-1', 1, 0, 10, 1)])
+        other.apply(iter(changes))
+        self.assertEqual(sorted(other.files()), sorted(self.data.files()))
+        self.assertEqual(other.get('/etc/hosts'), (1.5, 2, 2))
+        self.assertEqual(other.get_content('h3'), ('pack-3', 0, 0, 30))
+        self.assertEqual(other.count(), 5)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,6 @@
 KB = 1024
 MB = 1024*KB
+GB = 1024*MB
 
 MICROSEC = 1 / 10.0 ** 6
 MIN = 60
@@ -1,14 +1,26 @@
 import os
-import gzip
+import re
+import time
+import errno
+import threading
 import subprocess
 import itertools
 
 import mysql.connector
 
 from bitcalm.config import config, status
+from bitcalm.const import MIN
 
 
 DEFAULT_DB_PORT = 3306
+POOL_SIZE = 2
+POOL_IDLE = 5 * MIN
+DUMP_EXT = '.sql.gz'
+BINLOG_EXT = '.binlog.sql.gz'
+MASTER_DATA_SIZE = 64 * 1024
+MASTER_DATA_RE = re.compile(r"(?:MASTER|SOURCE)_LOG_FILE='([^']+)',\s*"
+                            r"(?:MASTER|SOURCE)_LOG_POS=(\d+)")
+DUMP_NAME_RE = re.compile(r'^(.+?)_(\d+)_(.+)_(\d{4}\.\d{2}\.\d{2}_\d{4})(\..+)$')
 EXCLUDE_DB = set(('information_schema',
                   'performance_schema',
                   'cond_instances',
@@ -18,30 +30,118 @@ EXCLUDE_DB = set(('information_schema',
                   'socket_instances'))
 
 
+class ConnectionPool(object):
+    """ Keeps up to size idle connections per (host, port, user).
+        Connections idle longer than idle seconds are closed,
+        others are pinged before reuse.
+    """
+    def __init__(self, size=POOL_SIZE, idle=POOL_IDLE):
+        self.size = size
+        self.idle = idle
+        self._conns = {}
+        self._lock = threading.Lock()
+
+    def _key(self, kwargs):
+        return (kwargs.get('host', 'localhost'),
+                int(kwargs.get('port', DEFAULT_DB_PORT)),
+                kwargs.get('user'))
+
+    def discard(self, conn):
+        try:
+            conn.close()
+        except mysql.connector.errors.Error:
+            pass
+
+    def expire(self):
+        expired = []
+        now = time.time()
+        with self._lock:
+            for conns in self._conns.itervalues():
+                while conns and now - conns[0][2] >= self.idle:
+                    expired.append(conns.pop(0)[0])
+        for conn in expired:
+            self.discard(conn)
+
+    def get(self, **kwargs):
+        """ Returns a healthy connection, raises mysql.connector.Error
+            if it can not be opened
+        """
+        kwargs['password'] = kwargs.pop('passwd', kwargs.get('password', ''))
+        self.expire()
+        key = self._key(kwargs)
+        while True:
+            with self._lock:
+                conns = self._conns.get(key)
+                if not conns:
+                    break
+                conn, password, used = conns.pop()
+            if password == kwargs['password'] and conn.is_connected():
+                return conn
+            self.discard(conn)
+        kwargs['autocommit'] = True
+        conn = mysql.connector.connect(**kwargs)
+        conn._pool_key = key, kwargs['password']
+        return conn
+
+    def put(self, conn):
+        key, password = conn._pool_key
+        with self._lock:
+            conns = self._conns.setdefault(key, [])
+            if len(conns) < self.size:
+                conns.append((conn, password, time.time()))
+                conn = None
+        if conn is not None:
+            self.discard(conn)
+        # pools of hosts which are not used anymore are expired here too
+        self.expire()
+
+    def clear(self):
+        with self._lock:
+            conns = [c[0] for cs in self._conns.itervalues() for c in cs]
+            self._conns.clear()
+        for conn in conns:
+            self.discard(conn)
+
+
+pool = ConnectionPool()
+
+
 def connection_error(**kwargs):
     try:
-        mysql.connector.connect(**kwargs)
+        pool.put(pool.get(**kwargs))
     except mysql.connector.errors.Error as err:
         return err.errno
     return 0
 
 
 def get_cursor(**kwargs):
-    kwargs['password'] = kwargs.pop('passwd')
     return MySQLContextManager(**kwargs)
 
 
 class MySQLContextManager(object):
+    """ Borrows a connection from the pool; the connection is returned
+        unless the block failed with a database error
+    """
     def __init__(self, **kwargs):
-        self.conn = mysql.connector.connect(**kwargs)
-        self.cur = self.conn.cursor()
+        self.conn = pool.get(**kwargs)
+        try:
+            self.cur = self.conn.cursor(buffered=True)
+        except:
+            pool.discard(self.conn)
+            raise
 
     def __enter__(self):
         return self.cur
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.conn.close()
-        self.cur.close()
+        try:
+            self.cur.close()
+        except mysql.connector.errors.Error:
+            pass
+        if exc_type and issubclass(exc_type, mysql.connector.errors.Error):
+            pool.discard(self.conn)
+        else:
+            pool.put(self.conn)
 
 
 def _make_args(util='mysql', **kwargs):
@@ -60,8 +160,17 @@ def get_databases(user, passwd='', host='localhost', port=3306):
         return [name for name, in cur.fetchall() if name not in EXCLUDE_DB]
 
 
+def get_sizes(user, passwd='', host='localhost', port=3306):
+    """ Returns estimated size of databases in bytes
+    """
+    with get_cursor(**vars()) as cur:
+        cur.execute('SELECT table_schema, SUM(data_length + index_length) '
+                    'FROM information_schema.tables GROUP BY table_schema;')
+        return dict((name, int(size or 0)) for name, size in cur.fetchall())
+
+
 def is_database_exists(name, host, user, passwd='', port=3306):
-    return name in get_databases(host, user, passwd, port)
+    return name in get_databases(user, passwd, host, port)
 
 
 def get_credentials(host, port):
@@ -71,33 +180,125 @@ def get_credentials(host, port):
     return None
 
 
+def parse_dump_name(filename):
+    """ Returns host, port, database name and extension of dump named
+        as host_port_name_YYYY.MM.DD_HHMM.ext
+    """
+    m = DUMP_NAME_RE.match(os.path.basename(filename))
+    if not m:
+        raise ValueError('Wrong dump name: %s' % filename)
+    host, port, name, ts, ext = m.groups()
+    return host, int(port), name, ext
+
+
 def import_db(dump, user, host='', passwd='', port=None, name=''):
     if not (host and port and name):
-        dhost, dport, dname = os.path.basename(dump).split('_', 3)[:3]
+        dhost, dport, dname = parse_dump_name(dump)[:3]
         host = host or dhost
         port = port or dport
         name = name or dname
     if not is_database_exists(name, host, user, passwd, port):
         return False
+    args = _make_args(util='mysql', host=host, port=port,
+                      user=user, passwd=passwd, name=name)
     try:
-        subprocess.check_call(('mysql',
-                               '-u', user,
-                               '-p%s' % passwd,
-                               name),
-                              stdin=open(dump))
+        with open(dump) as f:
+            subprocess.check_call(args, stdin=f)
     except subprocess.CalledProcessError:
         return False
     return True
 
 
-def dump_db(name, host, user, path, passwd='', port=3306):
-    kwargs = vars()
-    del kwargs['path']
-    dump = subprocess.Popen(_make_args(util='mysqldump', **kwargs),
-                            stdout=subprocess.PIPE)
-    if dump.poll():
+def import_stream(chunks, user, host, passwd='', port=3306, name=''):
+    """ Feeds chunks of SQL to mysql as they come
+    """
+    if not is_database_exists(name, host, user, passwd, port):
         return False
-    gz = gzip.open(path, 'wb')
-    gz.write(dump.stdout.read())
-    gz.close()
-    return True
+    args = _make_args(util='mysql', host=host, port=port,
+                      user=user, passwd=passwd, name=name)
+    proc = subprocess.Popen(args, stdin=subprocess.PIPE)
+    try:
+        for chunk in chunks:
+            proc.stdin.write(chunk)
+    except IOError, e:
+        # mysql exited early, its status tells the result
+        if e.errno != errno.EPIPE:
+            proc.kill()
+            raise
+    except:
+        proc.kill()
+        raise
+    finally:
+        try:
+            proc.stdin.close()
+        except IOError:
+            pass
+    return proc.wait() == 0
+
+
+def dump_db(name, host, user, passwd='', port=3306, master_data=False):
+    """ Starts mysqldump, the dump is read from stdout of the returned process.
+        With master_data the dump starts with commented out binary log
+        position of the snapshot.
+    """
+    args = _make_args(util='mysqldump', name=name, host=host, user=user,
+                      passwd=passwd, port=port)
+    args[1:1] = ('--single-transaction', '--quick')
+    if master_data:
+        args.insert(1, '--master-data=2')
+    return subprocess.Popen(args, stdout=subprocess.PIPE)
+
+
+def get_binlog_position(user, passwd='', host='localhost', port=3306):
+    """ Returns current binary log file and position
+        or None if binary logging is disabled
+    """
+    with get_cursor(**vars()) as cur:
+        cur.execute('SHOW MASTER STATUS;')
+        row = cur.fetchone()
+        return (row[0], int(row[1])) if row else None
+
+
+def get_binlogs(user, passwd='', host='localhost', port=3306):
+    with get_cursor(**vars()) as cur:
+        cur.execute('SHOW BINARY LOGS;')
+        return [row[0] for row in cur.fetchall()]
+
+
+def dump_binlog(name, host, user, passwd='', port=3306, start=None, stop=None):
+    """ Starts mysqlbinlog reading events of database from start to stop
+        binary log positions, the SQL is read from stdout of the returned
+        process. Returns None if the start log is already purged.
+    """
+    logs = get_binlogs(user, passwd, host, port)
+    if start[0] not in logs or stop[0] not in logs:
+        return None
+    logs = logs[logs.index(start[0]):logs.index(stop[0]) + 1]
+    args = _make_args(util='mysqlbinlog', host=host, port=port,
+                      user=user, passwd=passwd)
+    args.extend(('--read-from-remote-server',
+                 '--database=%s' % name,
+                 '--start-position=%i' % start[1],
+                 '--stop-position=%i' % stop[1]))
+    args.extend(logs)
+    return subprocess.Popen(args, stdout=subprocess.PIPE)
+
+
+class BinlogPositionReader(object):
+    """ Wraps stdout of mysqldump --master-data=2 and finds
+        the binary log position in the head of the dump
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.head = ''
+        self.position = None
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        if self.position is None and len(self.head) < MASTER_DATA_SIZE:
+            self.head += data
+            m = MASTER_DATA_RE.search(self.head)
+            if m:
+                self.position = (m.group(1), int(m.group(2)))
+                self.head = ''
+        return data
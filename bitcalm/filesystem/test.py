@@ -0,0 +1,179 @@
+import os
+import shutil
+import pickle
+import tempfile
+import unittest
+
+from bitcalm.filesystem.utils import levelwalk, iterfiles, extents
+
+
+class LevelwalkBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        self.spool = tempfile.mkdtemp()
+        for i in range(5):
+            for j in range(4):
+                path = os.path.join(self.top, 'd%i' % i, 's%i' % j)
+                os.makedirs(path)
+                for k in range(3):
+                    open(os.path.join(path, 'f%i' % k), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+        shutil.rmtree(self.spool)
+
+    def walk(self, **kwargs):
+        return [entry for level, has_next, cursor in levelwalk(**kwargs)
+                      for entry in level]
+
+    def names(self, entries):
+        return sorted((path, name) for path, dirs, files in entries
+                                   for name in dirs + files)
+
+    def runTest(self):
+        full = self.walk(top=self.top)
+        self.assertEqual(len(full), 1 + 5 + 20)
+
+        walk = levelwalk(top=self.top, spool=self.spool, batch=7)
+        batches = []
+        for level, has_next, cursor in walk:
+            self.assertTrue(sum(1 + len(d) + len(f) for p, d, f in level) <= 7 + 5)
+            batches.append(level)
+            if len(batches) == 3:
+                break
+        # the next batch was not sent, the walk is resumed from the cursor
+        next(walk)
+        walk.close()
+        rest = self.walk(top=self.top, spool=self.spool, cursor=cursor,
+                         batch=7)
+        walked = [entry for level in batches for entry in level] + rest
+        self.assertEqual(self.names(walked), self.names(full))
+        self.assertEqual(os.listdir(self.spool), [])
+
+
+class LevelwalkSplitTest(LevelwalkBatchTest):
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        self.spool = tempfile.mkdtemp()
+        self.big = os.path.join(self.top, 'maildir')
+        os.makedirs(os.path.join(self.big, 'sub'))
+        for i in range(30):
+            open(os.path.join(self.big, 'm%02i' % i), 'w').close()
+
+    def runTest(self):
+        full = self.walk(top=self.top)
+        batches = []
+        cursors = []
+        walk = levelwalk(top=self.top, spool=self.spool, batch=7)
+        for level, has_next, cursor in walk:
+            self.assertTrue(sum(1 + len(d) + len(f)
+                                for p, d, f in level) <= 8)
+            batches.append(level)
+            cursors.append(cursor)
+            if len(batches) == 2:
+                break
+        walk.close()
+        # resume in the middle of the maildir listing
+        partial = cursors[1][-1]
+        self.assertEqual(partial[0], self.big)
+        rest = self.walk(top=self.top, spool=self.spool, cursor=cursors[1],
+                         batch=7)
+        walked = [e for l in batches for e in l] + rest
+        self.assertEqual(self.names(walked), self.names(full))
+
+
+class LevelwalkWideTest(unittest.TestCase):
+    """ Cursors of a wide tree do not grow with its width
+    """
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        self.spool = tempfile.mkdtemp()
+        for i in range(300):
+            for j in range(2):
+                os.makedirs(os.path.join(self.top, 'd%03i' % i, 's%i' % j))
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+        shutil.rmtree(self.spool)
+
+    def runTest(self):
+        longest = len(os.path.join(self.top, 'd000', 's0'))
+        sizes = []
+        batches = 0
+        for level, has_next, cursor in levelwalk(top=self.top,
+                                                 spool=self.spool, batch=50):
+            batches += 1
+            sizes.append(len(pickle.dumps(list(cursor),
+                                          pickle.HIGHEST_PROTOCOL)))
+        self.assertTrue(batches > 10)
+        self.assertTrue(max(sizes) < longest + 64, sizes)
+
+
+class IterfilesCursorTest(unittest.TestCase):
+    def setUp(self):
+        self.top = tempfile.mkdtemp()
+        self.other = tempfile.mkstemp()[1]
+        for i in range(3):
+            for j in range(3):
+                path = os.path.join(self.top, 'd%i' % i, 's%i' % j)
+                os.makedirs(path)
+                for k in range(4):
+                    open(os.path.join(path, 'f%i' % k), 'w').close()
+        os.symlink(self.top, os.path.join(self.top, 'link'))
+
+    def tearDown(self):
+        shutil.rmtree(self.top)
+        os.remove(self.other)
+
+    def runTest(self):
+        full = list(iterfiles(files=[self.other], dirs=[self.top]))
+        self.assertEqual(len(full), 1 + 3 * 3 * 4)
+        self.assertEqual(len(set(full)), len(full))
+
+        checkpoints = []
+        walk = iterfiles(files=[self.other], dirs=[self.top],
+                         checkpoint=checkpoints.append)
+        walk.period = 0
+        walked = []
+        for filename in walk:
+            walked.append(filename)
+            if len(walked) == 20:
+                break
+        self.assertTrue(checkpoints)
+        rest = list(iterfiles(files=[self.other], dirs=[self.top],
+                              cursor=walk.cursor))
+        self.assertEqual(walked + rest, full)
+
+        # a directory removed after the checkpoint is skipped
+        cursor = checkpoints[-1]
+        shutil.rmtree(cursor[-1][0])
+        rest = list(iterfiles(files=[self.other], dirs=[self.top],
+                              cursor=cursor))
+        self.assertEqual(rest, [f for f in full[19:] if os.path.exists(f)])
+
+
+class ExtentsTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkstemp()[1]
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def runTest(self):
+        block = 1024 * 1024
+        with open(self.path, 'wb') as f:
+            f.write('x' * block)
+        self.assertEqual(extents(self.path), None)
+        with open(self.path, 'r+b') as f:
+            f.seek(4 * block)
+            f.write('y' * block)
+            f.truncate(8 * block)
+        result = extents(self.path)
+        if result is None:
+            # the filesystem does not report holes
+            return
+        self.assertEqual(result, [(0, block), (4 * block, block)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,25 @@
 import os
 import sys
+import time
+import errno
+import shutil
+import tempfile
+from bisect import bisect_right
 
-
+from bitcalm import metrics
 from bitcalm.const import IGNORE_DIRS
 
 
 FS_ENCODING = sys.getfilesystemencoding()
+LEVEL_BATCH = 50000
+# lseek whence values of Linux, os has no constants for them in python 2
+SEEK_DATA = 3
+SEEK_HOLE = 4
+CHECKPOINT_PERIOD = 30
+WALK = metrics.histogram('walk_seconds', 'Listing of a directory')
+STAT = metrics.histogram('stat_seconds', 'stat() of a file')
+LOOKUP = metrics.histogram('manifest_lookup_seconds',
+                           'Search of a file in the manifest')
 
 
 def ls(path):
@@ -38,68 +52,281 @@ def count_links(parent, items):
     return links
 
 
-def levelwalk(top='/', depth=-1, start=None):
+def _spool_path(spool, level):
+    return os.path.join(spool, 'level%i' % level)
+
+
+def _read_spool(path, offset, block=64 * 1024):
+    """ Yields (directory, offset right after it) of a spool file
+        starting at offset
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        rest = ''
+        while True:
+            data = f.read(block)
+            if not data:
+                break
+            entries = (rest + data).split('\0')
+            rest = entries.pop()
+            for entry in entries:
+                offset += len(entry) + 1
+                yield entry, offset
+
+
+def _open_spool(spool, level, size):
+    """ Opens the spool file of a level for appending, drops entries
+        written after size
+    """
+    path = _spool_path(spool, level)
+    f = open(path, 'ab')
+    if os.fstat(f.fileno()).st_size > size:
+        f.truncate(size)
+    return f
+
+
+def _spool_dirs(f, parent, dirs):
+    for d in sorted(dirs):
+        if not islink(parent, d):
+            f.write(os.path.join(parent, d) + '\0')
+
+
+def _sync(f):
+    f.flush()
+    os.fsync(f.fileno())
+    return os.fstat(f.fileno()).st_size
+
+
+def _clean_spool(spool):
+    for name in os.listdir(spool):
+        os.remove(os.path.join(spool, name))
+
+
+def levelwalk(top='/', depth=-1, spool=None, cursor=None, batch=LEVEL_BATCH):
+    """ Walks the tree level by level.
+        Yields (entries, has_next, cursor). A level is split into batches
+        of about `batch` names; a directory listing longer than that is
+        split into several entries of the same path, names are taken in
+        sorted order. Directories of the level being walked and of the
+        next one are kept in files of the spool directory, a temporary
+        one if it is not given, so memory does not grow with the width
+        of the tree. cursor is (level, offset, size, depth, partial) to
+        resume the walk right after the yielded batch: offset in the
+        file of the level, size of the file of the next level and
+        (path, offset) of the directory listing sent in part or None.
+    """
     if not depth:
         raise ValueError('Wrong depth')
-    if start:
-        items = start
-    elif top == '/':
-        cdirs, cfiles = ls(top)
-        cdirs = [p for p in cdirs if p not in IGNORE_DIRS]
-        depth -= 1
-        yield ([(top, cdirs, cfiles)],
-               bool(count_links(top, cdirs) != len(cdirs) and depth))
-        items = [(top, cdirs)]
+    temporary = spool is None
+    if temporary:
+        spool = tempfile.mkdtemp()
+    elif not os.path.isdir(spool):
+        os.makedirs(spool)
+    try:
+        for item in _levelwalk(top, depth, spool, cursor, batch):
+            yield item
+    finally:
+        if temporary:
+            shutil.rmtree(spool, ignore_errors=True)
+
+
+def _levelwalk(top, depth, spool, cursor, batch):
+    if cursor:
+        level, offset, size, depth, partial = cursor
     else:
-        items = [(os.path.dirname(top), [os.path.basename(top)])]
-    while items and depth:
-        next_items = []
-        level = []
-        while items:
-            parent, dirs = items.pop()
-            dirs = exclude_links(parent, dirs)
-            for d in dirs:
-                path = os.path.join(parent, d)
+        _clean_spool(spool)
+        level = offset = size = 0
+        partial = None
+        if top == '/':
+            cdirs, cfiles = ls(top)
+            cdirs = [p for p in cdirs if p not in IGNORE_DIRS]
+            depth -= 1
+            level = 1
+            with _open_spool(spool, level, 0) as f:
+                _spool_dirs(f, top, cdirs)
+                has_next = bool(_sync(f) and depth)
+            yield [(top, cdirs, cfiles)], has_next, (level, 0, 0, depth, None)
+            if not has_next:
+                _clean_spool(spool)
+                return
+        else:
+            with _open_spool(spool, level, 0) as f:
+                f.write(top + '\0')
+    while depth:
+        current = _spool_path(spool, level)
+        dirs = _read_spool(current, offset)
+        entries = []
+        count = 0
+        with _open_spool(spool, level + 1, size) as next_level:
+            while True:
+                if partial:
+                    path, start = partial
+                    partial = None
+                else:
+                    item = next(dirs, None)
+                    if item is None:
+                        break
+                    path, offset = item
+                    start = 0
                 cdirs, cfiles = ls(path)
                 if not (cdirs or cfiles):
                     continue
-                if count_links(parent, cdirs) != len(cdirs):
-                    next_items.append((path, cdirs))
-                level.append((path, cdirs, cfiles))
+                if not start:
+                    _spool_dirs(next_level, path, cdirs)
+                names = sorted(cdirs) + sorted(cfiles)
+                ndirs = len(cdirs)
+                while start < len(names):
+                    end = start + max(batch - count - 1, 1)
+                    entries.append((path, names[start:min(end, ndirs)],
+                                    names[max(start, ndirs):end]))
+                    count += 1 + len(names[start:end])
+                    start = end
+                    if count >= batch:
+                        rest = (path, start) if start < len(names) else None
+                        yield entries, True, (level, offset,
+                                              _sync(next_level), depth, rest)
+                        entries = []
+                        count = 0
+            has_next = bool(_sync(next_level))
         depth -= 1
-        yield level, bool(next_items and depth)
-        items = next_items
+        level += 1
+        offset = size = 0
+        yield entries, bool(has_next and depth), (level, 0, 0, depth, None)
+        # the cursor past the level is saved by now
+        if os.path.exists(current):
+            os.remove(current)
+        if not has_next:
+            break
+    _clean_spool(spool)
 
 
-def iterfiles(files=None, dirs=None):
-    files = [f.encode(FS_ENCODING) for f in files] if files else []
-    dirs = [d.encode(FS_ENCODING) for d in dirs] if dirs else []
-    while files or dirs:
-        while files:
-            yield files.pop()
-        if not dirs:
-            break
-        path = dirs.pop()
+class FileWalk(object):
+    """ Walks files and dirs depth-first in sorted order, yields files.
+        cursor is [[path, name], ...], the stack of directories being
+        walked (path is None for the files and dirs given) with the last
+        name taken from each. A walk started with a cursor continues
+        right after it. checkpoint, if set, is called with the cursor
+        every period seconds when the consumer is done with all files
+        up to it.
+    """
+    def __init__(self, files=None, dirs=None, cursor=None, checkpoint=None,
+                 period=CHECKPOINT_PERIOD):
+        roots = list(files or []) + list(dirs or [])
+        self.roots = sorted(set(p.encode(FS_ENCODING) for p in roots))
+        self.start = cursor
+        self.checkpoint = checkpoint
+        self.period = period
+        self._stack = []
+
+    @property
+    def cursor(self):
+        return [[path, entries[i - 1] if i else None]
+                for path, entries, i in self._stack]
+
+    def _list(self, path):
+        if path is None:
+            return self.roots
+        started = time.time()
         try:
-            ls = os.listdir(path)
+            return sorted(os.listdir(path))
         except OSError:
-            continue
-        for item in ls:
-            item = os.path.join(path, item)
-            if os.path.islink(item):
+            return None
+        finally:
+            WALK.observe(time.time() - started)
+
+    def _restore(self, cursor):
+        stack = []
+        for path, last in cursor:
+            entries = self._list(path)
+            if entries is None:
+                # removed since, its parent continues after it
+                break
+            i = bisect_right(entries, last) if last is not None else 0
+            stack.append([path, entries, i])
+        return stack
+
+    def __iter__(self):
+        if self.start:
+            stack = self._stack = self._restore(self.start)
+        else:
+            stack = self._stack = [[None, self.roots, 0]]
+        checked = time.time()
+        while stack:
+            if self.checkpoint and time.time() - checked >= self.period:
+                self.checkpoint(self.cursor)
+                checked = time.time()
+            frame = stack[-1]
+            path, entries, i = frame
+            if i >= len(entries):
+                stack.pop()
                 continue
+            frame[2] += 1
+            if path is None:
+                item = entries[i]
+            else:
+                item = os.path.join(path, entries[i])
+                if os.path.islink(item):
+                    continue
             if os.path.isdir(item):
-                dirs.append(item)
+                entries = self._list(item)
+                if entries:
+                    stack.append([item, entries, 0])
             elif os.path.isfile(item):
-                files.append(item)
+                yield item
+
+
+def iterfiles(files=None, dirs=None, cursor=None, checkpoint=None):
+    return FileWalk(files=files, dirs=dirs, cursor=cursor,
+                    checkpoint=checkpoint)
 
 
 def modified(files, mtime):
     for filename in files:
+        started = time.time()
         try:
             info = os.stat(filename)
         except OSError:
             continue
+        finally:
+            STAT.observe(time.time() - started)
+        started = time.time()
         b_mtime = mtime.get_mtime(filename)
+        LOOKUP.observe(time.time() - started)
         if not b_mtime or (b_mtime < int(info.st_mtime)):
             yield filename
+
+
+def is_sparse(info):
+    """ Returns True if less than size of the file is allocated
+    """
+    return info.st_blocks * 512 < info.st_size
+
+
+def extents(path):
+    """ Returns list of (offset, length) of data of a file with holes,
+        None if the file has no holes or they cannot be found
+    """
+    fd = os.open(path, os.O_RDONLY)
+    result = []
+    try:
+        size = os.fstat(fd).st_size
+        pos = 0
+        while pos < size:
+            try:
+                start = os.lseek(fd, pos, SEEK_DATA)
+            except OSError, e:
+                if e.errno == errno.ENXIO:
+                    # a hole up to the end
+                    break
+                if e.errno == errno.EINVAL:
+                    return None
+                raise
+            pos = os.lseek(fd, start, SEEK_HOLE)
+            result.append((start, pos - start))
+    finally:
+        os.close(fd)
+    if result == [(0, size)]:
+        return None
+    return result
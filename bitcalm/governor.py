@@ -0,0 +1,221 @@
+import os
+import re
+import time
+import ctypes
+import ctypes.util
+import threading
+import subprocess
+
+from bitcalm import log
+
+
+LOADAVG_PATH = '/proc/loadavg'
+PRESSURE_PATH = '/proc/pressure/%s'
+CGROUP_DIR = '/sys/fs/cgroup'
+CGROUP_PATH = '/proc/self/cgroup'
+PRESSURE_RE = re.compile(r'^some avg10=([\d.]+)')
+PRIO_PROCESS = 0
+
+
+class LEVEL:
+    IDLE = 0
+    BUSY = 1
+    OVERLOADED = 2
+
+
+def read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def thread_id():
+    """ Linux keeps priorities per thread """
+    try:
+        return int(os.readlink('/proc/thread-self').rsplit('/', 1)[1])
+    except (OSError, ValueError, IndexError):
+        return os.getpid()
+
+
+def cgroup_dirs(controller=''):
+    """ Returns directories of the cgroup of the process and of its
+        ancestors, limits of all of them apply. controller is the name
+        of a cgroup v1 controller or '' for the cgroup v2 hierarchy.
+    """
+    for line in (read(CGROUP_PATH) or '').splitlines():
+        try:
+            hierarchy, controllers, path = line.split(':', 2)
+        except ValueError:
+            continue
+        if controller:
+            if controller not in controllers.split(','):
+                continue
+            top = os.path.join(CGROUP_DIR, controllers)
+            if not os.path.isdir(top):
+                top = os.path.join(CGROUP_DIR, controller)
+        elif hierarchy == '0' and not controllers:
+            top = CGROUP_DIR
+        else:
+            continue
+        dirs = []
+        path = path.strip('/')
+        while path:
+            dirs.append(os.path.join(top, path))
+            path = os.path.dirname(path)
+        dirs.append(top)
+        # the path is of the host if the cgroup namespace is not private
+        return [d for d in dirs if os.path.isdir(d)]
+    return []
+
+
+def cpu_limit():
+    """ Returns number of CPUs available with respect to cgroup quotas
+    """
+    cpus = os.sysconf('SC_NPROCESSORS_ONLN')
+    for path in cgroup_dirs():
+        value = read(os.path.join(path, 'cpu.max'))
+        if value:
+            quota, period = value.split()
+            if quota != 'max':
+                cpus = min(cpus, int(quota) / float(period))
+    for path in cgroup_dirs('cpu'):
+        quota = read(os.path.join(path, 'cpu.cfs_quota_us'))
+        period = read(os.path.join(path, 'cpu.cfs_period_us'))
+        if quota and period and int(quota) > 0:
+            cpus = min(cpus, int(quota) / float(period))
+    return cpus
+
+
+def memory_usage():
+    """ Returns the largest part of a cgroup memory limit in use or None
+        if unlimited
+    """
+    usages = []
+    for controller, limit, usage in (('', 'memory.max', 'memory.current'),
+                                     ('memory', 'memory.limit_in_bytes',
+                                      'memory.usage_in_bytes')):
+        for path in cgroup_dirs(controller):
+            value = read(os.path.join(path, limit))
+            used = read(os.path.join(path, usage))
+            if value and used and value.isdigit():
+                value = int(value)
+                # cgroup v1 reports "unlimited" as a huge number
+                if value < 2**60:
+                    usages.append(int(used) / float(value))
+    return max(usages) if usages else None
+
+
+def pressure(resource):
+    """ Returns share of time (0..1) some tasks were stalled on resource
+        during the last 10 seconds or None if PSI is not available
+    """
+    data = read(PRESSURE_PATH % resource)
+    m = PRESSURE_RE.match(data or '')
+    return float(m.group(1)) / 100 if m else None
+
+
+class Governor(object):
+    """ Adapts the backup to the host load.
+        Load is the maximum of the load average per available CPU,
+        PSI stall times and cgroup memory usage, each scaled so that 1
+        means the host is saturated. The level of load defines nice,
+        IO priority and share of workers of the threads which call check().
+        On overload check() also pauses the caller after every RUN_SLICE
+        seconds of work, however many times it is called.
+    """
+    SAMPLE_PERIOD = 10
+    RUN_SLICE = 1
+    BUSY = 0.7
+    OVERLOADED = 1.0
+    PSI_SATURATED = 0.4
+    MEMORY_SATURATED = 0.95
+    # level: (nice, ionice class, ionice level, share of workers, pause)
+    POLICY = {LEVEL.IDLE: (0, 2, 4, 1.0, 0),
+              LEVEL.BUSY: (10, 2, 7, 0.5, 0),
+              LEVEL.OVERLOADED: (19, 3, 0, 0, 4)}
+
+    def __init__(self):
+        self.level = LEVEL.IDLE
+        self.load = 0
+        self.sampled = 0
+        self.applied = {}
+        self.lock = threading.Lock()
+        self._local = threading.local()
+        libc = ctypes.util.find_library('c')
+        self.libc = ctypes.CDLL(libc, use_errno=True) if libc else None
+
+    def sample(self):
+        values = []
+        loadavg = read(LOADAVG_PATH)
+        if loadavg:
+            values.append(float(loadavg.split()[0]) / cpu_limit())
+        for resource in ('cpu', 'io', 'memory'):
+            value = pressure(resource)
+            if value is not None:
+                values.append(value / self.PSI_SATURATED)
+        value = memory_usage()
+        if value is not None:
+            values.append(value / self.MEMORY_SATURATED)
+        self.load = max(values) if values else 0
+        if self.load >= self.OVERLOADED:
+            level = LEVEL.OVERLOADED
+        elif self.load >= self.BUSY:
+            level = LEVEL.BUSY
+        else:
+            level = LEVEL.IDLE
+        if level != self.level:
+            log.info('Host load is %.2f, backup priority level %i -> %i'
+                     % (self.load, self.level, level))
+            self.level = level
+        self.sampled = time.time()
+        return level
+
+    def check(self):
+        """ Applies current level to the calling thread; backs off if
+            the host is overloaded.
+        """
+        with self.lock:
+            if time.time() - self.sampled >= self.SAMPLE_PERIOD:
+                self.sample()
+            level = self.level
+        self.apply(level)
+        pause = self.POLICY[level][4]
+        if not pause:
+            self._local.running = None
+            return level
+        now = time.time()
+        running = getattr(self._local, 'running', None)
+        if running is None:
+            self._local.running = now
+        elif now - running >= self.RUN_SLICE:
+            time.sleep(pause)
+            self._local.running = time.time()
+        return level
+
+    def apply(self, level):
+        tid = thread_id()
+        if self.applied.get(tid) == level:
+            return
+        nice, ioclass, iolevel = self.POLICY[level][:3]
+        if self.libc:
+            self.libc.setpriority(PRIO_PROCESS, tid, nice)
+        cmd = ['ionice', '-c', str(ioclass)]
+        if ioclass != 3:
+            cmd.extend(('-n', str(iolevel)))
+        cmd.extend(('-p', str(tid)))
+        try:
+            with open(os.devnull, 'w') as devnull:
+                subprocess.call(cmd, stdout=devnull, stderr=devnull)
+        except OSError:
+            pass
+        self.applied[tid] = level
+
+    def workers(self, maximum):
+        """ Returns number of workers to use out of maximum
+        """
+        return max(1, int(maximum * self.POLICY[self.level][3]))
+
+
+governor = Governor()
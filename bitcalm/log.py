@@ -1,8 +1,9 @@
+import os
 import logging
 from logging.handlers import RotatingFileHandler
 
 
-LOG_PATH = '/var/log/bitcalm.log'
+LOG_PATH = os.environ.get('BITCALM_LOG', '/var/log/bitcalm.log')
 
 
 class ListHandler(logging.Handler):
@@ -0,0 +1,185 @@
+import os
+import time
+import threading
+from functools import wraps
+
+
+PREFIX = 'bitcalm_'
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\')
+                                                   .replace('"', '\\"'))
+                             for k, v in sorted(labels.iteritems()))
+
+
+class Counter(object):
+    TYPE = 'counter'
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+    def lines(self, name, labels):
+        return ['%s%s %s' % (name, _labels(labels), self.value)]
+
+
+class Histogram(object):
+    """ Latency histogram, values are seconds
+    """
+    TYPE = 'histogram'
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+
+    def time(self):
+        return Timer(self)
+
+    def snapshot(self):
+        return (self.count, self.sum)
+
+    def lines(self, name, labels):
+        with self._lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        result = []
+        cumulative = 0
+        for bound, n in zip(self.buckets, counts):
+            cumulative += n
+            result.append('%s_bucket%s %i' % (name,
+                                              _labels(dict(labels, le=bound)),
+                                              cumulative))
+        result.append('%s_bucket%s %i' % (name,
+                                          _labels(dict(labels, le='+Inf')),
+                                          count))
+        result.append('%s_sum%s %f' % (name, _labels(labels), total))
+        result.append('%s_count%s %i' % (name, _labels(labels), count))
+        return result
+
+
+class Timer(object):
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.time() - self.started)
+
+
+class Registry(object):
+    """ Named metrics, optionally with labels, rendered in Prometheus
+        text exposition format
+    """
+    def __init__(self):
+        self._metrics = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels):
+        key = (name, tuple(sorted((labels or {}).iteritems())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = cls()
+                    self._help.setdefault(name, (cls.TYPE, help))
+        return metric
+
+    def counter(self, name, help='', **labels):
+        return self._get(Counter, name, help, labels)
+
+    def histogram(self, name, help='', **labels):
+        return self._get(Histogram, name, help, labels)
+
+    def render(self):
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        lines = []
+        current = None
+        for (name, labels), metric in metrics:
+            if name != current:
+                mtype, help = self._help[name]
+                if help:
+                    lines.append('# HELP %s%s %s' % (PREFIX, name, help))
+                lines.append('# TYPE %s%s %s' % (PREFIX, name, mtype))
+                current = name
+            lines.extend(metric.lines(PREFIX + name, dict(labels)))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """ Writes the snapshot atomically, so a scraper never reads
+            a partial file
+        """
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.rename(tmp, path)
+
+    def snapshot(self):
+        with self._lock:
+            return dict((key, metric.snapshot())
+                        for key, metric in self._metrics.iteritems())
+
+    def summary(self, since=None):
+        """ Returns counter values and histogram counts and sums,
+            differences from the since snapshot if it is given
+        """
+        since = since or {}
+        result = {}
+        for key, value in self.snapshot().iteritems():
+            name = key[0] + _labels(dict(key[1]))
+            prev = since.get(key)
+            if isinstance(value, tuple):
+                if prev:
+                    value = (value[0] - prev[0], value[1] - prev[1])
+                if value[0]:
+                    result[name] = {'count': value[0],
+                                    'sum': round(value[1], 3)}
+            else:
+                value -= prev or 0
+                if value:
+                    result[name] = value
+        return result
+
+
+registry = Registry()
+counter = registry.counter
+histogram = registry.histogram
+
+
+def timed(name, help='', **labels):
+    """ Decorator observing duration of calls in a histogram
+    """
+    def decorator(func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            with registry.histogram(name, help, **labels).time():
+                return func(*args, **kwargs)
+        return inner
+    return decorator
@@ -0,0 +1,186 @@
+import os
+import sys
+import time
+import pstats
+import cProfile
+import threading
+from StringIO import StringIO
+from contextlib import contextmanager
+from collections import defaultdict
+
+from bitcalm import log
+
+
+class MODE:
+    OFF = 'off'
+    CPROFILE = 'cprofile'
+    SAMPLE = 'sample'
+
+
+SAMPLE_INTERVAL = 0.01
+DUMP_PERIOD = 10 * 60
+KEEP_DUMPS = 10
+SUMMARY_LINES = 40
+
+
+def frame_stack(frame):
+    stack = []
+    while frame:
+        code = frame.f_code
+        stack.append('%s:%s:%i' % (os.path.basename(code.co_filename),
+                                   code.co_name, frame.f_lineno))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+class Profiler(object):
+    """ Profiles actions and backup stages on demand.
+
+        In cprofile mode every profiled call is run under cProfile in its
+        thread and dumped to its own file. In sample mode a thread takes
+        stacks of all threads every SAMPLE_INTERVAL seconds and collects
+        them in collapsed stack format (thread;stage;frame;... count)
+        which is dumped every DUMP_PERIOD and when profiling is stopped.
+        Dumps are named profile-*.prof or profile-*.stacks, only
+        KEEP_DUMPS latest of each kind are kept. If report is set it is
+        called with a text summary of every dump.
+    """
+    def __init__(self, path=None, mode=MODE.OFF, report=None):
+        self.path = path
+        self.mode = MODE.OFF
+        self.report = report
+        self.stages = {}
+        self.samples = defaultdict(int)
+        self._active = threading.local()
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._stop = threading.Event()
+        self.set_mode(mode)
+
+    def set_mode(self, mode):
+        if mode == self.mode:
+            return
+        if self.mode == MODE.SAMPLE:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+            self.dump_samples()
+        self.mode = mode
+        if mode == MODE.SAMPLE:
+            self._stop.clear()
+            self._sampler = threading.Thread(target=self._sample,
+                                             name='profiler')
+            self._sampler.setDaemon(True)
+            self._sampler.start()
+        log.info('Profiling mode is %s' % mode)
+
+    def toggle(self, mode=MODE.SAMPLE):
+        self.set_mode(MODE.OFF if self.mode != MODE.OFF else mode)
+
+    @contextmanager
+    def stage(self, name):
+        """ Labels samples of the calling thread with name; in cprofile
+            mode profiles the block unless the thread is profiled already.
+        """
+        tid = threading.current_thread().ident
+        outer = self.stages.get(tid)
+        self.stages[tid] = '%s;%s' % (outer, name) if outer else name
+        profile = None
+        if self.mode == MODE.CPROFILE and not getattr(self._active,
+                                                      'profile', None):
+            profile = self._active.profile = cProfile.Profile()
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+                self._active.profile = None
+                self.dump_profile(profile, name)
+            if outer:
+                self.stages[tid] = outer
+            else:
+                self.stages.pop(tid, None)
+
+    def call(self, name, func, *args, **kwargs):
+        with self.stage(name):
+            return func(*args, **kwargs)
+
+    def _sample(self):
+        me = threading.current_thread().ident
+        dumped = time.time()
+        while not self._stop.wait(SAMPLE_INTERVAL):
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            frames = sys._current_frames()
+            with self._lock:
+                for tid, frame in frames.iteritems():
+                    if tid == me:
+                        continue
+                    stack = [names.get(tid, str(tid))]
+                    stage = self.stages.get(tid)
+                    if stage:
+                        stack.append(stage)
+                    stack.extend(frame_stack(frame))
+                    self.samples[';'.join(stack)] += 1
+            del frames
+            if time.time() - dumped >= DUMP_PERIOD:
+                self.dump_samples()
+                dumped = time.time()
+
+    def _filename(self, name, ext):
+        return os.path.join(self.path, 'profile-%s-%s.%s'
+                            % (time.strftime('%Y%m%d-%H%M%S'), name, ext))
+
+    def rotate(self, ext):
+        dumps = sorted(f for f in os.listdir(self.path)
+                       if f.startswith('profile-') and f.endswith('.' + ext))
+        for f in dumps[:-KEEP_DUMPS]:
+            try:
+                os.remove(os.path.join(self.path, f))
+            except OSError:
+                pass
+
+    def dump_profile(self, profile, name):
+        filename = self._filename(name, 'prof')
+        try:
+            profile.dump_stats(filename)
+            self.rotate('prof')
+        except (IOError, OSError), e:
+            log.error('Failed to save profile %s: %s' % (filename, e))
+            return
+        if self.report:
+            out = StringIO()
+            stats = pstats.Stats(profile, stream=out)
+            stats.sort_stats('cumulative').print_stats(SUMMARY_LINES)
+            self._report(name, out.getvalue())
+
+    def dump_samples(self):
+        with self._lock:
+            samples, self.samples = self.samples, defaultdict(int)
+        if not samples:
+            return
+        filename = self._filename('samples', 'stacks')
+        try:
+            with open(filename, 'w') as f:
+                for stack, count in samples.iteritems():
+                    f.write('%s %i\n' % (stack, count))
+            self.rotate('stacks')
+        except (IOError, OSError), e:
+            log.error('Failed to save samples %s: %s' % (filename, e))
+            return
+        if self.report:
+            top = sorted(samples.iteritems(), key=lambda s: -s[1])
+            total = float(sum(samples.itervalues()))
+            lines = ['%5.1f%% %s' % (count / total * 100, stack)
+                     for stack, count in top[:SUMMARY_LINES]]
+            self._report('samples', '\n'.join(lines))
+
+    def _report(self, name, summary):
+        try:
+            self.report(name, summary)
+        except Exception, e:
+            log.error('Failed to report profile %s: %s' % (name, e))
+
+
+profiler = Profiler()
@@ -0,0 +1,254 @@
+import math
+import Queue
+from cStringIO import StringIO
+
+import mysql.connector
+
+from bitcalm.const import MB, GB
+
+
+TABLE_CHUNK_SIZE = GB
+INSERT_SIZE = MB
+INT_TYPES = ('tinyint', 'smallint', 'mediumint', 'int', 'bigint')
+# utf8 of MySQL is utf8mb3 which has no 4 byte characters
+CHARSET = 'utf8mb4'
+HEADER = ('SET NAMES %s;\n'
+          'SET FOREIGN_KEY_CHECKS=0;\n'
+          'SET UNIQUE_CHECKS=0;\n' % CHARSET)
+
+
+def utf8(value):
+    return value.encode('utf8') if isinstance(value, unicode) else value
+
+
+def quote_name(name):
+    return '`%s`' % utf8(name).replace('`', '``')
+
+
+def quote_value(converter, value):
+    """ Returns SQL literal of a value fetched with converter
+    """
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bytearray):
+        return '0x' + str(value).encode('hex') if value else "''"
+    value = converter.quote(converter.escape(converter.to_mysql(value)))
+    return str(value).replace('\0', '\\0')
+
+
+def insert_statements(table, rows, converter, size=INSERT_SIZE):
+    """ Yields INSERT statements of rows, each of about size bytes
+    """
+    insert = 'INSERT INTO %s VALUES ' % quote_name(table)
+    statement = []
+    length = 0
+    for row in rows:
+        values = '(%s)' % ','.join(quote_value(converter, v) for v in row)
+        statement.append(values)
+        length += len(values)
+        if length >= size:
+            yield insert + ','.join(statement) + ';\n'
+            statement = []
+            length = 0
+    if statement:
+        yield insert + ','.join(statement) + ';\n'
+
+
+def blocks(lines, size=MB):
+    """ Joins lines into StringIO blocks of about size bytes
+    """
+    block = StringIO()
+    for line in lines:
+        block.write(line)
+        if block.tell() >= size:
+            block.seek(0)
+            yield block
+            block = StringIO()
+    if block.tell():
+        block.seek(0)
+        yield block
+
+
+class TableDump(object):
+    """ Dumps a database as separate objects within one consistent
+        snapshot: 'schema' creates tables, every 'data' object inserts
+        rows of a table or of a primary key range of a huge table,
+        'post' creates views and triggers after the data is imported.
+
+        The snapshot is shared by all connections: they start their
+        transactions while the server is locked by FLUSH TABLES WITH
+        READ LOCK, which requires RELOAD privilege. The binary log
+        position of the snapshot is kept in position.
+    """
+    def __init__(self, name, host, user, passwd='', port=3306, workers=4,
+                 chunk_size=TABLE_CHUNK_SIZE):
+        self.name = name
+        self.kwargs = {'host': host, 'port': port, 'user': user,
+                       'password': passwd, 'database': name,
+                       'charset': CHARSET, 'use_pure': True}
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.connections = Queue.Queue()
+        self.opened = []
+        self.position = None
+
+    def __enter__(self):
+        lock = mysql.connector.connect(**self.kwargs)
+        try:
+            cur = lock.cursor()
+            cur.execute('FLUSH TABLES WITH READ LOCK')
+            try:
+                cur.execute('SHOW MASTER STATUS')
+                row = cur.fetchone()
+                if row:
+                    self.position = (row[0], int(row[1]))
+                for i in xrange(self.workers):
+                    conn = mysql.connector.connect(**self.kwargs)
+                    self.opened.append(conn)
+                    conn.cursor().execute('SET SESSION TRANSACTION '
+                                          'ISOLATION LEVEL REPEATABLE READ')
+                    conn.cursor().execute('START TRANSACTION '
+                                          'WITH CONSISTENT SNAPSHOT')
+                    self.connections.put(conn)
+            finally:
+                cur.execute('UNLOCK TABLES')
+                cur.close()
+        except:
+            self.close()
+            raise
+        finally:
+            lock.close()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        for conn in self.opened:
+            try:
+                conn.close()
+            except mysql.connector.errors.Error:
+                pass
+        del self.opened[:]
+
+    def _query(self, conn, query, params=()):
+        cur = conn.cursor()
+        cur.execute(query, params)
+        rows = cur.fetchall()
+        cur.close()
+        return rows
+
+    def objects(self):
+        """ Returns list of objects to dump: dicts with type, table and
+            range of primary key values; the largest tables go first.
+        """
+        conn = self.connections.get()
+        try:
+            tables = self._query(conn,
+                'SELECT table_name, data_length + index_length '
+                'FROM information_schema.tables '
+                'WHERE table_schema = %s AND table_type = %s '
+                'ORDER BY 2 DESC', (self.name, 'BASE TABLE'))
+            objects = [{'type': 'schema'}]
+            for table, size in tables:
+                ranges = self._ranges(conn, table, int(size or 0))
+                for i, r in enumerate(ranges):
+                    objects.append({'type': 'data',
+                                    'table': table,
+                                    'part': i,
+                                    'range': r})
+            objects.append({'type': 'post'})
+            return objects
+        finally:
+            self.connections.put(conn)
+
+    def _ranges(self, conn, table, size):
+        parts = int(math.ceil(size / float(self.chunk_size)))
+        if parts < 2:
+            return [None]
+        pk = self._query(conn,
+            'SELECT k.column_name, c.data_type '
+            'FROM information_schema.key_column_usage k '
+            'JOIN information_schema.columns c '
+            'ON c.table_schema = k.table_schema '
+            'AND c.table_name = k.table_name '
+            'AND c.column_name = k.column_name '
+            'WHERE k.table_schema = %s AND k.table_name = %s '
+            'AND k.constraint_name = %s', (self.name, table, 'PRIMARY'))
+        if len(pk) != 1 or pk[0][1].lower() not in INT_TYPES:
+            return [None]
+        column = pk[0][0]
+        low, high = self._query(conn, 'SELECT MIN(%s), MAX(%s) FROM %s'
+                                          % (quote_name(column),
+                                             quote_name(column),
+                                             quote_name(table)))[0]
+        if low is None:
+            return [None]
+        step = max(1, int(math.ceil((high - low + 1) / float(parts))))
+        bounds = range(low, high + 1, step)[1:]
+        edges = [None] + bounds + [None]
+        return [(column, edges[i], edges[i+1]) for i in xrange(len(edges)-1)]
+
+    def dump(self, obj):
+        """ Yields SQL of the object; takes a snapshot connection
+            for the time of iteration.
+        """
+        conn = self.connections.get()
+        try:
+            yield HEADER
+            if obj['type'] == 'schema':
+                for line in self._schema(conn):
+                    yield line
+            elif obj['type'] == 'post':
+                for line in self._post(conn):
+                    yield line
+            else:
+                for line in self._rows(conn, obj['table'], obj['range']):
+                    yield line
+        finally:
+            self.connections.put(conn)
+
+    def _schema(self, conn):
+        for table, in self._query(conn,
+                'SELECT table_name FROM information_schema.tables '
+                'WHERE table_schema = %s AND table_type = %s',
+                (self.name, 'BASE TABLE')):
+            create = self._query(conn, 'SHOW CREATE TABLE %s'
+                                            % quote_name(table))[0][1]
+            yield 'DROP TABLE IF EXISTS %s;\n%s;\n' % (quote_name(table),
+                                                       utf8(create))
+
+    def _post(self, conn):
+        for view, in self._query(conn,
+                'SELECT table_name FROM information_schema.views '
+                'WHERE table_schema = %s', (self.name,)):
+            create = self._query(conn, 'SHOW CREATE VIEW %s'
+                                            % quote_name(view))[0][1]
+            yield 'DROP VIEW IF EXISTS %s;\n%s;\n' % (quote_name(view),
+                                                      utf8(create))
+        for trigger, in self._query(conn,
+                'SELECT trigger_name FROM information_schema.triggers '
+                'WHERE trigger_schema = %s', (self.name,)):
+            create = self._query(conn, 'SHOW CREATE TRIGGER %s'
+                                            % quote_name(trigger))[0][2]
+            yield 'DROP TRIGGER IF EXISTS %s;\nDELIMITER ;;\n%s;;\nDELIMITER ;\n' \
+                    % (quote_name(trigger), utf8(create))
+
+    def _rows(self, conn, table, key_range):
+        query = 'SELECT * FROM %s' % quote_name(table)
+        params = []
+        if key_range:
+            column, low, high = key_range
+            conditions = []
+            if low is not None:
+                conditions.append('%s >= %%s' % quote_name(column))
+                params.append(low)
+            if high is not None:
+                conditions.append('%s < %%s' % quote_name(column))
+                params.append(high)
+            query += ' WHERE ' + ' AND '.join(conditions)
+        cur = conn.cursor()
+        cur.execute(query, params)
+        for statement in insert_statements(table, cur, conn.converter):
+            yield statement
+        cur.close()
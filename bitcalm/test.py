@@ -1,6 +1,40 @@
+import os
+import sys
+import time
+import pickle
+import select
+import signal
+import datetime
+from decimal import Decimal
+import shutil
+import tempfile
 import unittest
+from threading import Thread, Timer, Event
+from httplib import HTTPConnection
 
-from bitcalm.utils import COMPRESSED, is_file_compressed
+from boto.s3.multipart import MultiPartUpload
+
+from bitcalm import get_version, log
+from bitcalm.actions import ActionPool, Action, OneTimeAction, CONCURRENCY
+from bitcalm.utils import COMPRESSED, is_file_compressed, run_parallel
+from bitcalm.metrics import Registry
+from bitcalm.throttle import TokenBucket, Bandwidth
+from bitcalm.profiler import Profiler, MODE
+from bitcalm import governor, backup, database
+from bitcalm.database import (ConnectionPool, MySQLContextManager,
+                              DUMP_EXT, BINLOG_EXT)
+from bitcalm.tabledump import (CHARSET, HEADER, quote_value,
+                               insert_statements)
+from bitcalm.config import base
+from bitcalm.filesystem.utils import extents as get_extents
+from bitcalm.config.base import Status, BackupData
+from bitcalm.api import api, Api
+from bitcalm.schedule import DailySchedule, WeeklySchedule
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'benchmarks'))
+from fakes3 import FakeS3
+from fakeapi import FakeApi
 
 
 class CompressedTest(unittest.TestCase):
@@ -20,5 +54,1019 @@ class CompressedTest(unittest.TestCase):
                 func, msg = mapping[compressed]
                 func(is_file_compressed(item), msg % item)
 
+
+class RunParallelTest(unittest.TestCase):
+    def runTest(self):
+        active = {}
+        peak = {}
+        done = []
+
+        def func(item):
+            host = item[0]
+            active[host] = active.get(host, 0) + 1
+            peak[host] = max(peak.get(host, 0), active[host])
+            time.sleep(0.01)
+            active[host] -= 1
+            done.append(item)
+
+        items = [(h, i) for h in 'abc' for i in range(5)]
+        run_parallel(func, items, workers=4,
+                     group=lambda item: item[0], group_workers=2)
+        self.assertEqual(sorted(done), sorted(items))
+        self.assertTrue(max(peak.values()) <= 2)
+
+        def crash(item):
+            if item % 2:
+                raise IOError('Connection reset by peer')
+
+        logged = len(log.upload)
+        self.assertEqual(sorted(run_parallel(crash, range(6), workers=3)),
+                         [1, 3, 5])
+        errors = log.upload[logged:]
+        self.assertEqual(len(errors), 3)
+        self.assertTrue(all('crash crashed' in e and
+                            'IOError: Connection reset by peer' in e
+                            for e in errors), errors)
+
+
+class ActionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = ActionPool()
+        self.later = Action(60, lambda: True)
+        self.pool.add(self.later)
+
+    def runTest(self):
+        self.assertFalse(self.pool.add(Action(1, self.later._func)))
+        urgent = Action(60, lambda: True)
+        self.pool.add(urgent)
+        self.assertTrue(self.pool.get(urgent._func) is urgent)
+
+        Timer(0.1, urgent.delay, kwargs={'period': 0}).start()
+        started = time.time()
+        self.assertTrue(self.pool.wait() is urgent)
+        self.assertTrue(time.time() - started < 5)
+
+        self.pool.remove(urgent)
+        self.assertTrue(self.pool.next() is self.later)
+        self.later.delay(period=0)
+        self.assertTrue(self.pool.wait() is self.later)
+
+
+class Interrupted(Exception):
+    pass
+
+
+class ActionWaitTest(unittest.TestCase):
+    """ wait() sleeps until a change or a signal instead of polling
+    """
+    def setUp(self):
+        self.pool = ActionPool()
+        self.later = Action(60, lambda: True)
+        self.pool.add(self.later)
+        self.calls = []
+        self.select = select.select
+
+        def counted(*args):
+            self.calls.append(args)
+            return self.select(*args)
+
+        select.select = counted
+
+    def tearDown(self):
+        select.select = self.select
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, signal.SIG_DFL)
+
+    def interrupt(self, signum, frame):
+        raise Interrupted()
+
+    def runTest(self):
+        Timer(0.5, self.later.delay, kwargs={'period': 0}).start()
+        self.assertTrue(self.pool.wait() is self.later)
+        self.assertTrue(len(self.calls) <= 2, len(self.calls))
+
+        self.later.delay(period=60)
+        signal.signal(signal.SIGALRM, self.interrupt)
+        signal.setitimer(signal.ITIMER_REAL, 0.2)
+        started = time.time()
+        self.assertRaises(Interrupted, self.pool.wait)
+        self.assertTrue(time.time() - started < 5)
+
+
+class ActionConcurrencyTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = ActionPool()
+        self.release = Event()
+        self.backup = Action(60, self.release.wait, 5, start=0,
+                             concurrency=CONCURRENCY.BACKUP)
+        self.restored = []
+        self.restore = OneTimeAction(0, self.restore_func, start=0,
+                                     concurrency=CONCURRENCY.RESTORE)
+        self.update = OneTimeAction(0, lambda: True, start=0,
+                                    concurrency=CONCURRENCY.UPDATE)
+        self.control = Action(60, lambda: True, start=0)
+        self.pool.extend((self.backup, self.restore, self.update,
+                          self.control))
+
+    def restore_func(self):
+        self.restored.append(self.pool.is_running(self.backup._func))
+        return True
+
+    def runTest(self):
+        action = self.pool.wait()
+        self.assertTrue(action is self.backup)
+        self.pool.run(action)
+        self.assertTrue(self.pool.is_running(self.backup._func))
+        # a restore does not wait for the backup, an update does
+        self.assertTrue(self.pool.wait() is self.restore)
+        self.pool.run(self.restore)
+        self.assertTrue(self.pool.wait() is self.control)
+        self.pool.run(self.control)
+        Timer(0.1, self.release.set).start()
+        self.assertTrue(self.pool.wait() is self.update)
+        self.assertFalse(self.pool.is_running(self.backup._func))
+        self.assertEqual(self.restored, [True])
+
+
+class TokenBucketTest(unittest.TestCase):
+    """ Transfers of several threads share the rate of one bucket
+    """
+    def runTest(self):
+        rate = 1024 * 1024
+        bucket = TokenBucket(rate)
+
+        def transfer():
+            for i in xrange(16):
+                bucket.consume(rate / 64)
+
+        threads = [Thread(target=transfer) for i in xrange(4)]
+        started = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - started
+        self.assertTrue(0.9 < elapsed < 2, elapsed)
+
+        # no limit
+        bucket.set_rate(0)
+        started = time.time()
+        self.assertEqual(bucket.consume(100 * rate), 0)
+        self.assertTrue(time.time() - started < 0.1)
+
+
+class BandwidthTest(unittest.TestCase):
+    def runTest(self):
+        def at(hour, minute):
+            return datetime.datetime(2015, 1, 1, hour, minute)
+
+        bandwidth = Bandwidth([
+            {'start': 9 * 60, 'end': 18 * 60, 'rate': 100},
+            {'start': 17 * 60, 'end': 19 * 60, 'rate': 50},
+            # passes midnight
+            {'start': 22 * 60 + 30, 'end': 6 * 60, 'rate': 10}])
+        for hm, rate in (((12, 0), 100), ((17, 30), 100), ((18, 0), 50),
+                         ((19, 0), 0), ((22, 29), 0), ((22, 30), 10),
+                         ((0, 0), 10), ((5, 59), 10), ((6, 0), 0),
+                         ((8, 59), 0), ((9, 0), 100)):
+            self.assertEqual(bandwidth.get_rate(at(*hm)), rate, hm)
+        self.assertNotEqual(bandwidth.callback(), None)
+
+        # no limits
+        bandwidth = Bandwidth()
+        self.assertEqual(bandwidth.get_rate(at(12, 0)), 0)
+        self.assertEqual(bandwidth.callback(), None)
+        self.assertEqual(bandwidth.consume(1024 * 1024 * 1024), 0)
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def runTest(self):
+        files = self.registry.counter('files_total', 'Files')
+        files.inc(3)
+        self.assertTrue(self.registry.counter('files_total') is files)
+        api = self.registry.histogram('api_seconds', 'API', endpoint='hi')
+        api.observe(0.002)
+        since = self.registry.snapshot()
+        api.observe(0.2)
+        api.observe(1000)
+        files.inc()
+
+        text = self.registry.render()
+        self.assertTrue('# TYPE bitcalm_files_total counter' in text)
+        self.assertTrue('bitcalm_files_total 4' in text)
+        self.assertTrue('bitcalm_api_seconds_bucket{endpoint="hi",le="0.005"} 1'
+                        in text)
+        self.assertTrue('bitcalm_api_seconds_bucket{endpoint="hi",le="0.5"} 2'
+                        in text)
+        self.assertTrue('bitcalm_api_seconds_bucket{endpoint="hi",le="+Inf"} 3'
+                        in text)
+        self.assertTrue('bitcalm_api_seconds_count{endpoint="hi"} 3' in text)
+
+        summary = self.registry.summary(since=since)
+        self.assertEqual(summary['files_total'], 1)
+        self.assertEqual(summary['api_seconds{endpoint="hi"}']['count'], 2)
+
+
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.profiler = Profiler(self.path)
+        self.reports = []
+        self.profiler.report = lambda name, summary: self.reports.append(name)
+
+    def tearDown(self):
+        self.profiler.set_mode(MODE.OFF)
+        shutil.rmtree(self.path)
+
+    def dumps(self, ext):
+        return [f for f in os.listdir(self.path) if f.endswith(ext)]
+
+    def busy(self):
+        with self.profiler.stage('busy_stage'):
+            time.sleep(0.2)
+
+    def runTest(self):
+        self.profiler.toggle()
+        self.assertEqual(self.profiler.mode, MODE.SAMPLE)
+        t = Thread(target=self.busy, name='worker')
+        t.start()
+        t.join()
+        self.profiler.toggle()
+        self.assertEqual(self.profiler.mode, MODE.OFF)
+        dumps = self.dumps('.stacks')
+        self.assertEqual(len(dumps), 1)
+        with open(os.path.join(self.path, dumps[0])) as f:
+            stacks = f.read()
+        self.assertTrue('worker;busy_stage;' in stacks)
+
+        self.profiler.set_mode(MODE.CPROFILE)
+        self.assertEqual(self.profiler.call('sum', sum, [1, 2]), 3)
+        self.assertEqual(len(self.dumps('.prof')), 1)
+        self.assertEqual(self.reports, ['samples', 'sum'])
+
+
+@unittest.skipIf(os.getuid() != 0, 'bitcalm.backupd runs only as root')
+class ProfileSignalTest(ProfilerTest):
+    """ The signal handler only adds an action toggling the profiler,
+        which is run by the main loop
+    """
+    def setUp(self):
+        ProfilerTest.setUp(self)
+        from bitcalm import backupd
+        self.backupd = backupd
+        self.global_profiler = backupd.profiler
+        backupd.profiler = self.profiler
+        self.handler = signal.signal(signal.SIGUSR2, backupd.on_profile)
+
+    def tearDown(self):
+        signal.signal(signal.SIGUSR2, self.handler)
+        self.backupd.actions.clear()
+        self.backupd.profiler = self.global_profiler
+        ProfilerTest.tearDown(self)
+
+    def runTest(self):
+        actions = self.backupd.actions
+        for mode in (MODE.OFF, MODE.SAMPLE):
+            self.profiler.set_mode(mode)
+            os.kill(os.getpid(), signal.SIGUSR2)
+            self.assertEqual(self.profiler.mode, mode)
+            action = actions.wait()
+            self.assertEqual(action._func, self.backupd.toggle_profile)
+            actions.run(action)
+            self.assertNotEqual(self.profiler.mode, mode)
+            self.assertFalse(actions.has(self.backupd.toggle_profile))
+
+
+class GovernorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.saved = (governor.CGROUP_DIR, governor.CGROUP_PATH,
+                      governor.LOADAVG_PATH, governor.PRESSURE_PATH)
+        governor.CGROUP_DIR = os.path.join(self.root, 'cgroup')
+        governor.CGROUP_PATH = os.path.join(self.root, 'cgroup.proc')
+        governor.LOADAVG_PATH = os.path.join(self.root, 'loadavg')
+        governor.PRESSURE_PATH = os.path.join(self.root, 'pressure-%s')
+        self.cpus = os.sysconf('SC_NPROCESSORS_ONLN')
+
+    def tearDown(self):
+        (governor.CGROUP_DIR, governor.CGROUP_PATH,
+         governor.LOADAVG_PATH, governor.PRESSURE_PATH) = self.saved
+        shutil.rmtree(self.root)
+
+    def write(self, path, data):
+        path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(data)
+
+
+class CgroupV2Test(GovernorTestCase):
+    def runTest(self):
+        self.write('cgroup.proc', '0::/system.slice/bitcalmd.service\n')
+        self.write('cgroup/cpu.max', 'max 100000\n')
+        self.write('cgroup/system.slice/cpu.max', '50000 100000\n')
+        self.write('cgroup/system.slice/bitcalmd.service/cpu.max',
+                   'max 100000\n')
+        self.write('cgroup/system.slice/bitcalmd.service/memory.max',
+                   '1000\n')
+        self.write('cgroup/system.slice/bitcalmd.service/memory.current',
+                   '250\n')
+        self.write('cgroup/system.slice/memory.max', 'max\n')
+        self.write('cgroup/system.slice/memory.current', '900\n')
+        self.assertEqual(governor.cpu_limit(), min(self.cpus, 0.5))
+        self.assertEqual(governor.memory_usage(), 0.25)
+
+
+class CgroupV1Test(GovernorTestCase):
+    def runTest(self):
+        self.write('cgroup.proc', '5:memory:/docker/abc\n'
+                                  '4:cpu,cpuacct:/docker/abc\n'
+                                  '0::/\n')
+        self.write('cgroup/cpu,cpuacct/docker/abc/cpu.cfs_quota_us',
+                   '25000\n')
+        self.write('cgroup/cpu,cpuacct/docker/abc/cpu.cfs_period_us',
+                   '100000\n')
+        self.write('cgroup/cpu,cpuacct/cpu.cfs_quota_us', '-1\n')
+        self.write('cgroup/cpu,cpuacct/cpu.cfs_period_us', '100000\n')
+        self.write('cgroup/memory/docker/abc/memory.limit_in_bytes',
+                   '%i\n' % 2**62)
+        self.write('cgroup/memory/docker/abc/memory.usage_in_bytes', '10\n')
+        self.assertEqual(governor.cpu_limit(), min(self.cpus, 0.25))
+        self.assertEqual(governor.memory_usage(), None)
+
+
+class GovernorLevelTest(GovernorTestCase):
+    def runTest(self):
+        g = governor.Governor()
+        g.apply = lambda level: None
+        self.write('loadavg', '%f 0 0 1/100 1\n' % (self.cpus * 0.1))
+        self.write('pressure-io', 'some avg10=10.00 avg60=0 avg300=0 '
+                                  'total=0\n')
+        self.assertEqual(g.sample(), governor.LEVEL.IDLE)
+        self.write('pressure-io', 'some avg10=60.00 avg60=0 avg300=0 '
+                                  'total=0\n')
+        self.assertEqual(g.sample(), governor.LEVEL.OVERLOADED)
+        self.assertEqual(g.workers(4), 1)
+
+        # pauses by time spent, not by the number of calls
+        g.RUN_SLICE = 0.05
+        g.POLICY = dict(g.POLICY)
+        g.POLICY[governor.LEVEL.OVERLOADED] = (19, 3, 0, 0, 0.05)
+        started = time.time()
+        calls = 0
+        while time.time() - started < 0.3:
+            g.check()
+            calls += 1
+        self.assertTrue(calls > 100)
+
+
+class QuoteValueTest(unittest.TestCase):
+    def setUp(self):
+        from mysql.connector.conversion import MySQLConverter
+        self.converter = MySQLConverter(CHARSET, True)
+
+    def quote(self, value):
+        return quote_value(self.converter, value)
+
+    def runTest(self):
+        self.assertTrue('SET NAMES utf8mb4;' in HEADER)
+        self.assertEqual(self.quote(None), 'NULL')
+        self.assertEqual(self.quote(bytearray('\x00\xff')), '0x00ff')
+        self.assertEqual(self.quote(bytearray()), "''")
+        self.assertEqual(self.quote(42), '42')
+        self.assertEqual(self.quote(0.1), '0.1')
+        self.assertEqual(self.quote(1.0000000000000002), '1.0000000000000002')
+        self.assertEqual(self.quote(Decimal('1.50')), "'1.50'")
+        self.assertEqual(self.quote("it's"), "'it\\'s'")
+        self.assertEqual(self.quote('a\0b'), "'a\\0b'")
+        self.assertEqual(self.quote('\x1a'), "'\\\x1a'")
+        self.assertEqual(self.quote(u'\U0001f600'),
+                         "'\xf0\x9f\x98\x80'")
+        self.assertEqual(self.quote(datetime.datetime(2020, 1, 2, 3, 4, 5)),
+                         "'2020-01-02 03:04:05'")
+
+
+class InsertBatchTest(QuoteValueTest):
+    def runTest(self):
+        rows = [(i, 'row%02i' % i) for i in range(10)]
+        statements = list(insert_statements('t`1', rows, self.converter,
+                                            size=30))
+        # every statement stops at the first row reaching the size
+        self.assertEqual(len(statements), 4)
+        self.assertEqual(statements[0], "INSERT INTO `t``1` VALUES "
+                                        "(0,'row00'),(1,'row01'),"
+                                        "(2,'row02');\n")
+        values = ''.join(s[len('INSERT INTO `t``1` VALUES '):-2] + ','
+                         for s in statements)
+        self.assertEqual(values, ''.join("(%i,'row%02i')," % (i, i)
+                                         for i in range(10)))
+        self.assertEqual(list(insert_statements('t', [], self.converter)),
+                         [])
+
+
+class FakeConnection(object):
+    def __init__(self, key, cursor_error=None):
+        self._pool_key = key, ''
+        self.cursor_error = cursor_error
+        self.closed = False
+
+    def is_connected(self):
+        return not self.closed
+
+    def cursor(self, **kwargs):
+        if self.cursor_error:
+            raise self.cursor_error
+        return self
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    def runTest(self):
+        pool = ConnectionPool(size=1, idle=60)
+        idle = FakeConnection(('db1', 3306, 'root'))
+        pool.put(idle)
+        pool._conns[idle._pool_key[0]][0] = (idle, '', time.time() - 60)
+        # the idle connection of another host is closed without get()
+        used = FakeConnection(('db2', 3306, 'root'))
+        pool.put(used)
+        self.assertTrue(idle.closed)
+        self.assertFalse(used.closed)
+        extra = FakeConnection(('db2', 3306, 'root'))
+        pool.put(extra)
+        self.assertTrue(extra.closed)
+        self.assertIs(pool.get(host='db2', user='root'), used)
+        pool.put(used)
+        pool.clear()
+        self.assertTrue(used.closed)
+
+
+class CursorErrorTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = FakeConnection(('db', 3306, 'root'),
+                                   database.mysql.connector.errors.Error())
+        self.get, database.pool.get = (database.pool.get,
+                                       lambda **kwargs: self.conn)
+
+    def tearDown(self):
+        database.pool.get = self.get
+
+    def runTest(self):
+        self.assertRaises(database.mysql.connector.errors.Error,
+                          MySQLContextManager, host='db', user='root')
+        self.assertTrue(self.conn.closed)
+
+
+class RestoreChainTest(unittest.TestCase):
+    def setUp(self):
+        self.imported = []
+        self.failing = set()
+        self.orig = (backup.get_bucket, backup.decompress_key,
+                     backup.import_stream)
+
+        def import_stream(chunks, user, host, passwd, port, name):
+            self.imported.append(chunks)
+            return chunks not in self.failing
+
+        backup.get_bucket = lambda: None
+        backup.decompress_key = lambda key: key.key
+        backup.import_stream = import_stream
+
+    def tearDown(self):
+        (backup.get_bucket, backup.decompress_key,
+         backup.import_stream) = self.orig
+
+    def restore(self, *keys):
+        chain = [(backup.Key(None, k), 'db/', ext) for k, ext in
+                 zip(keys, [DUMP_EXT] + [BINLOG_EXT] * (len(keys) - 1))]
+        return backup.restore_chain(chain, 'root', 'localhost', '', 3306,
+                                    'test')
+
+    def runTest(self):
+        self.assertEqual(self.restore('full', 'log1', 'log2'), None)
+        self.assertEqual(self.imported, ['full', 'log1', 'log2'])
+        del self.imported[:]
+        self.failing.add('full')
+        self.assertEqual(self.restore('full', 'log1', 'log2'),
+                         'Failed to import test to localhost:3306')
+        # binary logs are not replayed over a failed import
+        self.assertEqual(self.imported, ['full'])
+        del self.imported[:]
+        self.failing = set(['log1'])
+        self.assertEqual(self.restore('full', 'log1', 'log2'),
+                         'Failed to apply binary log log1 to localhost:3306')
+        self.assertEqual(self.imported, ['full', 'log1'])
+
+
+class S3TestCase(unittest.TestCase):
+    """ Runs a fake S3 and replaces the status by one of a temporary
+        directory
+    """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.s3 = FakeS3(os.path.join(self.dir, 's3')).start()
+        self.data_dir, base.DATA_DIR = base.DATA_DIR, self.dir
+        data = os.path.join(self.dir, 'data')
+        with open(data, 'w') as f:
+            pickle.dump({'key': 'test'}, f)
+        self.status, backup.status = (backup.status,
+                                      Status(data, amazon=self.s3.access()))
+        self.bucket = backup.get_bucket()
+
+    def tearDown(self):
+        backup.status = self.status
+        base.DATA_DIR = self.data_dir
+        self.s3.stop()
+        shutil.rmtree(self.dir)
+
+
+class UploadTestCase(S3TestCase):
+    """ Uploads 4 parts of 1M, the third part fails while failing is set
+    """
+    def setUp(self):
+        S3TestCase.setUp(self)
+        self.chunk_size, backup.CHUNK_SIZE = backup.CHUNK_SIZE, 1024 * 1024
+        self.path = os.path.join(self.dir, 'file')
+        with open(self.path, 'wb') as f:
+            f.write(os.urandom(4 * backup.CHUNK_SIZE))
+        self.upload_part = MultiPartUpload.upload_part_from_file
+        self.failing = True
+        test = self
+
+        def upload_part(self, fp, part_num, **kwargs):
+            if test.failing and part_num == 3:
+                raise IOError('Connection reset by peer')
+            return test.upload_part(self, fp, part_num, **kwargs)
+
+        MultiPartUpload.upload_part_from_file = upload_part
+
+    def tearDown(self):
+        MultiPartUpload.upload_part_from_file = self.upload_part
+        backup.CHUNK_SIZE = self.chunk_size
+        S3TestCase.tearDown(self)
+
+    def interrupt(self):
+        self.assertEqual(backup.upload_resumable('key', self.path,
+                                                 bucket=self.bucket), None)
+        self.assertEqual(sorted(backup.status.uploads['key']['parts']),
+                         [1, 2])
+        self.s3.reset()
+        self.failing = False
+
+
+class UploadResumeTest(UploadTestCase):
+    def runTest(self):
+        self.interrupt()
+        # the upload is resumed by a new status from the saved one
+        backup.status = Status(backup.status.path)
+        self.assertEqual(backup.upload_resumable('key', self.path,
+                                                 bucket=self.bucket),
+                         os.path.getsize(self.path))
+        self.assertEqual(backup.status.uploads, {})
+        self.assertEqual(self.s3.stats()['requests'].get('PUT part'), 2)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(self.bucket.get_key('key').read(), f.read())
+
+
+class AbortUploadsTest(UploadTestCase):
+    def runTest(self):
+        self.interrupt()
+        backup.abort_uploads(self.bucket)
+        self.assertEqual(backup.status.uploads, {})
+        self.assertEqual(self.s3.stats()['requests'].get('DELETE abort'), 1)
+        self.assertEqual(list(self.bucket.list_multipart_uploads()), [])
+        self.assertEqual(self.bucket.get_key('key'), None)
+
+
+class ManifestDeltaTest(S3TestCase):
+    """ Uploads the manifest of backup 1 whole and deltas of backups 2 and
+        3, then rebuilds the manifest of backup 3 from them
+    """
+    def row(self, path, backup_id, size=1):
+        return (path, 1, 1.5, size, 33188, 0, 0, 1, backup_id, None, None,
+                None, None, None, '[[0, %i]]' % size)
+
+    def upload_delta(self, backup_id):
+        with tempfile.TemporaryFile() as f:
+            backup.write_delta(f, self.data.changes(since=backup_id - 1))
+            delta = list(backup.read_delta(f))
+            self.assertEqual(delta, list(self.data.changes(
+                since=backup_id - 1)))
+            f.seek(0)
+            backup.upload(backup.get_prefix(backup_id) + 'backup.db.delta', f,
+                          bucket=self.bucket,
+                          metadata={'prev': str(backup_id - 1)})
+
+    def runTest(self):
+        self.data = backup.status.backupdb
+        self.data.add([self.row('/etc/hosts', 1), self.row('/etc/motd', 1)])
+        self.data.add_content([('h1', 1, 'pack-1', 1, 0, 10, 1)])
+        with tempfile.TemporaryFile() as f:
+            with open(self.data.db, 'rb') as db:
+                backup.write_gzipped(f, db)
+            backup.upload(backup.get_prefix(1) + 'backup.db', f,
+                          bucket=self.bucket)
+        self.data.add([self.row('/etc/hosts', 2, size=2),
+                       self.row('/srv/caf\xe9/\xff', 2)])
+        self.data.add_content([('h2', 2, 'pack-2', 1, 0, 20, 2)])
+        self.upload_delta(2)
+        self.data.add([self.row('/srv/caf\xe9/\xff', 3, size=3)])
+        self.data.add_content([('h3', 3, 'ref', 0, None, None, 3)])
+        self.upload_delta(3)
+
+        path = os.path.join(self.dir, 'restore.db')
+        self.assertEqual(backup.get_database(3, path=path), 0)
+        rebuilt = BackupData(path)
+        self.assertEqual(sorted(rebuilt.files()), sorted(self.data.files()))
+        self.assertEqual(rebuilt.get('/srv/caf\xe9/\xff'), (1.5, 3, 3))
+        for digest in ('h1', 'h2', 'h3'):
+            self.assertEqual(rebuilt.get_content(digest),
+                             self.data.get_content(digest))
+        self.assertEqual(backup.get_database(4, path=path), -1)
+
+
+class RekeyTest(S3TestCase):
+    """ A file uploaded again by a backup resumed after an interruption
+        goes to another key, the uploaded object may be referenced already
+    """
+    def runTest(self):
+        path = os.path.join(self.dir, 'file')
+        with open(path, 'wb') as f:
+            f.write(os.urandom(1000))
+        handler = backup.BackupHandler(1)
+        row = handler.upload_file(path, os.stat(path))
+        self.assertEqual(row[12], None)
+        backup.status.backupdb.add((row,))
+        key = handler.get_fs_keyname(path)
+        uploaded = self.bucket.get_key(key).read()
+
+        # a new handler of the same backup, as after a restart
+        handler = backup.BackupHandler(1)
+        with open(path, 'wb') as f:
+            f.write(os.urandom(1000))
+        row = handler.upload_file(path, os.stat(path))
+        self.assertTrue(row[12].startswith(key + '.'))
+        self.assertEqual(self.bucket.get_key(key).read(), uploaded)
+        self.assertTrue(self.bucket.get_key(row[12]))
+        backup.status.backupdb.add((row,))
+        self.assertEqual(backup.status.backupdb.files(backup_id=1)[0][7],
+                         row[12])
+
+
+class LinkPackTest(S3TestCase):
+    """ A hardlink to a file of the pack not uploaded yet is added to the
+        manifest with the pack, so an interrupted backup has neither
+    """
+    def runTest(self):
+        path = os.path.join(self.dir, 'file')
+        link = os.path.join(self.dir, 'link')
+        with open(path, 'wb') as f:
+            f.write('data')
+        os.link(path, link)
+        handler = backup.BackupHandler(1)
+        self.assertEqual(handler.pack_file(path, os.stat(path)), False)
+        handler.link_file(link, os.stat(link), path)
+        self.assertEqual(handler.packed, 2)
+        self.assertEqual(backup.status.backupdb.count(), 0)
+        self.assertTrue(handler.flush_pack())
+        self.assertEqual(handler.files_count, 2)
+        self.assertEqual(sorted(r[0] for r in backup.status.backupdb.files()),
+                         [path, link])
+        # with no pack being filled the row is added at once
+        other = os.path.join(self.dir, 'other')
+        os.link(path, other)
+        handler.link_file(other, os.stat(other), path)
+        self.assertEqual(handler.packed, 0)
+        self.assertEqual(backup.status.backupdb.get(other)[2], 1)
+
+
+@unittest.skipIf(os.getuid() != 0, 'bitcalm.backupd runs only as root')
+class BackupTestCase(S3TestCase):
+    """ Backs up the tree directory by make_backup with the fake S3 and
+        the fake control API
+    """
+    def setUp(self):
+        S3TestCase.setUp(self)
+        from bitcalm import backupd
+        self.backupd = backupd
+        self.fakeapi = FakeApi().start()
+        self.api = api._api
+        api._api = Api(self.fakeapi.host, self.fakeapi.port, 'test', 'test')
+        api._api.conn_cls = HTTPConnection
+        self.client_status, backupd.client_status = (backupd.client_status,
+                                                     backup.status)
+        self.top = os.path.join(self.dir, 'tree')
+        os.makedirs(self.top)
+        backup.status.schedules = [DailySchedule(id=1, time=(12, 0),
+                                                 files=[self.top], db={},
+                                                 day=1)]
+
+    def tearDown(self):
+        self.backupd.actions.clear()
+        self.backupd.client_status = self.client_status
+        api._api = self.api
+        self.fakeapi.stop()
+        S3TestCase.tearDown(self)
+
+    def write(self, name, data):
+        path = os.path.join(self.top, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def make_backup(self):
+        self.assertTrue(self.backupd.make_backup())
+        return self.fakeapi.completed[-1]
+
+    def restore(self, backup_id):
+        """ Moves the tree aside and restores the backup to its place,
+            returns the path of the original tree
+        """
+        orig = self.top + '.orig'
+        os.rename(self.top, orig)
+        self.assertEqual(backup.restore(backup_id), None)
+        return orig
+
+    def assertRestored(self, contents):
+        for path, data in contents.iteritems():
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), data, path)
+
+
+class PackTest(BackupTestCase):
+    """ Small files go to packs of several files, the cursor is not
+        saved past files of the pack not uploaded yet
+    """
+    def setUp(self):
+        BackupTestCase.setUp(self)
+        self.pack_size, backup.PACK_SIZE = backup.PACK_SIZE, 4096
+        self.iterfiles = self.backupd.iterfiles
+
+        def iterfiles(**kwargs):
+            walk = self.iterfiles(**kwargs)
+            walk.period = 0
+            return walk
+
+        self.backupd.iterfiles = iterfiles
+
+    def tearDown(self):
+        self.backupd.iterfiles = self.iterfiles
+        backup.PACK_SIZE = self.pack_size
+        BackupTestCase.tearDown(self)
+
+    def runTest(self):
+        contents = {}
+        for i in xrange(12):
+            name = 'd%i/f%i%s' % (i % 3, i, '.gz' if i == 5 else '')
+            data = os.urandom(1000)
+            contents[self.write(name, data)] = data
+        paths = sorted(contents)
+        status = backup.status
+        save = status.save
+        cursors = []
+
+        def checked_save(*args, **kwargs):
+            cursor = (status.backup or {}).get('cursor')
+            if cursor and (not cursors or cursors[-1] != cursor):
+                cursors.append([list(c) for c in cursor])
+                rest = set(self.iterfiles(dirs=[self.top], cursor=cursor))
+                for path in paths:
+                    if path not in rest:
+                        self.assertTrue(status.backupdb.get(path), path)
+            return save(*args, **kwargs)
+
+        status.save = checked_save
+        try:
+            backup_id = self.make_backup()
+        finally:
+            del status.save
+        self.assertTrue(cursors)
+        rows = dict((row[0], row) for row
+                    in status.backupdb.files(backup_id=backup_id))
+        self.assertEqual(sorted(rows), paths)
+        packs = {}
+        for row in rows.itervalues():
+            self.assertTrue(row[4])
+            packs.setdefault(row[4], []).append(row)
+        self.assertTrue(len(packs) > 1)
+        prefix = backup.get_prefix(backup_id, ptype=backup.PREFIX_TYPE.FS)
+        for pack in packs:
+            self.assertTrue(self.bucket.get_key(prefix + pack))
+        # gzipped already
+        self.assertEqual(rows[os.path.join(self.top, 'd2/f5.gz')][3], 0)
+
+        # the first and the last files of a pack, one GET when the gap
+        # between them is no more than PACK_GAP and two otherwise
+        members = sorted(max(packs.values(), key=len), key=lambda r: r[5])
+        self.assertTrue(len(members) > 2)
+        members = [(prefix + r[4], r[0], r[3], r[5], r[6])
+                   for r in (members[0], members[-1])]
+        for gap, gets in ((backup.PACK_GAP, 1), (0, 2)):
+            for m in members:
+                os.remove(m[1])
+            gap, backup.PACK_GAP = backup.PACK_GAP, gap
+            self.s3.reset()
+            try:
+                backup.restore_pack(self.bucket, members)
+            finally:
+                backup.PACK_GAP = gap
+            self.assertEqual(self.s3.stats()['requests']['GET object'], gets)
+            self.assertRestored(dict((m[1], contents[m[1]])
+                                     for m in members))
+
+        self.restore(backup_id)
+        self.assertRestored(contents)
+
+
+class DedupTest(BackupTestCase):
+    """ Files with the content of an uploaded object or of a packed file
+        refer to it and are restored from it
+    """
+    def runTest(self):
+        big = os.urandom(backup.PACK_FILE_SIZE + 1)
+        small = os.urandom(1000)
+        paths = {}
+        contents = {}
+        for name, data in (('big', big), ('copy', big),
+                           ('same', small), ('small', small)):
+            paths[name] = self.write(name, data)
+            contents[paths[name]] = data
+        backup_id = self.make_backup()
+        prefix = backup.get_prefix(backup_id, ptype=backup.PREFIX_TYPE.FS)
+        rows = dict((row[0], row) for row
+                    in backup.status.backupdb.files(backup_id=backup_id))
+        big, copy, same, small = [rows[paths[name]] for name
+                                  in ('big', 'copy', 'same', 'small')]
+        key = backup.make_hash_fs_key(prefix, paths['big'])
+        self.assertEqual(big[7], None)
+        self.assertEqual(copy[7], key)
+        # the reference to a packed file has its offset and length
+        self.assertTrue(same[4])
+        self.assertEqual(small[4:8], (None,) + same[5:7] + (prefix + same[4],))
+        self.assertEqual(sorted(k.name for k in self.bucket.list(prefix)),
+                         sorted([key, prefix + same[4]]))
+        self.restore(backup_id)
+        self.assertRestored(contents)
+
+
+class LinkTest(BackupTestCase):
+    """ Another hardlink of a backed up file is not uploaded and is
+        restored as a hardlink
+    """
+    def runTest(self):
+        contents = {}
+        links = {}
+        for name, link, size in (('a', 'b', 1000),
+                                 ('c', 'd', backup.PACK_FILE_SIZE + 1)):
+            data = os.urandom(size)
+            path = self.write(name, data)
+            links[os.path.join(self.top, link)] = path
+            os.link(path, os.path.join(self.top, link))
+            contents[path] = data
+        backup_id = self.make_backup()
+        prefix = backup.get_prefix(backup_id, ptype=backup.PREFIX_TYPE.FS)
+        rows = dict((row[0], row) for row
+                    in backup.status.backupdb.files(backup_id=backup_id))
+        self.assertEqual(sorted(rows), sorted(contents.keys() + links.keys()))
+        for link, target in links.iteritems():
+            self.assertEqual(rows[link][8], target)
+        self.assertEqual(len(list(self.bucket.list(prefix))), 2)
+        self.restore(backup_id)
+        self.assertRestored(contents)
+        for link, target in links.iteritems():
+            self.assertEqual(os.stat(link).st_ino, os.stat(target).st_ino)
+
+
+class SparseTest(BackupTestCase):
+    """ Only data of sparse files is uploaded, by one object and by parts,
+        and they are restored with their holes
+    """
+    def setUp(self):
+        BackupTestCase.setUp(self)
+        self.chunk_size, backup.CHUNK_SIZE = backup.CHUNK_SIZE, 1024 * 1024
+
+    def tearDown(self):
+        backup.CHUNK_SIZE = self.chunk_size
+        BackupTestCase.tearDown(self)
+
+    def runTest(self):
+        block = backup.CHUNK_SIZE
+        contents = {}
+        holes = {}
+        for name, extents in (('small', [(block, block / 2)]),
+                              ('large', [(0, block), (4 * block, block)])):
+            path = self.write(name, '')
+            with open(path, 'r+b') as f:
+                for offset, length in extents:
+                    f.seek(offset)
+                    f.write(os.urandom(length))
+                f.truncate(8 * block)
+            with open(path, 'rb') as f:
+                contents[path] = f.read()
+            holes[path] = extents
+            if get_extents(path) != extents:
+                # the filesystem does not report holes
+                return
+        backup_id = self.make_backup()
+        for row in backup.status.backupdb.files(backup_id=backup_id):
+            self.assertNotEqual(row[10], None)
+        self.restore(backup_id)
+        self.assertRestored(contents)
+        for path, extents in holes.iteritems():
+            info = os.stat(path)
+            self.assertEqual(info.st_size, 8 * block)
+            self.assertTrue(info.st_blocks * 512 < info.st_size / 2, path)
+            self.assertEqual(get_extents(path), extents)
+
+
+class BlockingGovernor(object):
+    """ Stops the backup at the first file until resume is set
+    """
+    def __init__(self):
+        self.checked = Event()
+        self.resume = Event()
+
+    def check(self):
+        self.checked.set()
+        self.resume.wait(10)
+
+    def workers(self, workers):
+        return workers
+
+
+class ScheduleChangeTest(BackupTestCase):
+    def runTest(self):
+        self.write('file', 'data')
+        governor, self.backupd.governor = self.backupd.governor, \
+                                          BlockingGovernor()
+        try:
+            t = Thread(target=self.make_backup)
+            t.start()
+            self.assertTrue(self.backupd.governor.checked.wait(10))
+            # the backed up schedule is replaced by a weekly one and
+            # another one becomes the next
+            self.fakeapi.changes = {'schedules': [
+                {'id': 1, 'type': 'weekly', 'days': 127, 'time': [12, 0],
+                 'files': [self.top]},
+                {'id': 2, 'type': 'daily', 'day': 1, 'time': [6, 0],
+                 'files': [self.top]}]}
+            self.assertTrue(self.backupd.check_changes())
+            self.backupd.governor.resume.set()
+            t.join(30)
+        finally:
+            self.backupd.governor = governor
+        self.assertEqual(self.fakeapi.completed, [1])
+        schedules = dict((s.id, s) for s in backup.status.schedules)
+        self.assertTrue(isinstance(schedules[1], WeeklySchedule))
+        self.assertNotEqual(schedules[1].prev_backup, None)
+        self.assertEqual(schedules[2].prev_backup, None)
+        self.assertIs(backup.next_schedule(), schedules[2])
+
+
+class DatabaseCrashTest(BackupTestCase):
+    """ A dump that raised is logged and counted as failed
+    """
+    def setUp(self):
+        BackupTestCase.setUp(self)
+        self.dump_database = self.backupd.dump_database
+
+        def dump_database(handler, host, port, name, user, passwd, size=0):
+            if name == 'broken':
+                raise IOError('Connection reset by peer')
+            return 10
+
+        self.backupd.dump_database = dump_database
+
+    def tearDown(self):
+        self.backupd.dump_database = self.dump_database
+        BackupTestCase.tearDown(self)
+
+    def runTest(self):
+        databases = [('127.0.0.1', 1, 'broken'), ('127.0.0.1', 1, 'test')]
+        logged = len(log.upload)
+        with backup.BackupHandler(1) as handler:
+            self.assertEqual(self.backupd.backup_databases(
+                handler, databases, {'127.0.0.1:1': ('root', '')}), 1)
+        self.assertEqual(databases, [])
+        self.assertTrue(any('IOError: Connection reset by peer' in e
+                            for e in log.upload[logged:]))
+
+
+class VersionTest(unittest.TestCase):
+    def runTest(self):
+        self.assertEqual(get_version((0, 1, 2, None, 0)), '0.1.2')
+        self.assertEqual(get_version((0, 1, 0, 'rc', 2)), '0.1c2')
+        self.assertEqual(get_version((0, 1, 0, 'dev', 1)), '0.1.dev')
+        self.assertEqual(get_version((0, 1, 0, 'dev', 1), timestamp=86400),
+                         '0.1.dev19700102000000')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,85 @@
+import time
+import threading
+from datetime import datetime
+
+from bitcalm.config import config
+
+
+class TokenBucket(object):
+    """ Thread safe token bucket; rate is in bytes per second, 0 means
+        no limit. A consumer that exceeds the rate sleeps until its debt
+        is paid off, so the limit is shared by all parallel transfers.
+    """
+    def __init__(self, rate=0, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = 0
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.tokens = min(self.tokens, rate * self.burst)
+
+    def consume(self, amount):
+        """ Returns the time spent waiting in seconds
+        """
+        with self.lock:
+            if not self.rate:
+                return 0
+            now = time.time()
+            self.tokens = min(self.rate * self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            pause = -self.tokens / float(self.rate) if self.tokens < 0 else 0
+        if pause:
+            time.sleep(pause)
+        return pause
+
+
+class Bandwidth(object):
+    """ Applies the rate of the first profile matching the local time.
+        A profile is a dict with start and end minute of the day and
+        rate in bytes per second; the period may pass midnight.
+    """
+    def __init__(self, profiles=()):
+        self.profiles = profiles
+        self.bucket = TokenBucket(self.get_rate())
+
+    def get_rate(self, now=None):
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+        for p in self.profiles:
+            if p['start'] <= p['end']:
+                inside = p['start'] <= minute < p['end']
+            else:
+                inside = minute >= p['start'] or minute < p['end']
+            if inside:
+                return p['rate']
+        return 0
+
+    def consume(self, amount):
+        rate = self.get_rate()
+        if rate != self.bucket.rate:
+            self.bucket.set_rate(rate)
+        return self.bucket.consume(amount)
+
+    def callback(self):
+        """ Returns boto progress callback to be used with num_cb=-1
+            or None if there are no limits.
+        """
+        if not self.profiles:
+            return None
+        state = {'done': 0}
+        def cb(transmitted, total):
+            if transmitted < state['done']:
+                # transfer was restarted
+                state['done'] = 0
+            self.consume(transmitted - state['done'])
+            state['done'] = transmitted
+        return cb
+
+
+bandwidth = Bandwidth(config.bandwidth)
@@ -1,8 +1,11 @@
 import re
 import time
 import platform
+import threading
+import traceback
 import subprocess
 
+from bitcalm import log
 from bitcalm.const import DAY, MICROSEC
 
 
@@ -37,6 +40,61 @@ def try_exec(func, args=(), kwargs={}, exc=Exception, tries=3, pause=60):
                 raise e
 
 
+def run_parallel(func, items, workers=1, group=None, group_workers=0):
+    """ Calls func for every item using up to workers threads.
+        Items are started in the given order, but no more than
+        group_workers items of the same group(item) run at once.
+        Returns items for which func raised an exception, the exceptions
+        are logged with their tracebacks.
+    """
+    items = list(items)
+    cond = threading.Condition()
+    active = {}
+    failed = []
+
+    def pick():
+        for i, item in enumerate(items):
+            g = group(item) if group else None
+            if not group_workers or active.get(g, 0) < group_workers:
+                del items[i]
+                return (item, g)
+        return None
+
+    def worker():
+        while True:
+            with cond:
+                picked = pick()
+                while not picked:
+                    if not items:
+                        return
+                    cond.wait()
+                    picked = pick()
+                item, g = picked
+                active[g] = active.get(g, 0) + 1
+            try:
+                func(item)
+            except Exception:
+                # items may hold credentials, they are not logged
+                log.error('%s crashed:\n%s'
+                          % (getattr(func, '__name__', func),
+                             traceback.format_exc()))
+                with cond:
+                    failed.append(item)
+            finally:
+                with cond:
+                    active[g] -= 1
+                    cond.notify_all()
+
+    threads = [threading.Thread(target=worker)
+               for i in xrange(min(workers, len(items)))]
+    for t in threads:
+        t.setDaemon(True)
+        t.start()
+    for t in threads:
+        t.join()
+    return failed
+
+
 def get_system_info():
     """unit of measurement of memory is kB"""
     data = {'kernel': '%s %s' % (platform.system(), platform.release()),
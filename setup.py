@@ -5,12 +5,21 @@ import shutil
 
 from setuptools import setup, find_packages
 
-from bitcalm import __version__
+from bitcalm import __version__, get_version, git_timestamp
+
+
+BUILD_PATH = os.path.join('bitcalm', '_build.py')
 
 
 if sys.version_info < (2, 6):
     exit('Please upgrade your python to 2.6 or newer')
 
+timestamp = git_timestamp()
+if timestamp:
+    __version__ = get_version(timestamp=timestamp)
+    with open(BUILD_PATH, 'w') as f:
+        f.write('__version__ = %r\n' % __version__)
+
 with open('req.txt') as req:
     install_requires = [s.strip() for s in req.readlines()]
 
@@ -19,7 +28,7 @@ setup(name = 'bitcalm',
       packages = find_packages(),
       install_requires = install_requires,
       zip_safe = False,
-      entry_points = {'console_scripts': ['bitcalm = bitcalm.backupd:main',]},
+      scripts = ['default/bitcalm',],
       data_files = [('/etc/init.d', ['default/bitcalmd',]),
                     ('/usr/local/bin', ['default/uninstall_bitcalm',])]
       )